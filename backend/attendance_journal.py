@@ -0,0 +1,585 @@
+"""
+出勤・退勤のローカル先行書き込み（ライトアヘッドジャーナル）
+
+打刻はローカルの SQLite に追記した時点で確定として応答し、`attendance_logs` への反映は
+バックグラウンドの `JournalReplayer` が追記順に行う。Supabase が遅い・落ちている間も打刻は
+ローカルディスクへの書き込み時間だけで返り、復旧後に順番どおり追いつく。
+
+- 出勤は Supabase の ID がまだ無いので、仮の負の ID（`provisional_id`）で台帳・応答に使い、
+  反映後に本当の ID に付け替える（`on_resolved` コールバック）
+- 未反映の出勤・退勤はユーザーごとの最新状態（`overlay()`）として公開し、未退勤シフト台帳が
+  DB を読み直しても打刻済みの状態が巻き戻らないようにする
+- 反映時に DB 側の状態と食い違っていれば（別の端末で出勤済み・退勤済みなど）`conflict` として記録し、
+  DB 側を正として先に進む
+- 退勤と一緒に外部システム（Stapro）へ送る内容（`sync`）も記録し、反映時に `submit_clock_out` に渡す。
+  打刻の処理が送信ジョブを積む前に落ちても、ジャーナルから積み直せる
+
+`attendance_journal` テーブルの列:
+    seq (PK), kind (clock_in / clock_out), user_id (JSON), attendance_id, clock_in_seq,
+    payload (JSON), sync (JSON), status, attempts, last_error, created_at, applied_at
+
+使用方法:
+    from attendance_journal import AttendanceJournal, JournalReplayer
+
+    journal = AttendanceJournal("attendance_journal.db")
+    replayer = JournalReplayer(journal, get_supabase=lambda: supabase)
+    replayer.start()
+
+    entry = await journal.append_clock_in(user_id, clock_in_at)
+    replayer.notify()
+"""
+
+import asyncio
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+# エントリーの状態
+JOURNAL_PENDING = 'pending'
+JOURNAL_APPLIED = 'applied'
+JOURNAL_CONFLICT = 'conflict'
+JOURNAL_FAILED = 'failed'
+
+KIND_CLOCK_IN = 'clock_in'
+KIND_CLOCK_OUT = 'clock_out'
+
+JOURNAL_APPEND_SECONDS = REGISTRY.histogram(
+    'attendance_journal_append_seconds', '打刻をジャーナルに追記する所要時間（種類別）', ['kind'])
+JOURNAL_REPLAY_SECONDS = REGISTRY.histogram(
+    'attendance_journal_replay_seconds', 'ジャーナルのエントリーを attendance_logs に反映する所要時間（種類・結果別）',
+    ['kind', 'status'])
+
+# 接続できない・応答が無いなどの一時的な失敗（何度でも再試行し、失敗回数に数えない）
+_TRANSIENT_ERRORS = (httpx.TransportError, asyncio.TimeoutError, OSError)
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _same_instant(a: Any, b: Any) -> bool:
+    """2 つのタイムスタンプ文字列が同じ時刻を指すか（表記ゆれを吸収する）"""
+    if a is None or b is None:
+        return False
+    try:
+        return datetime.fromisoformat(str(a).replace('Z', '+00:00')) == datetime.fromisoformat(str(b).replace('Z', '+00:00'))
+    except ValueError:
+        return str(a) == str(b)
+
+
+def is_provisional(attendance_id: Any) -> bool:
+    """ジャーナルが払い出した仮の勤怠 ID か"""
+    return isinstance(attendance_id, int) and attendance_id < 0
+
+
+class AttendanceJournal:
+    """SQLite に保存する出勤・退勤のジャーナル
+
+    仮の ID は `-(ノード番号 << 32 | seq)`。ノード番号はジャーナルファイルごとにランダムに決めるので、
+    複数のレプリカが Supabase のアウトボックスを共有していても仮の ID が重ならない。
+    """
+
+    def __init__(self, path: str, on_settled: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None):
+        self.path = path
+        # 反映結果を記録したら呼ぶ（同じジャーナルを使う他のワーカーに伝えるため）
+        self.on_settled = on_settled
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        # 反映されるまではここが唯一の記録なので、コミットごとに fsync する
+        self._conn.execute('PRAGMA synchronous=FULL')
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS attendance_journal (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                attendance_id INTEGER,
+                clock_in_seq INTEGER,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                created_at TEXT NOT NULL,
+                applied_at TEXT
+            )
+            """
+        )
+        columns = {row['name'] for row in self._conn.execute('PRAGMA table_info(attendance_journal)')}
+        if 'sync' not in columns:
+            # 外部連携の内容を持たない古いジャーナルファイル
+            self._conn.execute('ALTER TABLE attendance_journal ADD COLUMN sync TEXT')
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS attendance_journal_status ON attendance_journal (status, seq)'
+        )
+        self._conn.execute('CREATE TABLE IF NOT EXISTS attendance_journal_meta (key TEXT PRIMARY KEY, value TEXT)')
+        self._conn.execute(
+            "INSERT OR IGNORE INTO attendance_journal_meta (key, value) VALUES ('node', ?)",
+            (str(random.randrange(1, 1 << 16)),),
+        )
+        self.node = int(self._conn.execute("SELECT value FROM attendance_journal_meta WHERE key = 'node'").fetchone()[0])
+
+        # ユーザーID → 未反映の最新状態（出勤中なら台帳の行、退勤済みなら None）と、その seq
+        self._overlay: Dict[Any, Optional[Dict[str, Any]]] = {}
+        self._latest_seq: Dict[Any, int] = {}
+        # 仮の ID → 反映後の ID
+        self._resolved: Dict[int, int] = {}
+        # 状態別のエントリー数と、未反映エントリーの seq → 追記時刻（seq 順）。
+        # メトリクスの収集でイベントループから SQLite を読まないよう、追記・反映のたびに手元で更新する
+        self._counts: Dict[str, int] = {}
+        self._pending_at: Dict[int, str] = {}
+        self._load_state()
+
+    # ========================================
+    # 内部処理（SQLite）
+    # ========================================
+
+    def provisional_id(self, seq: int) -> int:
+        return -((self.node << 32) | seq)
+
+    @staticmethod
+    def _to_entry(row: Optional[sqlite3.Row]) -> Optional[Dict[str, Any]]:
+        if row is None:
+            return None
+        entry = dict(row)
+        entry['user_id'] = json.loads(entry['user_id'])
+        entry['payload'] = json.loads(entry['payload'])
+        entry['sync'] = json.loads(entry['sync']) if entry.get('sync') else None
+        return entry
+
+    def _execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._conn.execute(sql, params)
+
+    def _load_state(self) -> None:
+        rows = self._execute('SELECT status, COUNT(*) AS n FROM attendance_journal GROUP BY status').fetchall()
+        self._counts = {row['status']: row['n'] for row in rows}
+        rows = self._execute(
+            'SELECT * FROM attendance_journal WHERE status = ? ORDER BY seq', (JOURNAL_PENDING,)
+        ).fetchall()
+        for row in rows:
+            entry = self._to_entry(row)
+            self._track(entry)
+            self._pending_at[entry['seq']] = entry['created_at']
+        # 直近に反映した出勤の付け替え（再起動前に発行した状態トークンなどの照合用）
+        rows = self._execute(
+            'SELECT * FROM (SELECT seq, attendance_id FROM attendance_journal '
+            'WHERE kind = ? AND attendance_id IS NOT NULL ORDER BY seq DESC LIMIT 10000) ORDER BY seq',
+            (KIND_CLOCK_IN,),
+        ).fetchall()
+        for row in rows:
+            self._resolved[self.provisional_id(row['seq'])] = row['attendance_id']
+
+    def _track(self, entry: Dict[str, Any]) -> None:
+        user_id = entry['user_id']
+        if entry['kind'] == KIND_CLOCK_IN:
+            self._overlay[user_id] = {
+                'id': self.provisional_id(entry['seq']),
+                'user_id': user_id,
+                'clock_in_at': entry['payload'].get('clock_in_at'),
+            }
+        else:
+            self._overlay[user_id] = None
+        self._latest_seq[user_id] = entry['seq']
+
+    def _appended(self, entry: Dict[str, Any]) -> None:
+        self._track(entry)
+        self._pending_at[entry['seq']] = entry['created_at']
+        self._counts[JOURNAL_PENDING] = self._counts.get(JOURNAL_PENDING, 0) + 1
+
+    def _append(
+        self, kind: str, user_id: Any, payload: Dict[str, Any],
+        attendance_id: Optional[int] = None, clock_in_seq: Optional[int] = None,
+        sync: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        with self._lock:
+            cur = self._conn.execute(
+                'INSERT INTO attendance_journal '
+                '(kind, user_id, attendance_id, clock_in_seq, payload, sync, status, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (kind, json.dumps(user_id), attendance_id, clock_in_seq,
+                 json.dumps(payload, ensure_ascii=False),
+                 json.dumps(sync, ensure_ascii=False) if sync is not None else None,
+                 JOURNAL_PENDING, _now_iso()),
+            )
+            row = self._conn.execute('SELECT * FROM attendance_journal WHERE seq = ?', (cur.lastrowid,)).fetchone()
+        return self._to_entry(row)
+
+    def _pending(self, limit: int) -> List[Dict[str, Any]]:
+        rows = self._execute(
+            'SELECT * FROM attendance_journal WHERE status = ? ORDER BY seq LIMIT ?', (JOURNAL_PENDING, limit)
+        ).fetchall()
+        return [self._to_entry(r) for r in rows]
+
+    def _get(self, seq: int) -> Optional[Dict[str, Any]]:
+        return self._to_entry(self._execute('SELECT * FROM attendance_journal WHERE seq = ?', (seq,)).fetchone())
+
+    def _update(self, seq: int, fields: Dict[str, Any]) -> None:
+        columns = ', '.join(f'{k} = ?' for k in fields)
+        self._execute(f'UPDATE attendance_journal SET {columns} WHERE seq = ?', (*fields.values(), seq))
+
+    def _entries(self, status: Optional[str], limit: int) -> List[Dict[str, Any]]:
+        if status is None:
+            rows = self._execute('SELECT * FROM attendance_journal ORDER BY seq DESC LIMIT ?', (limit,)).fetchall()
+        else:
+            rows = self._execute(
+                'SELECT * FROM attendance_journal WHERE status = ? ORDER BY seq DESC LIMIT ?', (status, limit)
+            ).fetchall()
+        return [self._to_entry(r) for r in rows]
+
+    # ========================================
+    # 追記（打刻の処理から呼ぶ）
+    # ========================================
+
+    # SQLite の書き込み（fsync）でイベントループを止めないよう、スレッドで実行する
+
+    async def append_clock_in(self, user_id: Any, clock_in_at: str) -> Dict[str, Any]:
+        """出勤を追記する。戻り値の `provisional_id` を勤怠 ID の代わりに使う"""
+        with JOURNAL_APPEND_SECONDS.time(kind=KIND_CLOCK_IN):
+            entry = await asyncio.to_thread(
+                self._append, KIND_CLOCK_IN, user_id, {'user_id': user_id, 'clock_in_at': clock_in_at})
+        self._appended(entry)
+        entry['provisional_id'] = self.provisional_id(entry['seq'])
+        return entry
+
+    async def append_clock_out(
+        self, user_id: Any, attendance_id: Any, update: Dict[str, Any], sync: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        """退勤（`attendance_logs` の更新内容）を追記する。`attendance_id` は仮の ID でもよい
+
+        `sync` には外部システムへ送る内容を渡す（反映時に `JournalReplayer.submit_clock_out` に渡される）。
+        """
+        attendance_id = self.resolve(attendance_id)
+        clock_in_seq = None
+        if is_provisional(attendance_id):
+            # 出勤がまだ反映されていない。反映時に出勤エントリーの結果から ID を引く
+            clock_in_seq = -attendance_id & 0xFFFFFFFF
+            attendance_id = None
+        with JOURNAL_APPEND_SECONDS.time(kind=KIND_CLOCK_OUT):
+            entry = await asyncio.to_thread(
+                self._append, KIND_CLOCK_OUT, user_id, update, attendance_id, clock_in_seq, sync)
+        self._appended(entry)
+        return entry
+
+    # ========================================
+    # 参照
+    # ========================================
+
+    def overlay(self) -> Dict[Any, Optional[Dict[str, Any]]]:
+        """未反映の打刻によるユーザーごとの最新状態（出勤中なら台帳の行、退勤済みなら None）"""
+        return dict(self._overlay)
+
+    def resolve(self, attendance_id: Any) -> Any:
+        """仮の ID を反映後の ID に読み替える（未反映・仮でない ID はそのまま返す）"""
+        return self._resolved.get(attendance_id, attendance_id) if is_provisional(attendance_id) else attendance_id
+
+    async def pending(self, limit: int = 100) -> List[Dict[str, Any]]:
+        return await asyncio.to_thread(self._pending, limit)
+
+    async def get(self, seq: int) -> Optional[Dict[str, Any]]:
+        return await asyncio.to_thread(self._get, seq)
+
+    async def entries(self, status: Optional[str] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        return await asyncio.to_thread(self._entries, status, limit)
+
+    def counts(self) -> Dict[str, int]:
+        """状態別のエントリー数（起動時の件数に、このワーカーが見た追記・反映を足したもの）"""
+        return dict(self._counts)
+
+    def lag_seconds(self) -> float:
+        """最も古い未反映エントリーの経過秒数（無ければ 0）"""
+        if not self._pending_at:
+            return 0.0
+        oldest = next(iter(self._pending_at.values()))
+        return max(0.0, (datetime.now(timezone.utc) - datetime.fromisoformat(oldest)).total_seconds())
+
+    # ========================================
+    # 反映結果の記録（JournalReplayer から呼ぶ）
+    # ========================================
+
+    async def settle(
+        self, entry: Dict[str, Any], status: str, attendance_id: Optional[int] = None, error: Optional[str] = None,
+    ) -> None:
+        """エントリーを反映済み（または conflict / failed）にする"""
+        fields: Dict[str, Any] = {'status': status, 'last_error': error, 'applied_at': _now_iso()}
+        if attendance_id is not None:
+            fields['attendance_id'] = attendance_id
+        await asyncio.to_thread(self._update, entry['seq'], fields)
+        settled = {
+            'seq': entry['seq'], 'kind': entry['kind'], 'user_id': entry['user_id'],
+            'attendance_id': attendance_id, 'status': status,
+        }
+        self.settled(settled)
+        if self.on_settled is not None:
+            try:
+                await self.on_settled(settled)
+            except Exception:
+                logger.exception("attendance journal on_settled failed", extra={'seq': entry['seq']})
+
+    def settled(self, settled: Dict[str, Any]) -> None:
+        """反映結果（seq, kind, user_id, attendance_id, status）を手元の状態に反映する
+
+        同じジャーナルファイルを使う別のワーカーが反映したエントリーについても呼ぶ。
+        """
+        user_id, attendance_id = settled['user_id'], settled.get('attendance_id')
+        if self._pending_at.pop(settled['seq'], None) is not None:
+            self._counts[JOURNAL_PENDING] -= 1
+        if settled.get('status'):
+            self._counts[settled['status']] = self._counts.get(settled['status'], 0) + 1
+        if settled['kind'] == KIND_CLOCK_IN and attendance_id is not None:
+            provisional = self.provisional_id(settled['seq'])
+            self._resolved[provisional] = attendance_id
+            if len(self._resolved) > 20000:
+                del self._resolved[next(iter(self._resolved))]
+            current = self._overlay.get(user_id)
+            if current is not None and current['id'] == provisional:
+                current['id'] = attendance_id
+        # そのユーザーの最新の未反映エントリーだったなら、以降は DB の状態を正とする
+        if self._latest_seq.get(user_id) == settled['seq']:
+            self._latest_seq.pop(user_id, None)
+            self._overlay.pop(user_id, None)
+
+    async def record_failure(self, entry: Dict[str, Any], error: str, count: bool) -> None:
+        fields: Dict[str, Any] = {'last_error': error[:500]}
+        if count:
+            entry['attempts'] += 1
+            fields['attempts'] = entry['attempts']
+        await asyncio.to_thread(self._update, entry['seq'], fields)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class JournalReplayer:
+    """ジャーナルのエントリーを追記順に `attendance_logs` へ反映するバックグラウンドワーカー
+
+    - 順序を守るため、反映できないエントリーがあればそこで止まり、バックオフ後に再開する
+    - 接続できない等の一時的な失敗は何度でも再試行する。DB がエラーを返した場合は
+      `max_attempts` 回で `failed` にして先に進む（依存する退勤も `failed` になる）
+    - 出勤を反映して本当の ID が決まったら `on_resolved(user_id, 仮の ID, 本当の ID)` を呼ぶ
+    - 退勤を反映したら、記録する前に `submit_clock_out(user_id, 本当の ID, sync)` を呼ぶ（`sync` のある退勤のみ）。
+      例外を投げたら反映を記録せずに再試行するので、外部連携のジョブを積み損ねない（何度呼ばれてもよいこと）
+    - 退勤を反映したら `on_clock_out(user_id, 本当の ID)` を呼ぶ
+    - `leader` を渡すと、それが True を返す間だけ反映する（同じジャーナルを共有するワーカーのうち 1 つだけが反映する）
+    """
+
+    def __init__(
+        self,
+        journal: AttendanceJournal,
+        get_supabase: Callable[[], Any],
+        table: str = 'attendance_logs',
+        on_resolved: Optional[Callable[[Any, int, int], Awaitable[None]]] = None,
+        on_clock_out: Optional[Callable[[Any, int], Awaitable[None]]] = None,
+        submit_clock_out: Optional[Callable[[Any, int, Dict[str, Any]], Awaitable[None]]] = None,
+        leader: Optional[Callable[[], Awaitable[bool]]] = None,
+        poll_interval: float = 5.0,
+        batch_size: int = 100,
+        max_attempts: int = 10,
+        base_delay: float = 0.5,
+        max_delay: float = 30.0,
+    ):
+        self.journal = journal
+        self.get_supabase = get_supabase
+        self.table = table
+        self.on_resolved = on_resolved
+        self.on_clock_out = on_clock_out
+        self.submit_clock_out = submit_clock_out
+        self.leader = leader
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._failures = 0
+        self._retry_at = 0.0
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 5.0) -> None:
+        """ワーカーを止める。反映中のエントリーは `timeout` 秒まで待つ（残りは次回の起動時に反映する）"""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        done, _ = await asyncio.wait({self._task}, timeout=timeout)
+        if not done:
+            self._task.cancel()
+            await asyncio.wait({self._task})
+        self._task = None
+
+    def notify(self) -> None:
+        """新しいエントリーを追記したことをワーカーに知らせる"""
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("attendance journal replay error")
+            if self._stopping:
+                break
+            timeout = self.poll_interval
+            if self._retry_at:
+                timeout = max(0.0, self._retry_at - time.monotonic())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def run_once(self) -> int:
+        """未反映のエントリーを順に反映する。反映（または確定）したエントリー数を返す"""
+        supabase = self.get_supabase()
+        if supabase is None or time.monotonic() < self._retry_at:
+            return 0
+        # 同じジャーナルを複数のワーカーが使う場合は、リースを持つ 1 つだけが反映する
+        if self.leader is not None and not await self.leader():
+            return 0
+        settled = 0
+        while not self._stopping:
+            entries = await self.journal.pending(self.batch_size)
+            if not entries:
+                break
+            for entry in entries:
+                if not await self._apply(supabase, entry):
+                    # 失敗したエントリーより後ろは順序を守るため反映しない
+                    self._failures += 1
+                    self._retry_at = time.monotonic() + min(self.max_delay, self.base_delay * (2 ** (self._failures - 1)))
+                    return settled
+                self._failures = 0
+                self._retry_at = 0.0
+                settled += 1
+        return settled
+
+    async def _apply(self, supabase: Any, entry: Dict[str, Any]) -> bool:
+        started = time.perf_counter()
+        try:
+            if entry['kind'] == KIND_CLOCK_IN:
+                status = await self._apply_clock_in(supabase, entry)
+            else:
+                status = await self._apply_clock_out(supabase, entry)
+        except Exception as e:
+            transient = isinstance(e, _TRANSIENT_ERRORS)
+            await self.journal.record_failure(entry, repr(e), count=not transient)
+            if not transient and entry['attempts'] >= self.max_attempts:
+                await self.journal.settle(entry, JOURNAL_FAILED, error=repr(e)[:500])
+                logger.error("attendance journal entry failed", extra={
+                    'seq': entry['seq'], 'kind': entry['kind'], 'attempts': entry['attempts'], 'error': repr(e),
+                })
+                return True
+            logger.warning("attendance journal replay failed", extra={
+                'seq': entry['seq'], 'kind': entry['kind'], 'transient': transient, 'error': repr(e),
+            })
+            return False
+        JOURNAL_REPLAY_SECONDS.observe(time.perf_counter() - started, kind=entry['kind'], status=status)
+        return True
+
+    async def _apply_clock_in(self, supabase: Any, entry: Dict[str, Any]) -> str:
+        payload = entry['payload']
+        user_id = entry['user_id']
+        # 同じユーザーの未退勤の行があれば、前回の反映（応答前に落ちた）か別の端末の出勤
+        res = await supabase.table(self.table)\
+            .select('id,user_id,clock_in_at')\
+            .eq('user_id', user_id)\
+            .is_('clock_out_at', 'null')\
+            .order('id', desc=True)\
+            .limit(1)\
+            .execute()
+        existing = res.data[0] if res.data else None
+        if existing is not None and _same_instant(existing.get('clock_in_at'), payload.get('clock_in_at')):
+            status, attendance_id, error = JOURNAL_APPLIED, existing['id'], None
+        elif existing is not None:
+            # 既に出勤中。DB 側の出勤を正とし、以降の退勤はその行に反映する
+            status, attendance_id = JOURNAL_CONFLICT, existing['id']
+            error = f"user already had open attendance {existing['id']} since {existing.get('clock_in_at')}"
+        else:
+            res = await supabase.table(self.table).insert(payload).execute()
+            status, attendance_id, error = JOURNAL_APPLIED, res.data[0]['id'], None
+
+        await self.journal.settle(entry, status, attendance_id=attendance_id, error=error)
+        if error:
+            logger.warning("attendance journal conflict", extra={'seq': entry['seq'], 'kind': entry['kind'], 'error': error})
+        if self.on_resolved is not None:
+            try:
+                await self.on_resolved(user_id, self.journal.provisional_id(entry['seq']), attendance_id)
+            except Exception:
+                # 付け替えに失敗しても反映自体は済んでいる（台帳は次の読み直しで揃う）
+                logger.exception("attendance journal on_resolved failed", extra={'seq': entry['seq']})
+        return status
+
+    async def _apply_clock_out(self, supabase: Any, entry: Dict[str, Any]) -> str:
+        attendance_id = entry['attendance_id']
+        if attendance_id is None and entry['clock_in_seq'] is not None:
+            clock_in = await self.journal.get(entry['clock_in_seq'])
+            attendance_id = clock_in.get('attendance_id') if clock_in else None
+        if attendance_id is None:
+            error = f"clock-in entry {entry['clock_in_seq']} was not applied"
+            await self.journal.settle(entry, JOURNAL_FAILED, error=error)
+            logger.error("attendance journal entry failed", extra={'seq': entry['seq'], 'kind': entry['kind'], 'error': error})
+            return JOURNAL_FAILED
+
+        payload = entry['payload']
+        res = await supabase.table(self.table)\
+            .update(payload)\
+            .eq('id', attendance_id)\
+            .is_('clock_out_at', 'null')\
+            .execute()
+        if res.data:
+            await self._submit(entry, attendance_id)
+            await self.journal.settle(entry, JOURNAL_APPLIED, attendance_id=attendance_id)
+            await self._clocked_out(entry, attendance_id)
+            return JOURNAL_APPLIED
+
+        res = await supabase.table(self.table).select('id,clock_out_at').eq('id', attendance_id).execute()
+        row = res.data[0] if res.data else None
+        if row is not None and _same_instant(row.get('clock_out_at'), payload.get('clock_out_at')):
+            # 前回の反映が DB には届いていた
+            await self._submit(entry, attendance_id)
+            await self.journal.settle(entry, JOURNAL_APPLIED, attendance_id=attendance_id)
+            await self._clocked_out(entry, attendance_id)
+            return JOURNAL_APPLIED
+        if row is None:
+            error = f"attendance {attendance_id} no longer exists"
+        else:
+            error = f"attendance {attendance_id} was already clocked out at {row.get('clock_out_at')}"
+        await self.journal.settle(entry, JOURNAL_CONFLICT, attendance_id=attendance_id, error=error)
+        logger.warning("attendance journal conflict", extra={'seq': entry['seq'], 'kind': entry['kind'], 'error': error})
+        return JOURNAL_CONFLICT
+
+    async def _submit(self, entry: Dict[str, Any], attendance_id: Any) -> None:
+        # ここで失敗したら反映を記録せずに再試行する（DB への更新は済んでいるので、次回は上の確認で拾う）
+        if self.submit_clock_out is not None and entry.get('sync') is not None:
+            await self.submit_clock_out(entry['user_id'], attendance_id, entry['sync'])
+
+    async def _clocked_out(self, entry: Dict[str, Any], attendance_id: Any) -> None:
+        if self.on_clock_out is None:
+            return
+        try:
+            await self.on_clock_out(entry['user_id'], attendance_id)
+        except Exception:
+            # 集計の更新に失敗しても反映自体は済んでいる（集計はバックフィルで直せる）
+            logger.exception("attendance journal on_clock_out failed", extra={'seq': entry['seq']})
@@ -0,0 +1,420 @@
+"""
+Stapro への勤怠登録（create_attendance）のアウトボックス
+
+出勤・退勤処理は `attendance_logs` の書き込みと同じ流れでジョブを積むだけにして、
+Stapro への送信はバックグラウンドのワーカーがリトライ・バックオフ付きで行う。
+キオスクの応答時間は Stapro の応答時間に左右されなくなり、失敗したジョブも失われない。
+
+保存先は 2 種類:
+    - SqliteOutbox:   ローカルの SQLite ファイル（既定。テストや単体運用向け）
+    - SupabaseOutbox: Supabase の `attendance_sync_queue` テーブル
+
+`attendance_sync_queue` テーブルの列:
+    id (bigint, PK), attendance_id (bigint), kind (text), payload (jsonb),
+    status (text), result (text), attempts (int), next_attempt_at (double precision),
+    last_error (text), created_at (timestamptz), updated_at (timestamptz)
+
+使用方法:
+    from attendance_outbox import SqliteOutbox, OutboxWorker
+
+    outbox = SqliteOutbox("attendance_outbox.db")
+    worker = OutboxWorker(outbox, get_client=lambda: client)
+    worker.start()
+
+    job = await outbox.enqueue(attendance_id=1, kind="clock_out", payload={...})
+    worker.notify()
+"""
+
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+# ジョブの状態
+STATUS_PENDING = 'pending'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+# 送信結果
+RESULT_CREATED = 'created'
+RESULT_ALREADY_EXISTS = 'already_exists'
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class SqliteOutbox:
+    """SQLite ファイルに保存するアウトボックス"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS attendance_sync_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                attendance_id INTEGER,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                result TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                last_error TEXT,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS attendance_sync_queue_due '
+            'ON attendance_sync_queue (status, next_attempt_at)'
+        )
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS attendance_sync_queue_attendance '
+            'ON attendance_sync_queue (attendance_id)'
+        )
+
+    @staticmethod
+    def _to_job(row: Optional[sqlite3.Row]) -> Optional[Dict[str, Any]]:
+        if row is None:
+            return None
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
+        return job
+
+    def _execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._conn.execute(sql, params)
+
+    def _enqueue(self, attendance_id: Any, kind: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        now = _now_iso()
+        with self._lock:
+            cur = self._conn.execute(
+                'INSERT INTO attendance_sync_queue '
+                '(attendance_id, kind, payload, status, attempts, next_attempt_at, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, 0, ?, ?, ?)',
+                (attendance_id, kind, json.dumps(payload, ensure_ascii=False), STATUS_PENDING, time.time(), now, now),
+            )
+            row = self._conn.execute('SELECT * FROM attendance_sync_queue WHERE id = ?', (cur.lastrowid,)).fetchone()
+        return self._to_job(row)
+
+    def _due(self, limit: int) -> List[Dict[str, Any]]:
+        rows = self._execute(
+            'SELECT * FROM attendance_sync_queue WHERE status = ? AND next_attempt_at <= ? ORDER BY id LIMIT ?',
+            (STATUS_PENDING, time.time(), limit),
+        ).fetchall()
+        return [self._to_job(r) for r in rows]
+
+    def _claim(self, job: Dict[str, Any], lease: float) -> bool:
+        cur = self._execute(
+            'UPDATE attendance_sync_queue SET attempts = attempts + 1, next_attempt_at = ?, updated_at = ? '
+            'WHERE id = ? AND status = ? AND attempts = ?',
+            (time.time() + lease, _now_iso(), job['id'], STATUS_PENDING, job['attempts']),
+        )
+        return cur.rowcount == 1
+
+    def _update(self, job_id: Any, fields: Dict[str, Any]) -> None:
+        fields = dict(fields, updated_at=_now_iso())
+        columns = ', '.join(f'{k} = ?' for k in fields)
+        self._execute(f'UPDATE attendance_sync_queue SET {columns} WHERE id = ?', (*fields.values(), job_id))
+
+    def _get(self, job_id: Any) -> Optional[Dict[str, Any]]:
+        row = self._execute('SELECT * FROM attendance_sync_queue WHERE id = ?', (job_id,)).fetchone()
+        return self._to_job(row)
+
+    def _for_attendance(self, attendance_id: Any) -> List[Dict[str, Any]]:
+        rows = self._execute(
+            'SELECT * FROM attendance_sync_queue WHERE attendance_id = ? ORDER BY id',
+            (attendance_id,),
+        ).fetchall()
+        return [self._to_job(r) for r in rows]
+
+    def _reassign(self, old_id: Any, new_id: Any) -> int:
+        cur = self._execute(
+            'UPDATE attendance_sync_queue SET attendance_id = ?, updated_at = ? WHERE attendance_id = ?',
+            (new_id, _now_iso(), old_id),
+        )
+        return cur.rowcount
+
+    def _for_attendances(self, attendance_ids: List[Any]) -> Dict[Any, List[Dict[str, Any]]]:
+        jobs: Dict[Any, List[Dict[str, Any]]] = {}
+        # SQLite のプレースホルダ上限を超えないよう分割して問い合わせる
+        for i in range(0, len(attendance_ids), 500):
+            chunk = attendance_ids[i:i + 500]
+            placeholders = ', '.join('?' for _ in chunk)
+            rows = self._execute(
+                f'SELECT * FROM attendance_sync_queue WHERE attendance_id IN ({placeholders}) ORDER BY id',
+                tuple(chunk),
+            ).fetchall()
+            for row in rows:
+                job = self._to_job(row)
+                jobs.setdefault(job['attendance_id'], []).append(job)
+        return jobs
+
+    # SQLite の書き込み（fsync）でイベントループを止めないよう、スレッドで実行する
+
+    async def enqueue(self, attendance_id: Any, kind: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        return await asyncio.to_thread(self._enqueue, attendance_id, kind, payload)
+
+    async def due(self, limit: int = 50) -> List[Dict[str, Any]]:
+        return await asyncio.to_thread(self._due, limit)
+
+    async def claim(self, job: Dict[str, Any], lease: float) -> bool:
+        return await asyncio.to_thread(self._claim, job, lease)
+
+    async def update(self, job_id: Any, **fields: Any) -> None:
+        await asyncio.to_thread(self._update, job_id, fields)
+
+    async def get(self, job_id: Any) -> Optional[Dict[str, Any]]:
+        return await asyncio.to_thread(self._get, job_id)
+
+    async def for_attendance(self, attendance_id: Any) -> List[Dict[str, Any]]:
+        return await asyncio.to_thread(self._for_attendance, attendance_id)
+
+    async def for_attendances(self, attendance_ids: List[Any]) -> Dict[Any, List[Dict[str, Any]]]:
+        return await asyncio.to_thread(self._for_attendances, list(attendance_ids))
+
+    async def reassign(self, old_id: Any, new_id: Any) -> int:
+        """仮の勤怠 ID で積んだジョブを、DB に反映された ID に付け替える"""
+        return await asyncio.to_thread(self._reassign, old_id, new_id)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class SupabaseOutbox:
+    """Supabase の `attendance_sync_queue` テーブルに保存するアウトボックス"""
+
+    def __init__(self, supabase: Any, table: str = 'attendance_sync_queue'):
+        self.supabase = supabase
+        self.table = table
+
+    async def enqueue(self, attendance_id: Any, kind: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        now = _now_iso()
+        res = await self.supabase.table(self.table).insert({
+            'attendance_id': attendance_id,
+            'kind': kind,
+            'payload': payload,
+            'status': STATUS_PENDING,
+            'attempts': 0,
+            'next_attempt_at': time.time(),
+            'created_at': now,
+            'updated_at': now,
+        }).execute()
+        return res.data[0]
+
+    async def due(self, limit: int = 50) -> List[Dict[str, Any]]:
+        res = await self.supabase.table(self.table)\
+            .select('*')\
+            .eq('status', STATUS_PENDING)\
+            .lte('next_attempt_at', time.time())\
+            .order('id')\
+            .limit(limit)\
+            .execute()
+        return res.data or []
+
+    async def claim(self, job: Dict[str, Any], lease: float) -> bool:
+        # attempts を条件にした更新で、他のワーカーと同じジョブを取り合わないようにする
+        res = await self.supabase.table(self.table)\
+            .update({
+                'attempts': job['attempts'] + 1,
+                'next_attempt_at': time.time() + lease,
+                'updated_at': _now_iso(),
+            })\
+            .eq('id', job['id'])\
+            .eq('status', STATUS_PENDING)\
+            .eq('attempts', job['attempts'])\
+            .execute()
+        return bool(res.data)
+
+    async def update(self, job_id: Any, **fields: Any) -> None:
+        fields['updated_at'] = _now_iso()
+        await self.supabase.table(self.table).update(fields).eq('id', job_id).execute()
+
+    async def get(self, job_id: Any) -> Optional[Dict[str, Any]]:
+        res = await self.supabase.table(self.table).select('*').eq('id', job_id).execute()
+        return res.data[0] if res.data else None
+
+    async def for_attendance(self, attendance_id: Any) -> List[Dict[str, Any]]:
+        res = await self.supabase.table(self.table)\
+            .select('*')\
+            .eq('attendance_id', attendance_id)\
+            .order('id')\
+            .execute()
+        return res.data or []
+
+    async def for_attendances(self, attendance_ids: List[Any]) -> Dict[Any, List[Dict[str, Any]]]:
+        jobs: Dict[Any, List[Dict[str, Any]]] = {}
+        attendance_ids = list(attendance_ids)
+        for i in range(0, len(attendance_ids), 500):
+            res = await self.supabase.table(self.table)\
+                .select('*')\
+                .in_('attendance_id', attendance_ids[i:i + 500])\
+                .order('id')\
+                .execute()
+            for job in res.data or []:
+                jobs.setdefault(job['attendance_id'], []).append(job)
+        return jobs
+
+    async def reassign(self, old_id: Any, new_id: Any) -> int:
+        """仮の勤怠 ID で積んだジョブを、DB に反映された ID に付け替える"""
+        res = await self.supabase.table(self.table)\
+            .update({'attendance_id': new_id, 'updated_at': _now_iso()})\
+            .eq('attendance_id', old_id)\
+            .execute()
+        return len(res.data or [])
+
+    def close(self) -> None:
+        pass
+
+
+class OutboxWorker:
+    """アウトボックスのジョブを Stapro に送信するバックグラウンドワーカー
+
+    - 422 は「同じ勤務日の勤怠が登録済み」とみなして完了扱いにする
+    - それ以外の失敗は指数バックオフで再試行し、`max_attempts` 回で `failed` にする
+    - 送信中に落ちた場合も `lease` 秒後に再び取り出される
+    - 取り出したジョブは `create_attendances_bulk` で同時実行数を制限して並列に送る
+    """
+
+    def __init__(
+        self,
+        outbox: Any,
+        get_client: Callable[[], Any],
+        poll_interval: float = 5.0,
+        batch_size: int = 50,
+        max_concurrency: int = 8,
+        max_attempts: int = 8,
+        base_delay: float = 2.0,
+        max_delay: float = 300.0,
+        lease: float = 60.0,
+    ):
+        self.outbox = outbox
+        self.get_client = get_client
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lease = lease
+
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 5.0) -> None:
+        """ワーカーを止める。送信中のジョブは `timeout` 秒まで待ち、それでも終わらなければ打ち切る"""
+        if self._task is None:
+            return
+        # 待機中の wait_for をキャンセルで止めると、起床と重なったときにキャンセルが失われて
+        # 止まらなくなることがあるため、まずはフラグと起床で自発的に抜けさせる
+        self._stopping = True
+        self._wakeup.set()
+        done, _ = await asyncio.wait({self._task}, timeout=timeout)
+        if not done:
+            self._task.cancel()
+            await asyncio.wait({self._task})
+        self._task = None
+
+    def notify(self) -> None:
+        """新しいジョブを積んだことをワーカーに知らせる"""
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("attendance outbox worker error")
+            if self._stopping:
+                break
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def run_once(self) -> int:
+        """送信期限が来たジョブを 1 回分処理する。処理したジョブ数を返す"""
+        client = self.get_client()
+        if client is None:
+            return 0
+        claimed = [job for job in await self.outbox.due(self.batch_size) if await self.outbox.claim(job, self.lease)]
+        await self._submit(client, claimed, self.max_concurrency)
+        return len(claimed)
+
+    async def flush(self, jobs: List[Dict[str, Any]], max_concurrency: Optional[int] = None) -> List[Dict[str, Any]]:
+        """指定したジョブを送信期限に関係なく今すぐ送信する
+
+        Returns:
+            `jobs` と同じ順序の結果の配列。他のワーカーが送信中のジョブは `in_flight` になる
+        """
+        client = self.get_client()
+        if client is None:
+            raise RuntimeError('Stapro client is not configured')
+        claimed = []
+        results: List[Dict[str, Any]] = []
+        for job in jobs:
+            if await self.outbox.claim(job, self.lease):
+                claimed.append(job)
+                results.append({})
+            else:
+                results.append({'status': 'in_flight', 'http_status': None, 'data': None, 'error': None})
+        submitted = iter(await self._submit(client, claimed, max_concurrency or self.max_concurrency))
+        return [result or next(submitted) for result in results]
+
+    def _backoff(self, attempts: int) -> float:
+        return min(self.max_delay, self.base_delay * (2 ** (attempts - 1)))
+
+    async def _submit(self, client: Any, jobs: List[Dict[str, Any]], max_concurrency: int) -> List[Dict[str, Any]]:
+        if not jobs:
+            return []
+        results = await client.create_attendances_bulk([job['payload'] for job in jobs], max_concurrency=max_concurrency)
+        for job, result in zip(jobs, results):
+            await self._record(job, job['attempts'] + 1, result)
+        return results
+
+    async def _record(self, job: Dict[str, Any], attempts: int, result: Dict[str, Any]) -> None:
+        if result['status'] == RESULT_CREATED:
+            await self.outbox.update(job['id'], status=STATUS_DONE, result=RESULT_CREATED, last_error=None)
+        elif result['status'] == RESULT_ALREADY_EXISTS:
+            # 既存の扱いと同じく、422 は同じ勤務日の勤怠が登録済みとみなす
+            await self.outbox.update(job['id'], status=STATUS_DONE, result=RESULT_ALREADY_EXISTS, last_error=None)
+        else:
+            error = result.get('error') or 'unknown error'
+            if result.get('http_status'):
+                error = f"HTTP {result['http_status']}: {error}"
+            await self._retry(job, attempts, error[:500])
+
+    async def _retry(self, job: Dict[str, Any], attempts: int, error: str) -> None:
+        if attempts >= self.max_attempts:
+            await self.outbox.update(job['id'], status=STATUS_FAILED, last_error=error)
+            logger.error("stapro create_attendance gave up", extra={'job_id': job['id'], 'attempts': attempts, 'error': error})
+            return
+        await self.outbox.update(
+            job['id'],
+            next_attempt_at=time.time() + self._backoff(attempts),
+            last_error=error,
+        )
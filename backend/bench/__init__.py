@@ -0,0 +1,5 @@
+"""
+オフラインベンチマーク（Supabase 代替・Stapro スタブ・負荷生成）
+
+実行方法は `bench/run.py` を参照。
+"""
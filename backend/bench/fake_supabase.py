@@ -0,0 +1,223 @@
+"""
+Supabase（AsyncClient）のインメモリ代替
+
+ベンチマーク用に、このバックエンドが使うテーブル API
+（select / eq / gte / gt / lt / lte / in_ / is_ / not_ / order / limit / insert / upsert / update / delete）
+だけを辞書のリストで再現する。`latency` を指定すると 1 クエリごとに往復時間ぶん待つ。
+
+使用方法:
+    from bench.fake_supabase import FakeSupabase
+
+    db = FakeSupabase(latency=0.005)
+    db.seed('users', [{'id': 1, 'card_id': 'CARD0001', 'name': '山田 太郎'}])
+    res = await db.table('users').select('*').eq('card_id', 'CARD0001').execute()
+"""
+
+import asyncio
+import copy
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+
+class FakeResponse:
+    """`execute()` の戻り値（`data` だけを持つ）"""
+
+    __slots__ = ('data',)
+
+    def __init__(self, data: List[Dict[str, Any]]):
+        self.data = data
+
+
+class FakeQuery:
+    """1 回分のクエリ（メソッドチェーンで条件を積む）"""
+
+    def __init__(self, db: 'FakeSupabase', table: str):
+        self.db = db
+        self.table_name = table
+        self.op = 'select'
+        self.columns: Optional[List[str]] = None
+        self.payload: Any = None
+        self.on_conflict = 'id'
+        self.filters: List[Callable[[Dict[str, Any]], bool]] = []
+        self.order_by: List[tuple] = []
+        self.max_rows: Optional[int] = None
+        self._negate = False
+
+    # --- 操作 ---
+
+    def select(self, columns: str = '*', **kwargs) -> 'FakeQuery':
+        self.op = 'select'
+        if columns.strip() != '*':
+            self.columns = [c.strip() for c in columns.split(',') if c.strip()]
+        return self
+
+    def insert(self, payload: Any, **kwargs) -> 'FakeQuery':
+        self.op = 'insert'
+        self.payload = payload
+        return self
+
+    def upsert(self, payload: Any, on_conflict: str = 'id', **kwargs) -> 'FakeQuery':
+        self.op = 'upsert'
+        self.payload = payload
+        self.on_conflict = on_conflict
+        return self
+
+    def update(self, payload: Dict[str, Any], **kwargs) -> 'FakeQuery':
+        self.op = 'update'
+        self.payload = payload
+        return self
+
+    def delete(self, **kwargs) -> 'FakeQuery':
+        self.op = 'delete'
+        return self
+
+    # --- 条件 ---
+
+    def _filter(self, predicate: Callable[[Dict[str, Any]], bool]) -> 'FakeQuery':
+        if self._negate:
+            self._negate = False
+            self.filters.append(lambda row: not predicate(row))
+        else:
+            self.filters.append(predicate)
+        return self
+
+    @property
+    def not_(self) -> 'FakeQuery':
+        self._negate = True
+        return self
+
+    def eq(self, column: str, value: Any) -> 'FakeQuery':
+        return self._filter(lambda row: _comparable(row.get(column)) == _comparable(value))
+
+    def neq(self, column: str, value: Any) -> 'FakeQuery':
+        return self._filter(lambda row: _comparable(row.get(column)) != _comparable(value))
+
+    def gt(self, column: str, value: Any) -> 'FakeQuery':
+        return self._filter(lambda row: row.get(column) is not None and _comparable(row[column]) > _comparable(value))
+
+    def gte(self, column: str, value: Any) -> 'FakeQuery':
+        return self._filter(lambda row: row.get(column) is not None and _comparable(row[column]) >= _comparable(value))
+
+    def lt(self, column: str, value: Any) -> 'FakeQuery':
+        return self._filter(lambda row: row.get(column) is not None and _comparable(row[column]) < _comparable(value))
+
+    def lte(self, column: str, value: Any) -> 'FakeQuery':
+        return self._filter(lambda row: row.get(column) is not None and _comparable(row[column]) <= _comparable(value))
+
+    def in_(self, column: str, values: List[Any]) -> 'FakeQuery':
+        wanted = {_comparable(v) for v in values}
+        return self._filter(lambda row: _comparable(row.get(column)) in wanted)
+
+    def is_(self, column: str, value: Any) -> 'FakeQuery':
+        if value in (None, 'null'):
+            return self._filter(lambda row: row.get(column) is None)
+        return self._filter(lambda row: row.get(column) is value)
+
+    def order(self, column: str, desc: bool = False, **kwargs) -> 'FakeQuery':
+        self.order_by.append((column, desc))
+        return self
+
+    def limit(self, size: int, **kwargs) -> 'FakeQuery':
+        self.max_rows = size
+        return self
+
+    # --- 実行 ---
+
+    async def execute(self) -> FakeResponse:
+        if self.db.latency:
+            await asyncio.sleep(self.db.latency)
+        self.db.queries += 1
+        return FakeResponse(copy.deepcopy(self._run()))
+
+    def _matches(self, row: Dict[str, Any]) -> bool:
+        return all(predicate(row) for predicate in self.filters)
+
+    def _run(self) -> List[Dict[str, Any]]:
+        rows = self.db.tables.setdefault(self.table_name, [])
+        if self.op in ('insert', 'upsert'):
+            return self._write(rows)
+        matched = [row for row in rows if self._matches(row)]
+        if self.op == 'update':
+            now = _now()
+            for row in matched:
+                row.update(self.payload)
+                if 'updated_at' in row:
+                    row['updated_at'] = now
+            return matched
+        if self.op == 'delete':
+            self.db.tables[self.table_name] = [row for row in rows if not self._matches(row)]
+            return matched
+        for column, desc in reversed(self.order_by):
+            matched.sort(key=lambda row: (row.get(column) is None, _comparable(row.get(column))), reverse=desc)
+        if self.max_rows is not None:
+            matched = matched[:self.max_rows]
+        if self.columns is not None:
+            matched = [{c: row.get(c) for c in self.columns} for row in matched]
+        return matched
+
+    def _write(self, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        payloads = self.payload if isinstance(self.payload, list) else [self.payload]
+        unique = self.db.unique.get(self.table_name, ())
+        written = []
+        for payload in payloads:
+            if self.op == 'upsert':
+                # on_conflict は複合キー（"user_id,month" など）のこともある
+                columns = [c.strip() for c in self.on_conflict.split(',')]
+                key = tuple(payload.get(c) for c in columns)
+                existing = None if None in key else next(
+                    (r for r in rows if tuple(r.get(c) for c in columns) == key), None)
+                if existing is not None:
+                    existing.update(payload)
+                    written.append(existing)
+                    continue
+            for column in unique:
+                value = payload.get(column)
+                if value is not None and any(r.get(column) == value for r in rows):
+                    raise Exception(
+                        f'duplicate key value violates unique constraint "{self.table_name}_{column}_key"'
+                    )
+            row = dict(payload)
+            if row.get('id') is None:
+                row['id'] = self.db.next_id(self.table_name)
+            row.setdefault('created_at', _now())
+            rows.append(row)
+            written.append(row)
+        return written
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _comparable(value: Any) -> Any:
+    # 数値と数値文字列（PostgREST のクエリ文字列）を同じものとして比べる
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            return value
+    return value
+
+
+class FakeSupabase:
+    """`AsyncClient.table()` だけを持つインメモリの Supabase"""
+
+    def __init__(self, latency: float = 0.0, unique: Optional[Dict[str, tuple]] = None):
+        self.latency = latency
+        self.unique = unique if unique is not None else {'users': ('card_id',)}
+        self.tables: Dict[str, List[Dict[str, Any]]] = {}
+        self.queries = 0
+        self._ids: Dict[str, int] = {}
+
+    def next_id(self, table: str) -> int:
+        current = self._ids.get(table)
+        if current is None:
+            current = max((row.get('id') or 0 for row in self.tables.get(table, [])), default=0)
+        self._ids[table] = current + 1
+        return current + 1
+
+    def seed(self, table: str, rows: List[Dict[str, Any]]) -> None:
+        self.tables.setdefault(table, []).extend(copy.deepcopy(rows))
+
+    def table(self, name: str) -> FakeQuery:
+        return FakeQuery(self, name)
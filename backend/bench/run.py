@@ -0,0 +1,221 @@
+"""
+オフライン負荷ベンチマーク
+
+インメモリの Supabase 代替とローカルの Stapro スタブを使い、`main.app` に
+キオスクの打刻シーケンス（スキャン → 出勤 → スキャン → 退勤）を並列に流して、
+エンドポイントごとのスループットと p50 / p95 / p99 を表示する。実際の Supabase や Stapro には接続しない。
+
+使用方法（backend ディレクトリで実行）:
+    python -m bench.run --users 200 --kiosks 16 --stapro-latency 0.05
+    python -m bench.run --flow tap --error-rate 0.02 --output ../bench_output.txt
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from bench.fake_supabase import FakeSupabase
+from bench.stub_stapro import StubStapro
+
+
+class Recorder:
+    """エンドポイントごとの応答時間とエラー数"""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.statuses: Dict[str, Dict[int, int]] = {}
+
+    async def call(self, client: httpx.AsyncClient, name: str, path: str, body: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        started = time.perf_counter()
+        try:
+            response = await client.post(path, json=body)
+            status = response.status_code
+        except Exception:
+            response, status = None, 0
+        self.latencies.setdefault(name, []).append(time.perf_counter() - started)
+        by_status = self.statuses.setdefault(name, {})
+        by_status[status] = by_status.get(status, 0) + 1
+        if response is None or status >= 400:
+            self.errors[name] = self.errors.get(name, 0) + 1
+            return None
+        return response.json()
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """最近接順位法のパーセンタイル（sorted_values は昇順）"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(p / 100.0 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def build_users(count: int) -> List[Dict[str, Any]]:
+    return [
+        {
+            'id': i,
+            'card_id': f'BENCH{i:05d}',
+            'name': f'ベンチ {i}',
+            'email': f'bench{i}@example.com',
+            'stapro_staff_id': 10000 + i,
+            'default_transport_cost': 300 + (i % 5) * 100,
+            'transport_presets': [],
+            'created_at': '2024-04-01T00:00:00+00:00',
+        }
+        for i in range(1, count + 1)
+    ]
+
+
+async def scan_flow(client: httpx.AsyncClient, rec: Recorder, card_id: str) -> None:
+    """スキャン → 出勤 → スキャン → 退勤"""
+    await rec.call(client, 'scan', '/api/scan', {'card_id': card_id})
+    await rec.call(client, 'clock-in', '/api/clock-in', {'card_id': card_id})
+    scanned = await rec.call(client, 'scan', '/api/scan', {'card_id': card_id}) or {}
+    await rec.call(client, 'clock-out', '/api/clock-out', {
+        'card_id': card_id,
+        'transport_cost': scanned.get('default_cost') or 0,
+        'class_count': scanned.get('estimated_class_count') or 0,
+    })
+
+
+async def tap_flow(client: httpx.AsyncClient, rec: Recorder, card_id: str) -> None:
+    """タップ（出勤） → タップ（退勤待ち） → 確認付きタップ（退勤）"""
+    await rec.call(client, 'tap:in', '/api/tap', {'card_id': card_id})
+    ready = await rec.call(client, 'tap:ready', '/api/tap', {'card_id': card_id}) or {}
+    await rec.call(client, 'tap:out', '/api/tap', {
+        'state_token': ready.get('state_token'),
+        'card_id': None if ready.get('state_token') else card_id,
+        'confirm': {
+            'transport_cost': ready.get('default_cost') or 0,
+            'class_count': ready.get('estimated_class_count') or 0,
+        },
+    })
+
+
+async def run_load(app: Any, args: argparse.Namespace, users: List[Dict[str, Any]]) -> tuple:
+    rec = Recorder()
+    cards: asyncio.Queue = asyncio.Queue()
+    for _ in range(args.rounds):
+        for user in users:
+            cards.put_nowait(user['card_id'])
+    flow = tap_flow if args.flow == 'tap' else scan_flow
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=None) as client:
+        async def kiosk() -> None:
+            while True:
+                try:
+                    card_id = cards.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                await flow(client, rec, card_id)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(kiosk() for _ in range(args.kiosks)))
+        elapsed = time.perf_counter() - started
+    return rec, elapsed
+
+
+def report(rec: Recorder, elapsed: float, args: argparse.Namespace, fake: FakeSupabase, stub: StubStapro) -> str:
+    lines = [
+        f"flow={args.flow} users={args.users} rounds={args.rounds} kiosks={args.kiosks} "
+        f"db_latency={args.db_latency * 1000:.1f}ms stapro_latency={args.stapro_latency * 1000:.1f}ms "
+        f"error_rate={args.error_rate} reject_duplicates={not args.allow_duplicates}",
+        '',
+        f"{'endpoint':<12}{'count':>8}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}",
+    ]
+    total = 0
+    for name, values in rec.latencies.items():
+        ordered = sorted(values)
+        total += len(ordered)
+        lines.append(
+            f"{name:<12}{len(ordered):>8}{rec.errors.get(name, 0):>8}{len(ordered) / elapsed:>10.1f}"
+            f"{percentile(ordered, 50) * 1000:>10.2f}{percentile(ordered, 95) * 1000:>10.2f}"
+            f"{percentile(ordered, 99) * 1000:>10.2f}{ordered[-1] * 1000:>10.2f}"
+        )
+    lines += [
+        '',
+        f"total: {total} requests in {elapsed:.2f}s ({total / elapsed:.1f} req/s)",
+        f"supabase queries: {fake.queries}",
+        f"stapro requests: {stub.requests} {dict(sorted(stub.status_counts.items()))}",
+        f"status codes: { {name: dict(sorted(s.items())) for name, s in rec.statuses.items()} }",
+    ]
+    return '\n'.join(lines)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='オフライン負荷ベンチマーク')
+    parser.add_argument('--users', type=int, default=200, help='登録済みユーザー（カード）数')
+    parser.add_argument('--rounds', type=int, default=1, help='ユーザーあたりの打刻シーケンス回数')
+    parser.add_argument('--kiosks', type=int, default=16, help='同時に打刻するキオスク数')
+    parser.add_argument('--flow', choices=['scan', 'tap'], default='scan', help='打刻シーケンス')
+    parser.add_argument('--db-latency', type=float, default=0.002, help='Supabase 1 クエリの往復時間（秒）')
+    parser.add_argument('--stapro-latency', type=float, default=0.03, help='Stapro 1 リクエストの応答時間（秒）')
+    parser.add_argument('--stapro-jitter', type=float, default=0.0, help='Stapro の応答時間の揺らぎ（秒）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Stapro が 500 を返す割合')
+    parser.add_argument('--allow-duplicates', action='store_true', help='同日の重複登録に 422 を返さない')
+    parser.add_argument('--seed', type=int, default=None, help='乱数シード')
+    parser.add_argument('--output', default=None, help='結果を書き出すファイル')
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+
+    stub = StubStapro(
+        latency=args.stapro_latency,
+        jitter=args.stapro_jitter,
+        error_rate=args.error_rate,
+        reject_duplicates=not args.allow_duplicates,
+        seed=args.seed,
+    )
+    fake = FakeSupabase(latency=args.db_latency)
+    users = build_users(args.users)
+    fake.seed('users', users)
+
+    # main は import 時に環境変数を読むので、先にすべて差し替えておく
+    os.environ.update({
+        'SUPABASE_URL': 'http://supabase.bench.invalid',
+        'SUPABASE_KEY': 'bench',
+        'STAPRO_API_URL': stub.start(),
+        'STAPRO_API_TOKEN': 'bench',
+        'ATTENDANCE_OUTBOX': 'sqlite',
+        'ATTENDANCE_OUTBOX_PATH': ':memory:',
+        'ATTENDANCE_JOURNAL_PATH': ':memory:',
+        'SCHOOL_CATALOG_SNAPSHOT': '',
+        # 同じカードの打刻シーケンスを間を置かずに繰り返すので、重複排除の窓で応答が使い回されないようにする
+        'TAP_DEDUPE_WINDOW': '0',
+    })
+    import supabase as supabase_module
+
+    async def fake_acreate_client(*_args, **_kwargs) -> FakeSupabase:
+        return fake
+    supabase_module.acreate_client = fake_acreate_client
+    sys.modules.pop('main', None)
+    import main as backend_main
+
+    async def run() -> tuple:
+        async with backend_main.lifespan(backend_main.app):
+            # 本番と同じく /readyz が通る（索引・台帳の読み込みが終わる）まで待ってから流す
+            await backend_main.readiness.wait()
+            return await run_load(backend_main.app, args, users)
+
+    try:
+        rec, elapsed = asyncio.run(run())
+    finally:
+        stub.stop()
+
+    text = report(rec, elapsed, args, fake, stub)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""
+Stapro API のローカルスタブサーバー
+
+ベンチマーク用に、バックエンドが呼ぶ Stapro API（ログイン・教室・スタッフ・勤怠）を
+スレッドで動く HTTP サーバーで再現する。応答の遅延・エラー率・同じ日の重複登録に対する 422 を設定できる。
+GET の応答には ETag を付け、`If-None-Match` が一致すれば 304 を返す。
+
+使用方法:
+    from bench.stub_stapro import StubStapro
+
+    stub = StubStapro(latency=0.05, error_rate=0.01)
+    base_url = stub.start()
+    ...
+    stub.stop()
+"""
+
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+
+class StubStapro:
+    """Stapro API のスタブ
+
+    Args:
+        latency: 1 リクエストあたりの応答遅延（秒）
+        jitter: 遅延に加える揺らぎの最大値（秒）
+        error_rate: 500 を返す割合（0〜1）
+        reject_duplicates: 同じスタッフ・同じ日の勤怠登録に 422 を返すか
+        lessons_per_day: 教室詳細の timetables に入れる 1 日あたりのコマ数
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        reject_duplicates: bool = True,
+        lessons_per_day: int = 6,
+        seed: Optional[int] = None,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.reject_duplicates = reject_duplicates
+        self.lessons_per_day = lessons_per_day
+        self.random = random.Random(seed)
+
+        self.attendances: Dict[int, Dict[str, Any]] = {}
+        self.requests = 0
+        self.status_counts: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    # ========================================
+    # 起動・停止
+    # ========================================
+
+    def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """サーバーを起動してベース URL を返す"""
+        stub = self
+
+        class Handler(_Handler):
+            pass
+        Handler.stub = stub
+
+        self._server = _Server((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f'http://{host}:{self._server.server_address[1]}'
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    # ========================================
+    # 応答
+    # ========================================
+
+    def _delay(self) -> None:
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _record(self, status: int) -> None:
+        with self._lock:
+            self.requests += 1
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+
+    def timetables(self, school_id: int) -> List[Dict[str, Any]]:
+        """16:00 から 1 時間刻みのコマを全曜日に並べたタイムテーブル"""
+        rows = []
+        for wday in range(7):
+            for n in range(self.lessons_per_day):
+                hour = 16 + n if 16 + n < 24 else 23
+                rows.append({
+                    'id': school_id * 1000 + wday * 100 + n,
+                    'day_of_week': wday,
+                    'start_time': f'2000-01-01T{hour:02d}:00:00.000+09:00',
+                    'end_time': f'2000-01-01T{hour:02d}:50:00.000+09:00',
+                })
+        return rows
+
+    def handle(self, method: str, path: str, body: Dict[str, Any]) -> Tuple[int, Any]:
+        self._delay()
+        if self.error_rate and self.random.random() < self.error_rate:
+            return 500, {'error': 'injected failure'}
+
+        path, _, query = path.partition('?')
+        params = {key: values[-1] for key, values in parse_qs(query).items()}
+        if method == 'POST' and path in ('/api/v1/auth/login', '/auth/login'):
+            email = body.get('email') or ''
+            staff_id = 1 + sum(map(ord, email)) % 100000
+            return 200, {'id': staff_id, 'email': email, 'last_name': 'ベンチ', 'first_name': email.split('@')[0]}
+        if method == 'GET' and path == '/api/v1/schools':
+            return 200, {'schools': [{'id': i, 'name': f'教室{i}'} for i in range(1, 4)]}
+        match = re.fullmatch(r'/api/v1/schools/(\d+)', path)
+        if method == 'GET' and match:
+            school_id = int(match.group(1))
+            return 200, {'id': school_id, 'name': f'教室{school_id}', 'timetables': self.timetables(school_id)}
+        match = re.fullmatch(r'/api/v1/staffs/(\d+)', path)
+        if method == 'GET' and match:
+            return 200, {'id': int(match.group(1)), 'last_name': 'ベンチ', 'first_name': 'スタッフ'}
+        match = re.fullmatch(r'/api/v1/staffs/(\d+)/attendances', path)
+        if method == 'GET' and match:
+            staff_id = int(match.group(1))
+            with self._lock:
+                rows = [a for a in self.attendances.values() if a.get('staff_id') == staff_id]
+            if 'page' not in params:
+                return 200, {'attendances': rows}
+            page, per_page = int(params['page']), int(params.get('per_page') or 100)
+            next_page = page + 1 if page * per_page < len(rows) else None
+            return 200, {'attendances': rows[(page - 1) * per_page:page * per_page], 'meta': {'next_page': next_page}}
+        if method == 'POST' and path == '/api/v1/attendances':
+            with self._lock:
+                if self.reject_duplicates and any(
+                    a.get('staff_id') == body.get('staff_id') and a.get('work_day') == body.get('work_day')
+                    for a in self.attendances.values()
+                ):
+                    return 422, {'errors': ['work_day has already been taken']}
+                attendance_id = len(self.attendances) + 1
+                self.attendances[attendance_id] = dict(body, id=attendance_id)
+            return 201, self.attendances[attendance_id]
+        match = re.fullmatch(r'/api/v1/attendances/(\d+)', path)
+        if match:
+            attendance_id = int(match.group(1))
+            with self._lock:
+                attendance = self.attendances.get(attendance_id)
+                if attendance is not None and method == 'DELETE':
+                    del self.attendances[attendance_id]
+            if attendance is None:
+                return 404, {'error': 'not found'}
+            return 200, attendance
+        return 404, {'error': 'not found'}
+
+
+class _Server(ThreadingHTTPServer):
+    # 既定の listen バックログ（5）だと多数のキオスクが同時に接続したとき SYN の再送で 1 秒待たされる
+    request_queue_size = 128
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # ヘッダーと本文を別々に書くので、Nagle と遅延 ACK で応答が 40ms 待たされないようにする
+    disable_nagle_algorithm = True
+    stub: StubStapro
+
+    def _dispatch(self, method: str) -> None:
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        try:
+            body = json.loads(raw) if raw else {}
+        except ValueError:
+            body = {}
+        status, payload = self.stub.handle(method, self.path, body)
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        etag = None
+        if method == 'GET' and status == 200:
+            etag = '"' + hashlib.md5(data).hexdigest() + '"'
+            if self.headers.get('If-None-Match') == etag:
+                status, data = 304, b''
+        self.stub._record(status)
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            if etag:
+                self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            # 計測終了時にクライアントが接続を閉じた
+            self.close_connection = True
+
+    def do_GET(self) -> None:
+        self._dispatch('GET')
+
+    def do_POST(self) -> None:
+        self._dispatch('POST')
+
+    def do_DELETE(self) -> None:
+        self._dispatch('DELETE')
+
+    def log_message(self, *args) -> None:
+        pass
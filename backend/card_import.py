@@ -0,0 +1,97 @@
+"""
+カード一括登録ファイルの読み込み
+
+CSV（1 行目がヘッダー）または JSONL（1 行 1 オブジェクト）を読み、行番号付きの登録内容に変換する。
+列名は `RegisterCardRequest` と同じ（card_id, stapro_email, stapro_password,
+default_transport_cost, default_school_id, transport_presets）。
+CSV の `transport_presets` は JSON 文字列で書く。
+
+使用方法:
+    from card_import import parse_registrations
+
+    for row in parse_registrations(body, content_type="text/csv"):
+        print(row.line, row.data, row.error)
+"""
+
+import csv
+import io
+import json
+from typing import Any, Dict, List, Optional
+
+
+class ImportRow:
+    """ファイルの 1 行分（登録できない行は error に理由が入る）"""
+
+    __slots__ = ('line', 'data', 'error')
+
+    def __init__(self, line: int, data: Optional[Dict[str, Any]] = None, error: Optional[str] = None):
+        self.line = line
+        self.data = data
+        self.error = error
+
+
+def _clean(raw: Dict[str, Any]) -> Dict[str, Any]:
+    """空欄を取り除き、CSV で文字列になっている JSON 列を戻す"""
+    data: Dict[str, Any] = {}
+    for key, value in raw.items():
+        if key is None:
+            continue
+        key = key.strip()
+        if isinstance(value, str):
+            value = value.strip()
+            if value == '':
+                continue
+            if key == 'transport_presets':
+                value = json.loads(value)
+        if value is not None:
+            data[key] = value
+    return data
+
+
+def _looks_like_csv(body: str, content_type: str) -> bool:
+    if 'csv' in content_type:
+        return True
+    if 'json' in content_type:
+        return False
+    return not body.lstrip().startswith('{')
+
+
+def parse_registrations(body: str, content_type: str = '') -> List[ImportRow]:
+    """CSV / JSONL の本文を行ごとの登録内容に変換する
+
+    同じ card_id が複数行にあるときは、2 行目以降をエラーにする。
+    """
+    rows: List[ImportRow] = []
+    if _looks_like_csv(body, content_type):
+        reader = csv.DictReader(io.StringIO(body))
+        for raw in reader:
+            # ヘッダーが 1 行目なので、データ行の行番号は reader.line_num をそのまま使う
+            try:
+                rows.append(ImportRow(reader.line_num, _clean(raw)))
+            except ValueError as e:
+                rows.append(ImportRow(reader.line_num, error=f"invalid transport_presets: {e}"))
+    else:
+        for line, text in enumerate(body.splitlines(), start=1):
+            if not text.strip():
+                continue
+            try:
+                raw = json.loads(text)
+                if not isinstance(raw, dict):
+                    raise ValueError('each line must be a JSON object')
+                rows.append(ImportRow(line, _clean(raw)))
+            except ValueError as e:
+                rows.append(ImportRow(line, error=f"invalid JSON: {e}"))
+
+    seen: Dict[str, int] = {}
+    for row in rows:
+        if row.data is None:
+            continue
+        card_id = row.data.get('card_id')
+        if card_id is None:
+            continue
+        card_id = str(card_id)
+        if card_id in seen:
+            row.error = f"duplicate card_id (first seen on line {seen[card_id]})"
+        else:
+            seen[card_id] = row.line
+    return rows
@@ -0,0 +1,341 @@
+"""
+カードID → ユーザーのインメモリインデックス
+
+打刻のたびに `users` テーブルへ問い合わせるのをやめ、起動時に全ユーザーを読み込んでおく。
+以降は `updated_at`（無ければ `created_at`）のウォーターマークから差分だけを取り込む。
+問い合わせは `UserRecord` が読む列だけに絞る（テーブルに実在する列は最初に 1 行だけ読んで確かめる）。
+
+使用方法:
+    from card_index import CardIndex
+
+    card_index = CardIndex(supabase)  # supabase は AsyncClient
+    await card_index.load()
+
+    user = await card_index.get("0123456789ABCDEF")
+    if user:
+        print(user.name)
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class UserRecord:
+    """打刻に必要な `users` の列だけを保持するコンパクトなレコード"""
+
+    # `from_row` が読む列（別名を含む）
+    COLUMNS = (
+        'id',
+        'card_id',
+        'name',
+        'email',
+        'default_transport_cost',
+        'transport_presets',
+        'stapro_staff_id',
+        'staff_id',
+        'stapro_school_id',
+        'default_school_id',
+    )
+
+    __slots__ = (
+        'id',
+        'card_id',
+        'name',
+        'email',
+        'default_transport_cost',
+        'transport_presets',
+        'stapro_staff_id',
+        'school_id',
+        'stamp',
+    )
+
+    def __init__(
+        self,
+        id: Any,
+        card_id: Optional[str],
+        name: str,
+        email: Optional[str] = None,
+        default_transport_cost: int = 0,
+        transport_presets: Optional[List[Dict[str, Any]]] = None,
+        stapro_staff_id: Any = None,
+        school_id: Any = None,
+        stamp: Optional[str] = None,
+    ):
+        self.id = id
+        self.card_id = card_id
+        self.name = name
+        self.email = email
+        self.default_transport_cost = default_transport_cost
+        self.transport_presets = transport_presets if transport_presets is not None else []
+        self.stapro_staff_id = stapro_staff_id
+        self.school_id = school_id
+        self.stamp = stamp
+
+    @classmethod
+    def from_row(cls, row: Dict[str, Any], stamp_column: Optional[str] = None) -> 'UserRecord':
+        """Supabase の行（dict）からレコードを作る"""
+        try:
+            cost = int(row.get('default_transport_cost') or 0)
+        except (TypeError, ValueError):
+            cost = 0
+        return cls(
+            id=row.get('id'),
+            card_id=row.get('card_id'),
+            name=row.get('name') or '',
+            email=row.get('email'),
+            default_transport_cost=cost,
+            transport_presets=row.get('transport_presets') or [],
+            stapro_staff_id=row.get('stapro_staff_id') or row.get('staff_id'),
+            school_id=row.get('stapro_school_id') or row.get('default_school_id'),
+            stamp=row.get(stamp_column) if stamp_column else None,
+        )
+
+    def __repr__(self) -> str:
+        return f"UserRecord(id={self.id!r}, card_id={self.card_id!r}, name={self.name!r})"
+
+
+class CardIndex:
+    """`users` テーブルの card_id 索引
+
+    - `load()` で全件を読み込み、ウォーターマーク列を決める
+    - `get()` は索引を引くだけ。未知のカードのみ DB に問い合わせる
+    - `refresh_interval` 秒ごとにウォーターマーク以降の差分をバックグラウンドで取り込む
+    - `full_reload_interval` 秒ごとに全件を読み直す（削除の反映用）
+    - `invalidate()` で登録・更新されたカード／ユーザーを即座に捨てる
+    """
+
+    WATERMARK_COLUMNS = ('updated_at', 'created_at')
+
+    def __init__(
+        self,
+        supabase: Any,
+        table: str = 'users',
+        refresh_interval: float = 30.0,
+        full_reload_interval: float = 600.0,
+        lookup_chunk: int = 200,
+    ):
+        self.supabase = supabase
+        self.table = table
+        self.refresh_interval = refresh_interval
+        self.full_reload_interval = full_reload_interval
+        # `get_many()` で 1 回の問い合わせに入れるユーザーIDの上限（URL が長くなりすぎないように）
+        self.lookup_chunk = lookup_chunk
+
+        self._by_card: Dict[str, UserRecord] = {}
+        self._by_id: Dict[Any, UserRecord] = {}
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._load_task: Optional[asyncio.Task] = None
+        self._stamp_column: Optional[str] = None
+        self._watermark: Optional[str] = None
+        self._columns: Optional[str] = None
+        self._loaded_at = 0.0
+        self._refreshed_at = 0.0
+
+    # ========================================
+    # 読み込み
+    # ========================================
+
+    async def _select_columns(self) -> str:
+        """`select()` に渡す列の一覧。テーブルに無い列を指定するとエラーになるので、実在する列だけにする"""
+        if self._columns is not None:
+            return self._columns
+        res = await self.supabase.table(self.table).select('*').limit(1).execute()
+        if not res.data:
+            # 空のテーブルでは列を確かめられないので、次の読み込みで改めて確かめる
+            return '*'
+        row = res.data[0]
+        wanted = UserRecord.COLUMNS + self.WATERMARK_COLUMNS
+        self._columns = ','.join(col for col in wanted if col in row)
+        return self._columns
+
+    async def load(self) -> int:
+        """全ユーザーを読み込み直す。読み込んだ件数を返す
+
+        読み込み中に呼ばれたら新たに読み込まず、実行中の読み込みの結果を待つ。
+        """
+        task = self._load_task
+        if task is None or task.done():
+            task = self._load_task = asyncio.create_task(self._load())
+            # 待ち手が全員キャンセルされていても「取り出されなかった例外」の警告を出さない
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return await asyncio.shield(task)
+
+    async def _load(self) -> int:
+        columns = await self._select_columns()
+        res = await self.supabase.table(self.table).select(columns).execute()
+        rows = res.data or []
+
+        stamp_column = None
+        if rows:
+            for col in self.WATERMARK_COLUMNS:
+                if col in rows[0]:
+                    stamp_column = col
+                    break
+
+        by_card: Dict[str, UserRecord] = {}
+        by_id: Dict[Any, UserRecord] = {}
+        watermark = None
+        for row in rows:
+            record = UserRecord.from_row(row, stamp_column)
+            by_id[record.id] = record
+            if record.card_id:
+                by_card[record.card_id] = record
+            if record.stamp and (watermark is None or record.stamp > watermark):
+                watermark = record.stamp
+
+        now = time.monotonic()
+        self._by_card = by_card
+        self._by_id = by_id
+        self._stamp_column = stamp_column
+        self._watermark = watermark
+        self._loaded_at = now
+        self._refreshed_at = now
+        return len(by_id)
+
+    async def refresh(self) -> int:
+        """ウォーターマーク以降に作成・更新された行だけを取り込む。取り込んだ件数を返す"""
+        if not self._stamp_column or self._watermark is None:
+            return await self.load()
+
+        res = await self.supabase.table(self.table)\
+            .select(await self._select_columns())\
+            .gte(self._stamp_column, self._watermark)\
+            .order(self._stamp_column)\
+            .execute()
+        rows = res.data or []
+        self._apply(rows)
+        self._refreshed_at = time.monotonic()
+        return len(rows)
+
+    def _apply(self, rows: Iterable[Dict[str, Any]]) -> None:
+        for row in rows:
+            record = UserRecord.from_row(row, self._stamp_column)
+            previous = self._by_id.get(record.id)
+            if previous is not None and previous.card_id and previous.card_id != record.card_id:
+                # カードが付け替えられた場合は古いカードを外す
+                if self._by_card.get(previous.card_id) is previous:
+                    del self._by_card[previous.card_id]
+            self._by_id[record.id] = record
+            if record.card_id:
+                self._by_card[record.card_id] = record
+            if record.stamp and (self._watermark is None or record.stamp > self._watermark):
+                self._watermark = record.stamp
+
+    async def _background_refresh(self, started: float) -> None:
+        try:
+            if started - self._loaded_at >= self.full_reload_interval:
+                await self.load()
+            else:
+                await self.refresh()
+        except Exception as e:
+            # 更新に失敗しても既存の索引で応答を続ける。次回の間隔で再試行する
+            logger.warning("card index refresh failed", extra={'error': repr(e)})
+            self._refreshed_at = started
+
+    def _maybe_refresh(self) -> None:
+        now = time.monotonic()
+        if now - self._refreshed_at < self.refresh_interval:
+            return
+        # 更新は 1 タスクだけがバックグラウンドで行い、打刻は手元のデータで即応答する
+        if self._refresh_task is not None and not self._refresh_task.done():
+            return
+        # 全件の読み込み中（起動直後の `load()` など）は、それが終われば最新になる
+        if self._load_task is not None and not self._load_task.done():
+            return
+        self._refresh_task = asyncio.create_task(self._background_refresh(now))
+
+    # ========================================
+    # 参照・無効化
+    # ========================================
+
+    async def get(self, card_id: str) -> Optional[UserRecord]:
+        """カードIDからユーザーを引く。索引に無いカードのみ DB を確認する"""
+        self._maybe_refresh()
+        record = self._by_card.get(card_id)
+        if record is not None:
+            return record
+
+        columns = await self._select_columns()
+        res = await self.supabase.table(self.table).select(columns).eq('card_id', card_id).execute()
+        if not res.data:
+            return None
+        self._apply(res.data[:1])
+        return self._by_card.get(card_id)
+
+    async def get_by_id(self, user_id: Any) -> Optional[UserRecord]:
+        """ユーザーIDからユーザーを引く。索引に無いユーザーのみ DB を確認する"""
+        record = self._by_id.get(user_id)
+        if record is not None:
+            return record
+
+        columns = await self._select_columns()
+        res = await self.supabase.table(self.table).select(columns).eq('id', user_id).execute()
+        if not res.data:
+            return None
+        self._apply(res.data[:1])
+        return self._by_id.get(user_id)
+
+    async def get_many(self, user_ids: Iterable[Any]) -> Dict[Any, UserRecord]:
+        """複数のユーザーIDをまとめて引く。索引に無いユーザーだけを `lookup_chunk` 件ずつの `in_` で DB に問い合わせる
+
+        Returns:
+            見つかったユーザーだけの {ユーザーID: ユーザー}
+        """
+        found: Dict[Any, UserRecord] = {}
+        missing = []
+        for user_id in dict.fromkeys(user_ids):
+            record = self._by_id.get(user_id)
+            if record is not None:
+                found[user_id] = record
+            elif user_id is not None:
+                missing.append(user_id)
+        if not missing:
+            return found
+
+        columns = await self._select_columns()
+        for start in range(0, len(missing), self.lookup_chunk):
+            res = await self.supabase.table(self.table)\
+                .select(columns)\
+                .in_('id', missing[start:start + self.lookup_chunk])\
+                .execute()
+            self._apply(res.data or [])
+        for user_id in missing:
+            record = self._by_id.get(user_id)
+            if record is not None:
+                found[user_id] = record
+        return found
+
+    def cached(self, user_id: Any) -> Optional[UserRecord]:
+        """索引にあるユーザーだけを引く（DB には問い合わせない）"""
+        return self._by_id.get(user_id)
+
+    @property
+    def loaded(self) -> bool:
+        """`load()` が一度でも済んでいるか"""
+        return self._loaded_at > 0
+
+    def records(self) -> List[UserRecord]:
+        """索引にある全ユーザー（`load()` 前は DB から個別に引いた分だけ）"""
+        return list(self._by_id.values())
+
+    def invalidate(self, card_id: Optional[str] = None, user_id: Any = None) -> None:
+        """カード・ユーザーを索引から外す。次の `get()` で DB から読み直される"""
+        if card_id is not None:
+            record = self._by_card.pop(card_id, None)
+            if record is not None:
+                self._by_id.pop(record.id, None)
+        if user_id is not None:
+            record = self._by_id.pop(user_id, None)
+            if record is not None and record.card_id and self._by_card.get(record.card_id) is record:
+                del self._by_card[record.card_id]
+
+    def __contains__(self, card_id: object) -> bool:
+        """索引だけで引けるカードか（`get()` が DB に問い合わせずに済むか）"""
+        return card_id in self._by_card
+
+    def __len__(self) -> int:
+        return len(self._by_card)
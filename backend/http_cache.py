@@ -0,0 +1,158 @@
+"""
+条件付きリクエスト（ETag / If-None-Match）の補助
+
+- プロキシの応答: `RenderCache.render()` で本文と ETag を作り（同じオブジェクトなら作り直さない）、
+  `etag_matches()` でクライアントの `If-None-Match` と照合して 304 を返す
+- 上流への GET: `ValidatorCache` に ETag / Last-Modified と応答を保持し、次回は条件付きで問い合わせる。
+  304 が返れば保持している応答をそのまま使う
+
+使用方法:
+    from http_cache import RenderCache, ValidatorCache, etag_matches
+
+    rendered = render_cache.render(request.url.path, data)
+    if etag_matches(request.headers.get('if-none-match'), rendered.etag):
+        return Response(status_code=304, headers={'ETag': rendered.etag})
+"""
+
+import hashlib
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+import orjson
+
+
+def make_etag(body: bytes) -> str:
+    """本文から強い ETag を作る"""
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+class ETagBuilder:
+    """分けて書き出す本文から、`make_etag` と同じ ETag を作る"""
+
+    __slots__ = ('_hash',)
+
+    def __init__(self):
+        self._hash = hashlib.blake2b(digest_size=16)
+
+    def update(self, chunk: bytes) -> None:
+        self._hash.update(chunk)
+
+    @property
+    def etag(self) -> str:
+        return '"' + self._hash.hexdigest() + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """`If-None-Match` が ETag に一致するか（弱い比較。`W/` の有無は区別しない）"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    opaque = etag[2:] if etag.startswith('W/') else etag
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+
+class _LRU:
+    """件数上限付きの辞書（古く使われたものから捨てる）"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[Hashable, Any]' = OrderedDict()
+
+    def get(self, key: Hashable) -> Any:
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: Hashable) -> Any:
+        return self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# ========================================
+# 上流への条件付き GET
+# ========================================
+
+class CachedResponse:
+    """上流の応答と検証子"""
+
+    __slots__ = ('etag', 'last_modified', 'data')
+
+    def __init__(self, etag: Optional[str], last_modified: Optional[str], data: Any):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.data = data
+
+    def conditional_headers(self) -> Dict[str, str]:
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ValidatorCache(_LRU):
+    """GET のキー（エンドポイントとクエリ）→ 最後に受け取った応答と検証子"""
+
+    def __init__(self, max_entries: int = 512):
+        super().__init__(max_entries)
+        self.not_modified = 0
+        self.modified = 0
+
+    def store(self, key: Hashable, etag: Optional[str], last_modified: Optional[str], data: Any) -> None:
+        """検証子の付いた応答だけを保持する（付いていなければ以前のものも捨てる）"""
+        if etag or last_modified:
+            self.put(key, CachedResponse(etag, last_modified, data))
+        else:
+            self.pop(key)
+
+    def stats(self) -> Dict[str, int]:
+        return {'entries': len(self), 'not_modified': self.not_modified, 'modified': self.modified}
+
+
+# ========================================
+# プロキシの応答
+# ========================================
+
+class RenderedJson:
+    """JSON にした本文と ETag（元のオブジェクトが同じ間は使い回す）"""
+
+    __slots__ = ('source', 'body', 'etag')
+
+    def __init__(self, source: Any, body: bytes):
+        self.source = source
+        self.body = body
+        self.etag = make_etag(body)
+
+
+class RenderCache(_LRU):
+    """応答のキー（パス）→ JSON にした本文と ETag
+
+    カタログや上流の 304 で同じオブジェクトが返ってくる間は、JSON への変換とハッシュ計算を省く。
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        super().__init__(max_entries)
+
+    def render(self, key: Hashable, data: Any) -> RenderedJson:
+        rendered = self.get(key)
+        if rendered is None or rendered.source is not data:
+            rendered = RenderedJson(data, orjson.dumps(data))
+            self.put(key, rendered)
+        return rendered
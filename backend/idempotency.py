@@ -0,0 +1,347 @@
+"""
+打刻リクエストの重複排除（Idempotency-Key とカードごとの短い窓）
+
+NFC リーダーは同じカードを 1 秒以内に何度も読み取ることがあり、そのたびに打刻リクエストが届く。
+対象のパスでは次のどちらかに当たった重複リクエストに、最初のリクエストの応答をそのまま返す
+（DB や Stapro には触れない。最初のリクエストが処理中なら、その完了を待って同じ応答を返す）。
+
+- `Idempotency-Key` ヘッダー: 同じキーのリクエストに `key_ttl` 秒間同じ応答を返す。
+  同じキーで本文が異なる場合は 422 にする
+- 重複排除の窓: パスと本文（JSON を正規化したもの。`card_id` を含む）が同じリクエストに `window` 秒間同じ応答を返す
+
+5xx や例外で終わった応答は保持しない（待っていた重複リクエストは改めて処理する）。
+再送した応答には `Idempotent-Replayed: true` を付ける。
+
+`get_store` がワーカー間の共有ストア（`shared_state`）を返す場合は、応答をそこにも保持し、
+別のワーカーに届いた重複リクエストにも同じ応答を返す（処理中なら完了までポーリングして待つ）。
+
+使用方法:
+    from idempotency import IdempotencyMiddleware
+
+    app.add_middleware(IdempotencyMiddleware, paths=("/api/clock-in", "/api/clock-out"), window=2.0)
+"""
+
+import asyncio
+import base64
+import hashlib
+import logging
+import math
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import orjson
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+REPLAYED = REGISTRY.counter(
+    'http_replayed_responses_total', '重複リクエストに保持していた応答を返した件数（key: Idempotency-Key, window: 重複排除の窓）',
+    ['reason'])
+KEY_CONFLICTS = REGISTRY.counter(
+    'idempotency_key_conflicts_total', '同じ Idempotency-Key で異なる本文のリクエストを拒否した件数')
+
+_CONFLICT_BODY = orjson.dumps({"detail": "Idempotency-Key が別の内容のリクエストで使われています"})
+
+
+class StoredResponse:
+    """最初のリクエストの応答（処理中は `done` が未設定）"""
+
+    __slots__ = ('fingerprint', 'done', 'status', 'headers', 'body', 'route')
+
+    def __init__(self, fingerprint: bytes):
+        self.fingerprint = fingerprint
+        self.done = asyncio.Event()
+        self.status: Optional[int] = None
+        self.headers: List[Tuple[bytes, bytes]] = []
+        self.body = b''
+        self.route: Any = None
+
+
+class _ReplayedRoute:
+    """別のワーカーの応答を返すときに `scope['route']` に入れる（ログ・メトリクスのラベル用）"""
+
+    __slots__ = ('path',)
+
+    def __init__(self, path: str):
+        self.path = path
+
+
+class IdempotencyMiddleware:
+    """対象パスの POST について、重複リクエストに最初の応答を返す ASGI ミドルウェア
+
+    Args:
+        paths: 対象のパス
+        window: 同じ本文のリクエストを重複とみなす秒数（0 なら窓による重複排除をしない）
+        key_ttl: `Idempotency-Key` ごとの応答を保持する秒数
+        max_entries: 保持する応答の上限（超えたら期限切れを捨てる）
+        get_store: ワーカー間の共有ストアを返す関数（None を返す間はプロセス内だけで重複排除する）
+        pending_ttl: 共有ストアで処理中とみなす秒数（処理中のワーカーが落ちても、これを過ぎれば処理し直す）
+    """
+
+    def __init__(
+        self,
+        app: Any,
+        paths: Iterable[str],
+        window: float = 2.0,
+        key_ttl: float = 600.0,
+        max_entries: int = 10000,
+        get_store: Optional[Callable[[], Any]] = None,
+        pending_ttl: float = 30.0,
+    ):
+        self.app = app
+        self.paths = frozenset(paths)
+        self.window = window
+        self.key_ttl = key_ttl
+        self.max_entries = max_entries
+        self.get_store = get_store
+        self.pending_ttl = pending_ttl
+        # キー → (応答, 期限)。処理中の応答の期限は無限大にしておく
+        self._entries: Dict[Tuple[str, ...], Tuple[StoredResponse, float]] = {}
+
+    def _purge(self, now: float) -> None:
+        expired = [key for key, (_, expires_at) in self._entries.items() if expires_at <= now]
+        for key in expired:
+            del self._entries[key]
+
+    def _lookup(self, keys: List[Tuple[str, ...]], now: float) -> Optional[Tuple[Tuple[str, ...], StoredResponse]]:
+        for key in keys:
+            found = self._entries.get(key)
+            if found is None:
+                continue
+            stored, expires_at = found
+            if expires_at > now:
+                return key, stored
+            del self._entries[key]
+        return None
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        if scope['type'] != 'http' or scope.get('method') != 'POST' or scope.get('path') not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        # 本文を読み切ってキーを作り、アプリには読んだ本文をそのまま渡す
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        raw = b''.join(chunks)
+        delivered = False
+
+        async def replay_receive() -> Dict[str, Any]:
+            nonlocal delivered
+            if not delivered:
+                delivered = True
+                return {'type': 'http.request', 'body': raw, 'more_body': False}
+            return await receive()
+
+        keys = self._keys(scope, raw)
+        if not keys:
+            await self.app(scope, replay_receive, send)
+            return
+        fingerprint = hashlib.blake2b(scope['path'].encode() + b'\0' + raw, digest_size=16).digest()
+
+        while True:
+            now = time.monotonic()
+            found = self._lookup(keys, now)
+            if found is None:
+                break
+            key, stored = found
+            if key[0] == 'key' and stored.fingerprint != fingerprint:
+                KEY_CONFLICTS.inc()
+                await self._send(send, 422, [(b'content-type', b'application/json')], _CONFLICT_BODY)
+                return
+            await stored.done.wait()
+            if stored.status is not None:
+                reason = 'key' if key[0] == 'key' else 'window'
+                REPLAYED.inc(reason=reason)
+                logger.info("replayed response", extra={
+                    'path': scope['path'], 'reason': reason, 'status': stored.status, 'sampled': True,
+                })
+                if stored.route is not None:
+                    scope['route'] = stored.route
+                await self._send(send, stored.status, stored.headers + [(b'idempotent-replayed', b'true')], stored.body)
+                return
+            # 最初のリクエストが失敗した。キーは外されているので、改めて探すか自分で処理する
+
+        if len(self._entries) >= self.max_entries:
+            self._purge(now)
+        stored = StoredResponse(fingerprint)
+        for key in keys:
+            self._entries[key] = (stored, math.inf)
+
+        store = self.get_store() if self.get_store is not None else None
+        claimed: List[str] = []
+        if store is not None:
+            outcome, claimed, record, reason = await self._claim_shared(store, keys, fingerprint)
+            if outcome != 'claimed':
+                if outcome == 'replay':
+                    # 別のワーカーの応答を、このワーカーで待っている重複リクエストにも返せるようにする
+                    stored.status = record['status']
+                    stored.headers = [(name.encode('latin-1'), value.encode('latin-1')) for name, value in record['headers']]
+                    stored.body = base64.b64decode(record['body'])
+                    stored.route = _ReplayedRoute(scope['path'])
+                    now = time.monotonic()
+                    for key in keys:
+                        self._entries[key] = (stored, now + (self.key_ttl if key[0] == 'key' else self.window))
+                else:
+                    for key in keys:
+                        if self._entries.get(key, (None,))[0] is stored:
+                            del self._entries[key]
+                stored.done.set()
+                if outcome == 'conflict':
+                    KEY_CONFLICTS.inc()
+                    await self._send(send, 422, [(b'content-type', b'application/json')], _CONFLICT_BODY)
+                    return
+                REPLAYED.inc(reason=reason)
+                logger.info("replayed response", extra={
+                    'path': scope['path'], 'reason': reason, 'status': stored.status, 'shared': True, 'sampled': True,
+                })
+                scope['route'] = stored.route
+                await self._send(send, stored.status, stored.headers + [(b'idempotent-replayed', b'true')], stored.body)
+                return
+
+        body: List[bytes] = []
+
+        async def capture(message: Dict[str, Any]) -> None:
+            if message['type'] == 'http.response.start':
+                stored.status = message['status']
+                stored.headers = [
+                    (name, value) for name, value in message.get('headers') or [] if name.lower() != b'content-length'
+                ]
+            elif message['type'] == 'http.response.body':
+                body.append(message.get('body', b''))
+            await send(message)
+
+        completed = False
+        try:
+            await self.app(scope, replay_receive, capture)
+            completed = True
+        finally:
+            if completed and stored.status is not None and stored.status < 500:
+                stored.body = b''.join(body)
+                stored.route = scope.get('route')
+                now = time.monotonic()
+                for key in keys:
+                    ttl = self.key_ttl if key[0] == 'key' else self.window
+                    self._entries[key] = (stored, now + ttl)
+            else:
+                stored.status = None
+                for key in keys:
+                    if self._entries.get(key, (None,))[0] is stored:
+                        del self._entries[key]
+            stored.done.set()
+            if claimed:
+                await self._settle_shared(store, keys, claimed, stored, fingerprint)
+
+    # ========================================
+    # ワーカー間の共有ストア
+    # ========================================
+
+    @staticmethod
+    def _shared_key(key: Tuple[str, ...]) -> str:
+        return 'idempotency:' + '\0'.join(key)
+
+    async def _claim_shared(
+        self, store: Any, keys: List[Tuple[str, ...]], fingerprint: bytes,
+    ) -> Tuple[str, List[str], Optional[Dict[str, Any]], str]:
+        """共有ストアのキーをすべて取る
+
+        Returns:
+            (結果, 取ったキー, 保持されていた応答, 理由)。結果は claimed（自分で処理する）/ replay / conflict
+        """
+        fp = fingerprint.hex()
+        deadline = time.monotonic() + self.pending_ttl
+        while True:
+            claimed: List[str] = []
+            waiting = False
+            for key in keys:
+                shared_key = self._shared_key(key)
+                try:
+                    if await store.add(shared_key, {'fp': fp, 'status': None}, self.pending_ttl):
+                        claimed.append(shared_key)
+                        continue
+                    record = await store.get(shared_key)
+                except Exception as e:
+                    # 共有ストアが使えなければプロセス内の重複排除だけで処理を続ける
+                    logger.warning("shared idempotency store unavailable", extra={'error': repr(e)})
+                    return 'claimed', claimed, None, ''
+                if record is None:
+                    # 取ろうとした間に消えた。最初からやり直す
+                    waiting = True
+                    break
+                reason = 'key' if key[0] == 'key' else 'window'
+                if key[0] == 'key' and record.get('fp') != fp:
+                    await self._release_shared(store, claimed)
+                    return 'conflict', [], None, reason
+                if record.get('status') is not None:
+                    await self._release_shared(store, claimed)
+                    return 'replay', [], record, reason
+                waiting = True
+                break
+            if not waiting:
+                return 'claimed', claimed, None, ''
+            # 別のワーカーが処理中。完了を待ってから取り直す
+            await self._release_shared(store, claimed)
+            if time.monotonic() >= deadline:
+                return 'claimed', [], None, ''
+            await asyncio.sleep(0.02)
+
+    @staticmethod
+    async def _release_shared(store: Any, claimed: List[str]) -> None:
+        for shared_key in claimed:
+            try:
+                await store.delete(shared_key)
+            except Exception:
+                pass
+
+    async def _settle_shared(
+        self, store: Any, keys: List[Tuple[str, ...]], claimed: List[str], stored: StoredResponse, fingerprint: bytes,
+    ) -> None:
+        """処理を終えた応答を共有ストアに書く（保持しない応答ならキーを外す）"""
+        if stored.status is None:
+            await self._release_shared(store, claimed)
+            return
+        record = {
+            'fp': fingerprint.hex(),
+            'status': stored.status,
+            'headers': [[name.decode('latin-1'), value.decode('latin-1')] for name, value in stored.headers],
+            'body': base64.b64encode(stored.body).decode('ascii'),
+        }
+        for key in keys:
+            shared_key = self._shared_key(key)
+            if shared_key not in claimed:
+                continue
+            try:
+                await store.set(shared_key, record, self.key_ttl if key[0] == 'key' else self.window)
+            except Exception as e:
+                logger.warning("shared idempotency store unavailable", extra={'error': repr(e)})
+
+    def _keys(self, scope: Dict[str, Any], raw: bytes) -> List[Tuple[str, ...]]:
+        """`Idempotency-Key` と重複排除の窓のキー（どちらも無ければ空）"""
+        keys: List[Tuple[str, ...]] = []
+        for name, value in scope.get('headers') or []:
+            if name == b'idempotency-key':
+                keys.append(('key', scope['path'], value.decode('latin-1')[:255]))
+                break
+        if self.window > 0:
+            try:
+                payload = orjson.loads(raw)
+            except orjson.JSONDecodeError:
+                payload = None
+            # カードを読み取った打刻だけを対象にする（card_id の無い確認操作などは毎回処理する）
+            if isinstance(payload, dict) and payload.get('card_id'):
+                canonical = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)
+                keys.append(('window', scope['path'], hashlib.blake2b(canonical, digest_size=16).hexdigest()))
+        return keys
+
+    @staticmethod
+    async def _send(send: Callable, status: int, headers: List[Tuple[bytes, bytes]], body: bytes) -> None:
+        headers = headers + [(b'content-length', str(len(body)).encode('latin-1'))]
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
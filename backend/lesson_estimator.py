@@ -0,0 +1,197 @@
+"""
+タイムテーブルからのコマ推定
+
+`get_school` の `timetables` を曜日ごとの区間索引（開始時刻でソートした配列）に変換し、
+出勤〜現在の勤務時間帯と重なるレッスンを二分探索で求める。
+同じ（教室・曜日・時間帯）の問い合わせ結果はメモ化する。
+
+タイムテーブルの各要素は次のキーを想定する（無いキーは別名も順に探す）:
+    id / lesson_id:              レッスンID
+    day_of_week / wday / weekday: 曜日（数値は Ruby の wday と同じく 0=日曜。"monday" や "月" も可）
+    start_time / start_at:       開始時刻（"16:00"、"16:00:00"、"2000-01-01T16:00:00.000+09:00" など）
+    end_time / end_at:           終了時刻
+    lessons:                     入れ子のレッスン配列（曜日は親の値を引き継ぐ）
+
+使用方法:
+    from lesson_estimator import LessonEstimator
+
+    estimator = LessonEstimator()
+    estimate = estimator.estimate(school_id, school, clock_in_at, now)
+    print(estimate.count, estimate.lesson_ids)
+"""
+
+import bisect
+from collections import OrderedDict
+from datetime import datetime, tzinfo
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+
+_WEEKDAY_NAMES = {
+    'sunday': 0, 'sun': 0, '日': 0,
+    'monday': 1, 'mon': 1, '月': 1,
+    'tuesday': 2, 'tue': 2, '火': 2,
+    'wednesday': 3, 'wed': 3, '水': 3,
+    'thursday': 4, 'thu': 4, '木': 4,
+    'friday': 5, 'fri': 5, '金': 5,
+    'saturday': 6, 'sat': 6, '土': 6,
+}
+
+
+def _first(row: Dict[str, Any], *keys: str) -> Any:
+    for key in keys:
+        value = row.get(key)
+        if value is not None:
+            return value
+    return None
+
+
+def _parse_wday(value: Any) -> Optional[int]:
+    """曜日を Ruby の wday（0=日曜）に揃える"""
+    if value is None:
+        return None
+    if isinstance(value, int):
+        return value % 7
+    text = str(value).strip().lower()
+    if text.isdigit():
+        return int(text) % 7
+    # 日曜は 0 なので `or` でつながず、見つかったかどうかで判定する
+    for candidate in (text, text[:3], text[:1]):
+        wday = _WEEKDAY_NAMES.get(candidate)
+        if wday is not None:
+            return wday
+    return None
+
+
+def _parse_minutes(value: Any) -> Optional[int]:
+    """時刻を 0 時からの分に変換する（日付・タイムゾーン部分は無視する）"""
+    if value is None:
+        return None
+    text = str(value).strip()
+    if 'T' in text:
+        text = text.split('T', 1)[1]
+    parts = text[:8].split(':')
+    try:
+        return int(parts[0]) * 60 + int(parts[1])
+    except (IndexError, ValueError):
+        return None
+
+
+class LessonEstimate:
+    """勤務時間帯に重なるレッスン"""
+
+    __slots__ = ('count', 'lesson_ids')
+
+    def __init__(self, lesson_ids: List[int]):
+        self.lesson_ids = lesson_ids
+        self.count = len(lesson_ids)
+
+
+class DayIndex:
+    """1 曜日分の区間索引（開始時刻の昇順）"""
+
+    __slots__ = ('starts', 'ends', 'ids', 'max_duration')
+
+    def __init__(self, lessons: Iterable[Tuple[int, int, int]]):
+        ordered = sorted(lessons)
+        self.starts = [start for start, _, _ in ordered]
+        self.ends = [end for _, end, _ in ordered]
+        self.ids = [lesson_id for _, _, lesson_id in ordered]
+        self.max_duration = max((end - start for start, end, _ in ordered), default=0)
+
+    def overlapping(self, start: int, end: int, min_overlap: float) -> List[int]:
+        """[start, end) と重なるレッスンIDを返す
+
+        各レッスンの長さの `min_overlap` 割合以上が勤務時間帯に入っているものだけを数える。
+        """
+        # 開始が (start - 最長レッスン) 以上 end 未満のものだけが重なりうる
+        lo = bisect.bisect_left(self.starts, start - self.max_duration)
+        hi = bisect.bisect_left(self.starts, end)
+        lesson_ids = []
+        for i in range(lo, hi):
+            lesson_start, lesson_end = self.starts[i], self.ends[i]
+            overlap = min(end, lesson_end) - max(start, lesson_start)
+            duration = max(1, lesson_end - lesson_start)
+            if overlap > 0 and overlap >= duration * min_overlap:
+                lesson_ids.append(self.ids[i])
+        return lesson_ids
+
+
+def build_index(timetables: Iterable[Dict[str, Any]]) -> Dict[int, DayIndex]:
+    """タイムテーブルから曜日ごとの区間索引を作る"""
+    by_day: Dict[int, List[Tuple[int, int, int]]] = {}
+
+    def add(row: Dict[str, Any], inherited_wday: Optional[int]) -> None:
+        wday = _parse_wday(_first(row, 'day_of_week', 'wday', 'weekday', 'day'))
+        if wday is None:
+            wday = inherited_wday
+        nested = row.get('lessons')
+        if isinstance(nested, list):
+            for lesson in nested:
+                if isinstance(lesson, dict):
+                    add(lesson, wday)
+            return
+        lesson_id = _first(row, 'lesson_id', 'id')
+        start = _parse_minutes(_first(row, 'start_time', 'start_at', 'begin_time', 'started_at'))
+        end = _parse_minutes(_first(row, 'end_time', 'end_at', 'finish_time', 'ended_at'))
+        if wday is None or lesson_id is None or start is None or end is None or end <= start:
+            return
+        try:
+            by_day.setdefault(wday, []).append((start, end, int(lesson_id)))
+        except (TypeError, ValueError):
+            return
+
+    for row in timetables or []:
+        if isinstance(row, dict):
+            add(row, None)
+    return {wday: DayIndex(lessons) for wday, lessons in by_day.items()}
+
+
+class LessonEstimator:
+    """教室ごとの区間索引と推定結果のメモ化"""
+
+    def __init__(self, tz: Optional[tzinfo] = None, min_overlap: float = 0.5, cache_size: int = 4096):
+        self.tz = tz
+        self.min_overlap = min_overlap
+        self.cache_size = cache_size
+        # school_id -> (索引の元になった get_school の応答, 曜日ごとの索引)
+        self._indexes: Dict[Any, Tuple[Any, Dict[int, DayIndex]]] = {}
+        self._memo: 'OrderedDict[Tuple[Any, int, int, int], List[int]]' = OrderedDict()
+
+    def _index_for(self, school_id: Any, school: Dict[str, Any]) -> Dict[int, DayIndex]:
+        cached = self._indexes.get(school_id)
+        if cached is not None and cached[0] is school:
+            return cached[1]
+        # カタログが取り直した（別オブジェクトになった）ときだけ索引を作り直す
+        timetables = school.get('timetables')
+        if timetables is None and isinstance(school.get('school'), dict):
+            timetables = school['school'].get('timetables')
+        index = build_index(timetables or [])
+        self._indexes[school_id] = (school, index)
+        for key in [k for k in self._memo if k[0] == school_id]:
+            del self._memo[key]
+        return index
+
+    def stats(self) -> Dict[str, int]:
+        return {'schools': len(self._indexes), 'memo_entries': len(self._memo)}
+
+    def estimate(self, school_id: Any, school: Dict[str, Any], clock_in_at: datetime, now: datetime) -> LessonEstimate:
+        """出勤〜現在の時間帯に重なるレッスンを推定する"""
+        index = self._index_for(school_id, school)
+        local_in = clock_in_at.astimezone(self.tz)
+        local_now = now.astimezone(self.tz)
+        wday = (local_in.weekday() + 1) % 7
+        start = local_in.hour * 60 + local_in.minute
+        # 日をまたいだ勤務は出勤日の終わりまでで打ち切る
+        end = local_now.hour * 60 + local_now.minute if local_now.date() == local_in.date() else 24 * 60
+
+        key = (school_id, wday, start, end)
+        lesson_ids = self._memo.get(key)
+        if lesson_ids is None:
+            day = index.get(wday)
+            lesson_ids = day.overlapping(start, end, self.min_overlap) if day else []
+            self._memo[key] = lesson_ids
+            if len(self._memo) > self.cache_size:
+                self._memo.popitem(last=False)
+        else:
+            self._memo.move_to_end(key)
+        return LessonEstimate(list(lesson_ids))
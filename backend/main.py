@@ -1,19 +1,164 @@
+import asyncio
+import csv
+import io
+import json
+import logging
 import os
-from datetime import datetime, timezone
-from typing import List, Optional, Dict, Any
-from fastapi import FastAPI, HTTPException
-import requests
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime, time as dt_time, timedelta, timezone
+from zoneinfo import ZoneInfo
+from typing import TYPE_CHECKING, List, Optional, Dict, Any
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+import orjson
 from fastapi.middleware.cors import CORSMiddleware
-from supabase import create_client, Client
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 from dotenv import load_dotenv
-from stapro_api_client import StaproAPIClient
+from stapro_api_client_async import AsyncStaproAPIClient
+from card_index import CardIndex, UserRecord
+from open_shifts import OpenShift, OpenShiftRegistry
+from state_tokens import StateTokenStore
+from school_catalog import SchoolCatalog
+from lesson_estimator import LessonEstimate, LessonEstimator
+from card_import import ImportRow, parse_registrations
+import metrics
+from metrics import REGISTRY, MetricsMiddleware
+import structured_logging
+from structured_logging import RequestLogMiddleware, log_duration
+from attendance_outbox import STATUS_DONE, STATUS_FAILED, OutboxWorker, SqliteOutbox, SupabaseOutbox
+from attendance_journal import AttendanceJournal, JournalReplayer
+from readiness import Readiness
+from idempotency import IdempotencyMiddleware
+from payroll_rollups import PayrollRollups, valid_month
+from reconciliation import AttendanceReconciler
+from shared_state import open_shared_state
+from roster import RESYNC, RosterFeed, sse_frame
 from datetime import date
 
+if TYPE_CHECKING:
+    from supabase import AsyncClient
+
 # 環境変数の読み込み
 load_dotenv()
 
-app = FastAPI()
+logger = logging.getLogger("main")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global supabase, card_index, open_shifts, attendance_outbox, outbox_worker, school_catalog, readiness, _stapro_client
+    global attendance_journal, journal_replayer, payroll_rollups, attendance_reconciler, shared_state, roster_feed
+    structured_logging.start("main")
+    # 複数ワーカーで動かすときは SHARED_STATE=sqlite:///shared_state.db のように全ワーカーで同じファイルを指定する
+    shared_state = open_shared_state(os.getenv("SHARED_STATE", "local"))
+    # プロセス内の実装ではリースが常に取れるので、同じジャーナルを全ワーカーが二重に反映してしまう
+    if not shared_state.shared and int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+        raise ValueError("SHARED_STATE must point to a shared store (sqlite:///...) when WEB_CONCURRENCY > 1")
+    url =os.environ.get("SUPABASE_URL")
+    key = os.environ.get("SUPABASE_KEY")
+    # 環境変数が読み込めてるかチェック
+    if not url or not key:
+        raise ValueError("Supabase credentials not found in .env")
+
+    # supabase は読み込みが重いので、import 時ではなく起動時に読み込む（接続はまだ張らない）
+    from supabase import acreate_client
+    supabase = await acreate_client(url, key)
+    card_index = CardIndex(supabase)
+    # 出勤・退勤はローカルのジャーナルに追記して応答し、attendance_logs へはバックグラウンドで反映する
+    attendance_journal = AttendanceJournal(
+        os.getenv("ATTENDANCE_JOURNAL_PATH", "attendance_journal.db"),
+        on_settled=_publish_journal_settled,
+    )
+    # 台帳の変更（出勤・退勤）はロスターの購読者に配信する
+    roster_feed = RosterFeed()
+    open_shifts = OpenShiftRegistry(supabase, overlay=attendance_journal.overlay, on_change=_on_open_shift_changed)
+    # 月次の給与集計は退勤が attendance_logs に反映されるたびに更新する
+    payroll_rollups = PayrollRollups(supabase, tz=lesson_estimator.tz)
+    journal_replayer = JournalReplayer(
+        attendance_journal,
+        get_supabase=lambda: supabase,
+        on_resolved=_on_attendance_resolved,
+        on_clock_out=payroll_rollups.record_clock_out,
+        submit_clock_out=_submit_clock_out,
+        leader=_journal_leader,
+    )
+
+    # コマ推定に使うタイムテーブル（前回のスナップショットから温めておく）
+    school_catalog = SchoolCatalog(
+        get_client=get_stapro_client,
+        ttl=float(os.getenv("SCHOOL_CATALOG_TTL", "3600")),
+        snapshot_path=os.getenv("SCHOOL_CATALOG_SNAPSHOT", "school_catalog.json"),
+    )
+    school_catalog.load_snapshot()
+    _register_gauges()
+
+    # Stapro への勤怠登録はアウトボックス経由でバックグラウンド送信する
+    if os.getenv("ATTENDANCE_OUTBOX", "sqlite") == "supabase":
+        attendance_outbox = SupabaseOutbox(supabase)
+    else:
+        attendance_outbox = SqliteOutbox(os.getenv("ATTENDANCE_OUTBOX_PATH", "attendance_outbox.db"))
+    outbox_worker = OutboxWorker(attendance_outbox, get_client=get_stapro_client)
+    outbox_worker.start()
+    # 退勤の反映時にアウトボックスへ積むことがあるので、アウトボックスを用意してから始める
+    journal_replayer.start()
+
+    # attendance_logs と Stapro の突き合わせ（管理用エンドポイントから実行する）
+    attendance_reconciler = AttendanceReconciler(
+        supabase,
+        get_client=get_stapro_client,
+        get_users=_reconcile_users,
+        tz=lesson_estimator.tz,
+        watermark_path=os.getenv("RECONCILE_WATERMARK_PATH", "attendance_reconcile.json"),
+        overlap_days=int(os.getenv("RECONCILE_OVERLAP_DAYS", "2")),
+    )
+
+    # キャッシュの読み込みは受け付け開始後にバックグラウンドで行い、終わるまで /readyz は 503 を返す
+    # （読み込み前の打刻は索引・台帳が DB を直接引くので正しく動く）
+    # 他のワーカーの書き込み（カード登録・出勤・退勤）をこのワーカーのキャッシュに反映する
+    shared_state.subscribe("users", _on_users_changed)
+    shared_state.subscribe("open_shifts", _on_shift_changed)
+    shared_state.subscribe("journal", attendance_journal.settled)
+    shared_state.subscribe("school_catalog", _on_school_catalog_invalidated)
+    tap_tokens.store = shared_state if shared_state.shared else None
+    shared_state.start()
+
+    # 読み込みが済んだ後も依存先への疎通を定期的に確かめ、落ちている間は /readyz を 503 に戻す
+    readiness = Readiness(recheck_interval=READINESS_RECHECK_INTERVAL, probe_timeout=READINESS_PROBE_TIMEOUT)
+    readiness.add("card_index", _load_card_index, dependency="supabase", probe=_ping_supabase)
+    readiness.add("open_shifts", _seed_open_shifts, dependency="supabase")
+    if os.getenv("STARTUP_WARMUP", "1") == "1":
+        readiness.add("stapro", _warm_up_stapro, required=False, probe=_ping_stapro)
+    readiness.start()
+    yield
+    roster_feed.close()
+    await readiness.stop()
+    await journal_replayer.stop()
+    await shared_state.release("journal_replayer")
+    attendance_journal.close()
+    await outbox_worker.stop()
+    attendance_outbox.close()
+    # 共有している Stapro クライアントの接続プールを閉じる
+    if _stapro_client is not None:
+        await _stapro_client.aclose()
+        _stapro_client = None
+    await shared_state.close()
+    structured_logging.stop()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# NFC リーダーの多重読み取りや再送による重複打刻には、最初の応答をそのまま返す（DB・Stapro に触れない）
+app.add_middleware(
+    IdempotencyMiddleware,
+    paths=("/api/clock-in", "/api/clock-out", "/api/tap"),
+    window=float(os.getenv("TAP_DEDUPE_WINDOW", "2.0")),
+    key_ttl=float(os.getenv("IDEMPOTENCY_KEY_TTL", "600")),
+    get_store=lambda: shared_state if shared_state is not None and shared_state.shared else None,
+)
+
+# ルートごとの所要時間を記録する（/metrics で公開）
+app.add_middleware(MetricsMiddleware, app_name="main")
 
 # CORS設定 (Flutterアプリからのアクセスを許可)
 app.add_middleware(
@@ -24,15 +169,92 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Supabase接続
-url: str = os.environ.get("SUPABASE_URL")
-key: str = os.environ.get("SUPABASE_KEY")
+# リクエストIDの割り当てとアクセスログ（最も外側に置き、以降のログすべてに ID を付ける）
+app.add_middleware(RequestLogMiddleware)
+
+# 非同期クライアントはイベントループ上で作る必要があるため lifespan で接続する
+supabase: Optional["AsyncClient"] = None
+
+# カードID → ユーザーの索引（lifespan で読み込む）
+card_index: Optional[CardIndex] = None
+
+# ユーザーID → 未退勤シフトの台帳（lifespan で読み込む）
+open_shifts: Optional[OpenShiftRegistry] = None
+
+# 出勤・退勤のジャーナルと attendance_logs への反映ワーカー（lifespan で起動する）
+attendance_journal: Optional[AttendanceJournal] = None
+journal_replayer: Optional[JournalReplayer] = None
+
+# ユーザー × 月の給与集計（lifespan で作る）
+payroll_rollups: Optional[PayrollRollups] = None
+
+# Stapro 連携ジョブのアウトボックスと送信ワーカー（lifespan で起動する）
+attendance_outbox: Any = None
+outbox_worker: Optional[OutboxWorker] = None
 
-# 環境変数が読み込めてるかチェック
-if not url or not key:
-    raise ValueError("Supabase credentials not found in .env")
+# 出勤中スタッフ一覧の変更の配信（lifespan で作る）
+roster_feed: Optional[RosterFeed] = None
+# ロスターの配信で、イベントが無いときに接続維持のコメントを送る間隔（秒）
+ROSTER_HEARTBEAT = float(os.getenv("ROSTER_HEARTBEAT", "15"))
 
-supabase: Client = create_client(url, key)
+# ワーカー間で共有する状態と無効化イベント（lifespan で開く）
+shared_state: Any = None
+# ジャーナルを反映するワーカーのリースの期限（秒）。反映するワーカーが落ちたら、これを過ぎて別のワーカーが引き継ぐ
+JOURNAL_LEADER_TTL = float(os.getenv("JOURNAL_LEADER_TTL", "15"))
+
+# attendance_logs と Stapro の勤怠の突き合わせ（lifespan で作る）
+attendance_reconciler: Optional[AttendanceReconciler] = None
+
+# 教室・タイムテーブルのキャッシュ（lifespan で作る）とコマ推定
+school_catalog: Optional[SchoolCatalog] = None
+lesson_estimator = LessonEstimator(tz=ZoneInfo(os.getenv("SCHOOL_TIMEZONE", "Asia/Tokyo")))
+# 推定のためにタイムテーブルを取りに行くときの待ち時間の上限（秒）
+LESSON_ESTIMATE_TIMEOUT = float(os.getenv("LESSON_ESTIMATE_TIMEOUT", "1.0"))
+
+# Stapro API クライアント（プロセスで 1 つを共有し、keep-alive 接続を再利用する）
+_stapro_client: Optional[AsyncStaproAPIClient] = None
+
+# 起動時の準備処理（lifespan で開始し、/readyz で報告する）
+readiness: Optional[Readiness] = None
+# 起動時に先に開いておく Stapro への接続数の目安（教室詳細を並列に取得する数）
+STARTUP_WARMUP_CONNECTIONS = int(os.getenv("STARTUP_WARMUP_CONNECTIONS", "4"))
+# 起動後に依存先（Supabase・Stapro）への疎通を確かめ直す間隔と、その応答を待つ秒数
+READINESS_RECHECK_INTERVAL = float(os.getenv("READINESS_RECHECK_INTERVAL", "15"))
+READINESS_PROBE_TIMEOUT = float(os.getenv("READINESS_PROBE_TIMEOUT", "5"))
+
+# `/api/tap` の確認用トークン（退勤待ちの状態を短時間だけ覚えておく）
+tap_tokens = StateTokenStore(ttl=float(os.getenv("TAP_TOKEN_TTL", "120")))
+
+# ユーザーごとの打刻ロック（同じユーザーの出勤・退勤を直列化する）
+# 使っている間だけ残し、誰も持っていないロックは捨てる（打刻したユーザーの数だけ増え続けないように）
+_user_locks: "weakref.WeakValueDictionary[Any, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+# Supabase を使うヘルパーごとの所要時間
+SUPABASE_SECONDS = REGISTRY.histogram(
+    'supabase_query_duration_seconds', 'Supabase を使うヘルパーの所要時間（ヘルパー別）', ['helper'])
+
+
+@contextmanager
+def _db_timer(helper: str):
+    """Supabase を使うヘルパーの所要時間をヒストグラムとログに記録する"""
+    with SUPABASE_SECONDS.time(helper=helper), log_duration(logger, "supabase query", helper=helper):
+        yield
+
+
+# 打刻時の参照（索引・台帳）の所要時間。DB まで問い合わせた分だけ supabase_query_duration_seconds にも記録する
+LOOKUP_SECONDS = REGISTRY.histogram(
+    'lookup_duration_seconds', '打刻時の参照の所要時間（ヘルパー・参照先別）', ['helper', 'source'])
+
+
+@contextmanager
+def _lookup_timer(helper: str, source: str):
+    """参照の所要時間を参照先（memory / supabase）別に記録する"""
+    with LOOKUP_SECONDS.time(helper=helper, source=source):
+        if source == "supabase":
+            with _db_timer(helper):
+                yield
+        else:
+            yield
 
 # --- 型定義 ---
 class ScanRequest(BaseModel):
@@ -44,6 +266,7 @@ class ScanResponse(BaseModel):
     message: str
     default_cost: Optional[int] = 0
     estimated_class_count: Optional[int] = 0
+    estimated_lesson_ids: Optional[List[int]] = []
     transport_presets: Optional[List[Dict[str, Any]]] = []
     attendance_id: Optional[int] = None
     clock_in_at: Optional[str] = None
@@ -70,40 +293,260 @@ class RegisterCardRequest(BaseModel):
     default_school_id: Optional[int] = None
     transport_presets: Optional[List[Dict[str, Any]]] = None
 
+class TapConfirm(BaseModel):
+    transport_cost: int
+    class_count: int
+    is_auto_submit: bool = False
+    lesson_ids: Optional[List[int]] = None
+
+class TapRequest(BaseModel):
+    card_id: Optional[str] = None
+    state_token: Optional[str] = None  # 直前の `/api/tap` が返したトークン
+    confirm: Optional[TapConfirm] = None  # 退勤時の入力。あればそのまま退勤する
+
+class AttendanceFlushRequest(BaseModel):
+    work_day: Optional[date] = None  # 省略時は今日
+    school_id: Optional[int] = None
+    max_concurrency: int = 8
+
+
+class AttendanceReconcileRequest(BaseModel):
+    since: Optional[date] = None  # 省略時は前回の続きから
+    until: Optional[date] = None  # 省略時は昨日
+    repair: bool = False
+    max_concurrency: int = 16
+    limit: int = 500
+
 
 #--- ヘルパー関数 ---
-def _get_user_by_card(card_id: str):
-    """カードIDからユーザーを検索する"""
-    res = supabase.table("users").select("*").eq("card_id", card_id).execute()
-    if not res.data:
-        return None
-    return res.data[0]
+async def _get_user_by_card(card_id: str) -> Optional[UserRecord]:
+    """カードIDからユーザーを検索する（インメモリ索引を優先）"""
+    source = "memory" if card_id in card_index else "supabase"
+    with _lookup_timer("get_user_by_card", source):
+        return await card_index.get(card_id)
 
-def _get_active_log(user_id: str):
-    """現在出勤中（退勤していない）のログを取得する"""
-    # Supabase の is_ 等の挙動に依存せず、取得したレコードをコード側でチェックする。
-    # これにより `NULL`、空文字、文字列 "null" のような不整合にも対応する。
+async def _get_active_log(user_id: Any) -> Optional[OpenShift]:
+    """現在出勤中（退勤していない）のログを取得する（未退勤シフト台帳を参照）"""
     try:
-        res = supabase.table("attendance_logs")\
-            .select("*")\
-            .eq("user_id", user_id)\
-            .order("id", desc=True)\
-            .limit(50)\
-            .execute()
+        source = "memory" if open_shifts.seeded else "supabase"
+        with _lookup_timer("get_active_log", source):
+            return await open_shifts.get(user_id)
     except Exception:
         return None
 
-    if not res.data:
-        return None
 
-    for row in res.data:
-        if row is None:
+# --- 起動時の準備処理（readiness のチェック） ---
+async def _load_card_index() -> Dict[str, Any]:
+    """全ユーザーを読み込み、打刻時のユーザー検索を DB 往復なしにする（Supabase への到達確認を兼ねる）"""
+    count = await card_index.load()
+    logger.info("card index loaded", extra={"users": count})
+    return {"users": count}
+
+async def _seed_open_shifts() -> Dict[str, Any]:
+    """未退勤シフトを 1 クエリで読み込み、出勤中かどうかの判定を台帳で済ませる"""
+    count = await open_shifts.seed()
+    logger.info("open shift registry seeded", extra={"open_shifts": count})
+    return {"open_shifts": count}
+
+async def _warm_up_stapro() -> Dict[str, Any]:
+    """Stapro への接続をプールに開いておき、教室一覧とタイムテーブルを先読みする
+
+    打刻の可否には関わらないので readiness の必須チェックにはしない。
+    """
+    if get_stapro_client() is None:
+        return {"configured": False}
+    schools = await school_catalog.get_schools()
+    if isinstance(schools, dict):
+        schools = schools.get("schools") or []
+    school_ids = [s.get("id") for s in schools or [] if isinstance(s, dict) and s.get("id") is not None]
+    # 教室詳細を並列に取ることで、最初の打刻が新しい接続の確立を待たないようにする
+    semaphore = asyncio.Semaphore(max(1, STARTUP_WARMUP_CONNECTIONS))
+
+    async def preload(school_id: Any) -> None:
+        async with semaphore:
+            await school_catalog.get_school(school_id)
+
+    await asyncio.gather(*(preload(i) for i in school_ids))
+    return {"configured": True, "schools": len(school_ids), "pool": get_stapro_client().pool_stats()}
+
+
+async def _ping_supabase() -> None:
+    """Supabase への疎通確認（1 行だけ読む）"""
+    await supabase.table("users").select("id").limit(1).execute()
+
+async def _ping_stapro() -> None:
+    """Stapro への疎通確認（教室一覧は ETag で再検証するので、変わっていなければ本文は返らない）"""
+    client = get_stapro_client()
+    if client is not None:
+        await client.get_schools()
+
+
+def _register_gauges() -> None:
+    """キャッシュや接続プールの状態をスクレイプ時に読むゲージを登録する"""
+    metrics.watch_stapro_pool(lambda: _stapro_client, "main")
+    metrics.watch_school_catalog(lambda: school_catalog, "main")
+    REGISTRY.callback('card_index_users', 'カード索引に載っているユーザー数', 'gauge',
+                      lambda: [({}, len(card_index))] if card_index is not None else [])
+    REGISTRY.callback('open_shifts', '未退勤シフト台帳の件数', 'gauge',
+                      lambda: [({}, len(open_shifts))] if open_shifts is not None else [])
+    REGISTRY.callback('tap_tokens_active', '発行済みで未使用のタップ確認トークン数', 'gauge',
+                      lambda: [({}, len(tap_tokens))])
+    REGISTRY.callback('lesson_estimate_memo_entries', 'コマ推定のメモ化件数', 'gauge',
+                      lambda: [({}, lesson_estimator.stats()['memo_entries'])])
+    REGISTRY.callback('attendance_journal_entries', '出勤・退勤ジャーナルのエントリー数（状態別）', 'gauge',
+                      lambda: [({'status': k}, v) for k, v in attendance_journal.counts().items()]
+                      if attendance_journal is not None else [])
+    REGISTRY.callback('attendance_journal_lag_seconds', 'attendance_logs に未反映の最も古い打刻の経過秒数', 'gauge',
+                      lambda: [({}, attendance_journal.lag_seconds())] if attendance_journal is not None else [])
+    REGISTRY.callback('roster_stream_clients', 'ロスターの配信に接続中のクライアント数', 'gauge',
+                      lambda: [({}, len(roster_feed))] if roster_feed is not None else [])
+
+
+async def _on_attendance_resolved(user_id: Any, provisional_id: int, attendance_id: int) -> None:
+    """ジャーナルの出勤が attendance_logs に反映されたら、仮の ID を本当の ID に付け替える"""
+    open_shifts.rekey(user_id, provisional_id, attendance_id)
+    await shared_state.publish(
+        "open_shifts", {"op": "rekey", "user_id": user_id, "old_id": provisional_id, "new_id": attendance_id})
+    await attendance_outbox.reassign(provisional_id, attendance_id)
+
+
+async def _journal_leader() -> bool:
+    """このワーカーがジャーナルを反映する番か（同じジャーナルを共有するワーカーのうちリースを持つ 1 つだけ）"""
+    return await shared_state.acquire("journal_replayer", JOURNAL_LEADER_TTL)
+
+
+async def _publish_journal_settled(settled: Dict[str, Any]) -> None:
+    await shared_state.publish("journal", settled)
+
+
+async def _invalidate_user(card_id: Optional[str] = None, user_id: Any = None) -> None:
+    """登録・更新したカード／ユーザーを全ワーカーの索引から外す"""
+    card_index.invalidate(card_id=card_id, user_id=user_id)
+    await shared_state.publish("users", {"card_id": card_id, "user_id": user_id})
+
+
+def _roster_entry(shift: OpenShift) -> Dict[str, Any]:
+    """ロスターの 1 行（ユーザー情報は索引にある分だけを使い、DB には問い合わせない）"""
+    user = card_index.cached(shift.user_id)
+    return {
+        "attendance_id": shift.id,
+        "user_id": shift.user_id,
+        "name": user.name if user else None,
+        "school_id": (_safe_int(user.school_id) or 1) if user else None,
+        "stapro_staff_id": _safe_int(user.stapro_staff_id) if user and user.stapro_staff_id is not None else None,
+        "clock_in_at": shift.clock_in_at,
+    }
+
+
+def _roster_payload(school_id: Optional[int] = None) -> Dict[str, Any]:
+    """出勤中のスタッフを教室ごとにまとめる（`last_event_id` 以降の変更は配信で受け取れる）"""
+    schools: Dict[Any, List[Dict[str, Any]]] = {}
+    for shift in open_shifts.snapshot():
+        entry = _roster_entry(shift)
+        if school_id is not None and entry["school_id"] != school_id:
             continue
-        co = row.get('clock_out_at')
-        if co is None or co == "" or (isinstance(co, str) and co.lower() == "null"):
-            return row
+        schools.setdefault(entry["school_id"], []).append(entry)
+    return {
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "last_event_id": roster_feed.last_id,
+        "total": sum(len(staff) for staff in schools.values()),
+        "schools": [
+            {"school_id": sid, "count": len(staff), "staff": sorted(staff, key=lambda e: e["clock_in_at"] or "")}
+            for sid, staff in sorted(schools.items(), key=lambda item: (item[0] is None, item[0] or 0))
+        ],
+    }
+
+
+def _on_open_shift_changed(user_id: Any, old: Optional[OpenShift], new: Optional[OpenShift]) -> None:
+    """未退勤シフト台帳の変更をロスターのイベントにして配信する"""
+    if roster_feed is None:
+        return
+    event_type = "clock_out" if new is None else "clock_in" if old is None else "updated"
+    entry = _roster_entry(new or old)
+    entry.update(type=event_type, at=datetime.now(timezone.utc).isoformat())
+    roster_feed.publish(event_type, entry, school_id=entry["school_id"])
+
 
-    return None
+def _on_users_changed(message: Dict[str, Any]) -> None:
+    card_index.invalidate(card_id=message.get("card_id"), user_id=message.get("user_id"))
+
+
+def _on_school_catalog_invalidated(message: Dict[str, Any]) -> None:
+    """別のワーカーで捨てた教室カタログをこのワーカーでも捨てる（取り直しは次の参照時）"""
+    school_catalog.invalidate(message.get("school_id"))
+
+
+def _on_shift_changed(message: Dict[str, Any]) -> None:
+    """別のワーカーの出勤・退勤を台帳に反映し、ジャーナルの反映を促す"""
+    op = message.get("op")
+    if op == "opened":
+        open_shifts.opened(message["row"])
+    elif op == "closed":
+        open_shifts.closed(message["user_id"])
+    elif op == "rekey":
+        open_shifts.rekey(message["user_id"], message["old_id"], message["new_id"])
+    journal_replayer.notify()
+
+
+async def _reconcile_users() -> List[UserRecord]:
+    """突き合わせ対象のユーザー（索引の読み込み前なら読み込んでから返す）"""
+    if not card_index.loaded:
+        await card_index.load()
+    return card_index.records()
+
+
+async def _resubmit_attendances(items: List[tuple], max_concurrency: int) -> List[Dict[str, Any]]:
+    """突き合わせで Stapro に無かった勤怠をアウトボックスのジョブにして今すぐ送信する
+
+    flush_attendance と同じく既存のジョブを先に引き、送信済みなら送らず、
+    未送信のジョブがあればそれを使い、ジョブが無いか諦めたものだけ積み直す。
+    """
+    jobs_by_log = await attendance_outbox.for_attendances([attendance_id for attendance_id, _ in items])
+    results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+    pending: List[tuple] = []
+    for index, (attendance_id, payload) in enumerate(items):
+        jobs = [job for job in jobs_by_log.get(attendance_id, []) if job.get('kind') == "clock_out"]
+        done = next((job for job in jobs if job.get('status') == STATUS_DONE), None)
+        if done is not None:
+            results[index] = {"status": "already_synced", "sync_job_id": done.get('id'), "error": None}
+            continue
+        job = jobs[-1] if jobs else None
+        if job is None or job.get('status') == STATUS_FAILED:
+            job = await attendance_outbox.enqueue(attendance_id, "clock_out", payload)
+        pending.append((index, job))
+
+    flushed = await outbox_worker.flush([job for _, job in pending], max_concurrency=max_concurrency)
+    for (index, job), result in zip(pending, flushed):
+        results[index] = dict(result, sync_job_id=job.get("id"))
+    return results
+
+
+def _user_lock(user_id: Any) -> asyncio.Lock:
+    """ユーザーごとの打刻ロックを返す"""
+    lock = _user_locks.get(user_id)
+    if lock is None:
+        lock = _user_locks[user_id] = asyncio.Lock()
+    return lock
+
+
+def get_stapro_client() -> Optional[AsyncStaproAPIClient]:
+    """共有の Stapro クライアントを返す。環境変数が未設定なら None"""
+    global _stapro_client
+    if _stapro_client is not None:
+        return _stapro_client
+    stapro_url = os.getenv("STAPRO_API_URL")
+    stapro_token = os.getenv("STAPRO_API_TOKEN")
+    if not stapro_url or not stapro_token:
+        return None
+    _stapro_client = AsyncStaproAPIClient(
+        base_url=stapro_url,
+        api_token=stapro_token,
+        max_connections=int(os.getenv("STAPRO_MAX_CONNECTIONS", "100")),
+        max_keepalive_connections=int(os.getenv("STAPRO_POOL_MAXSIZE", "32")),
+        timeout=float(os.getenv("STAPRO_TIMEOUT", "10")),
+        connect_timeout=float(os.getenv("STAPRO_CONNECT_TIMEOUT", "3")),
+    )
+    return _stapro_client
 
 
 def _safe_int(v: Any) -> Optional[int]:
@@ -121,36 +564,111 @@ def _safe_int(v: Any) -> Optional[int]:
     except Exception:
         return None
 
-# --- エンドポイント ---
-@app.get("/")
-def health_check():
-    return {"status": "ok", "message": "Backend is running"}
+def _parse_timestamp(value: Any) -> Optional[datetime]:
+    """DB の ISO 形式の日時を datetime にする（タイムゾーンなしは UTC とみなす）"""
+    if isinstance(value, datetime):
+        parsed = value
+    else:
+        try:
+            parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+        except (TypeError, ValueError):
+            return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
 
-@app.post("/api/scan", response_model=ScanResponse)
-def scan_card(req: ScanRequest):
-    """カードをスキャンした時の状態判定"""
-    
-    # 1. ユーザー特定
-    user = _get_user_by_card(req.card_id)
-    if not user:
-        raise HTTPException(status_code=404, detail="未登録のカードです")
-    
-    # 2. 現在の状態を確認（出勤中か？）
-    active_log = _get_active_log(user['id'])
-    
+async def _estimate_lessons(user: UserRecord, clock_in_at: Any, until: Any = None) -> Optional[LessonEstimate]:
+    """出勤〜退勤（省略時は現在）の時間帯に重なるレッスンを推定する。推定できなければ None"""
+    started = _parse_timestamp(clock_in_at)
+    ended = _parse_timestamp(until) if until is not None else datetime.now(timezone.utc)
+    if school_catalog is None or get_stapro_client() is None or started is None or ended is None:
+        return None
+    school_id = _safe_int(user.school_id) or 1
+    try:
+        # タイムテーブルが手元にないときも打刻を待たせすぎない（取得はバックグラウンドで続く）
+        school = await asyncio.wait_for(school_catalog.get_school(school_id), LESSON_ESTIMATE_TIMEOUT)
+    except Exception as e:
+        logger.warning("lesson estimate unavailable", extra={"school_id": school_id, "error": repr(e)})
+        return None
+    if not isinstance(school, dict):
+        return None
+    return lesson_estimator.estimate(school_id, school, started, ended)
+
+def _stapro_payload(
+    user: UserRecord,
+    kind: str,
+    commuting_costs: int,
+    total_lesson: int,
+    lesson_ids: List[int],
+) -> Optional[Dict[str, Any]]:
+    """Stapro に登録する勤怠の内容。Stapro が未設定か、スタッフ ID が無ければ None"""
+    raw_staff_id = user.stapro_staff_id or user.id
+    staff_id_int = _safe_int(raw_staff_id)
+    if get_stapro_client() is None or staff_id_int is None:
+        logger.warning("skipping stapro create_attendance", extra={"kind": kind, "staff_id": raw_staff_id})
+        return None
+    return {
+        "staff_id": staff_id_int,
+        "work_day": datetime.now(lesson_estimator.tz).date().isoformat(),
+        "school_id": _safe_int(user.school_id) or 1,
+        "commuting_costs": commuting_costs,
+        "another_time": 0.0,
+        "total_lesson": total_lesson,
+        "lesson_ids": lesson_ids,
+    }
+
+async def _enqueue_stapro_sync(attendance_id: Any, kind: str, payload: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Stapro への勤怠登録をアウトボックスに積み、レスポンス用の同期状態を返す
+
+    `external_status` は queued（送信待ち）/ skipped（送らない）/ unqueued（積めなかった）。
+    """
+    if payload is None:
+        return {"external_status": "skipped", "sync_status": "skipped", "sync_job_id": None}
+    try:
+        job = await attendance_outbox.enqueue(attendance_id, kind, payload)
+    except Exception:
+        # ローカルの打刻記録は残っているので打刻自体は失敗させない
+        logger.exception("failed to enqueue stapro create_attendance", extra={"kind": kind, "attendance_id": attendance_id})
+        return {"external_status": "unqueued", "sync_status": "unqueued", "sync_job_id": None}
+    # ジョブを積む間に出勤が反映されていたら、付け替え済みの ID に揃える
+    resolved_id = attendance_journal.resolve(attendance_id)
+    if resolved_id != attendance_id:
+        await attendance_outbox.reassign(attendance_id, resolved_id)
+    outbox_worker.notify()
+    return {"external_status": "queued", "sync_status": job.get('status'), "sync_job_id": job.get('id')}
+
+async def _submit_clock_out(user_id: Any, attendance_id: int, payload: Dict[str, Any]) -> None:
+    """退勤を attendance_logs に反映したとき、Stapro への送信ジョブが無ければ積む
+
+    退勤の処理はジャーナルに追記してからジョブを積むので、その間に落ちてもここで積み直される。
+    何度呼ばれてもジョブは 1 つにする（例外はジャーナルの再試行に任せる）。
+    """
+    jobs = await attendance_outbox.for_attendance(attendance_id)
+    if any(job.get('kind') == "clock_out" for job in jobs):
+        return
+    job = await attendance_outbox.enqueue(attendance_id, "clock_out", payload)
+    logger.info("stapro create_attendance queued from journal",
+                extra={"user_id": user_id, "attendance_id": attendance_id, "sync_job_id": job.get('id')})
+    outbox_worker.notify()
+
+def _scan_payload(
+    user: UserRecord,
+    active_log: Optional[OpenShift],
+    estimate: Optional[LessonEstimate] = None,
+) -> Dict[str, Any]:
+    """スキャン結果（出勤前／出勤中）のレスポンスを組み立てる"""
     if active_log:
         # --- パターンB: 出勤中 -> 退勤画面へ誘導 ---
-        # コマ数はフロントエンドで計算して送信されるため、ここでは推定を行わない
+        # コマ数はタイムテーブルから推定した値を初期値として返す（推定できなければ 0）
         return {
             "status": "ready_to_out",
-            "user_name": user['name'],
-            "message": f"お疲れ様です、{user['name']}さん。",
-            "default_cost": user.get('default_transport_cost', 0),
-            "estimated_class_count": 0,
-            "transport_presets": user.get('transport_presets', []),
-            "attendance_id": active_log.get('id'),
-            "clock_in_at": active_log.get('clock_in_at'),
-            "stapro_staff_id": _safe_int(user.get('stapro_staff_id')) if user.get('stapro_staff_id') is not None else None,
+            "user_name": user.name,
+            "message": f"お疲れ様です、{user.name}さん。",
+            "default_cost": user.default_transport_cost,
+            "estimated_class_count": estimate.count if estimate else 0,
+            "estimated_lesson_ids": estimate.lesson_ids if estimate else [],
+            "transport_presets": user.transport_presets,
+            "attendance_id": active_log.id,
+            "clock_in_at": active_log.clock_in_at,
+            "stapro_staff_id": _safe_int(user.stapro_staff_id) if user.stapro_staff_id is not None else None,
             "external_active": False,
         }
     else:
@@ -159,38 +677,93 @@ def scan_card(req: ScanRequest):
         # `/api/clock-in` を実行したときに出勤処理を行う方針とする。
         response_payload = {
             "status": "ready_to_in",
-            "user_name": user['name'],
-            "message": f"おはようございます、{user['name']}さん。",
-            "default_cost": int(user.get('default_transport_cost', 0) or 0),
+            "user_name": user.name,
+            "message": f"おはようございます、{user.name}さん。",
+            "default_cost": user.default_transport_cost,
             "estimated_class_count": 0,
-            "transport_presets": user.get('transport_presets', []),
+            "estimated_lesson_ids": [],
+            "transport_presets": user.transport_presets,
             "attendance_id": None,
             "clock_in_at": None,
             "external_active": False,
-            "stapro_staff_id": _safe_int(user.get('stapro_staff_id')) if user.get('stapro_staff_id') is not None else None,
+            "stapro_staff_id": _safe_int(user.stapro_staff_id) if user.stapro_staff_id is not None else None,
         }
         return response_payload
 
 
-@app.post("/api/register-card")
-def register_card(req: RegisterCardRequest):
-    """新規カードを登録する。Stapro にログインしてスタッフ情報を取得し、
-    ローカル DB の `users` テーブルに `card_id` を紐付ける。
-    リクエストには Stapro のログイン情報を含める必要がある。
+async def _do_clock_in(user: UserRecord) -> Dict[str, Any]:
+    """出勤を記録する（呼び出し側で未出勤であることを確認済みとする）"""
+    # ジャーナルに追記した時点で確定とする（attendance_logs へはバックグラウンドで反映する）
+    now_iso = datetime.now(timezone.utc).isoformat()
+    entry = await attendance_journal.append_clock_in(user.id, now_iso)
+    row = {"id": entry['provisional_id'], "user_id": user.id, "clock_in_at": now_iso}
+    shift = open_shifts.opened(row)
+    journal_replayer.notify()
+    await shared_state.publish("open_shifts", {"op": "opened", "row": row})
+
+    # Stapro への勤怠作成はアウトボックスに積むだけにし、送信はワーカーが行う
+    # （上流が遅くても打刻の応答を待たせない。仮の ID は反映時に付け替えられる）
+    payload = _stapro_payload(
+        user, "clock_in", commuting_costs=int(user.default_transport_cost or 0), total_lesson=0, lesson_ids=[])
+    sync = await _enqueue_stapro_sync(shift.id, "clock_in", payload)
+
+    # attendance_id は反映までは仮の（負の）ID。退勤時にはそのまま使える
+    return {
+        "message": "出勤を記録しました",
+        "attendance_id": shift.id,
+        "clock_in_at": now_iso,
+        **sync,
+    }
+
+
+async def _do_clock_out(
+    user: UserRecord,
+    active_log: OpenShift,
+    transport_cost: int,
+    class_count: int,
+    is_auto_submit: bool = False,
+    lesson_ids: Optional[List[int]] = None,
+) -> Dict[str, Any]:
+    """退勤を記録して Stapro 連携ジョブを積む
+
+    `lesson_ids` が送られてこなければタイムテーブルから推定した値を使う。
     """
-    stapro_url = os.getenv("STAPRO_API_URL")
-    stapro_token = os.getenv("STAPRO_API_TOKEN")
-    if not stapro_url or not stapro_token:
-        raise HTTPException(status_code=500, detail="Stapro configuration missing")
+    if lesson_ids is None:
+        estimate = await _estimate_lessons(user, active_log.clock_in_at)
+        lesson_ids = estimate.lesson_ids if estimate else []
+    # 1. 退勤時間と実績をジャーナルに追記する（attendance_logs へはバックグラウンドで反映する）
+    update_data = {
+        "clock_out_at": datetime.now(timezone.utc).isoformat(),
+        "transport_cost": transport_cost,
+        "class_count": class_count,
+        "is_auto_submit": is_auto_submit
+    }
+    # Stapro へ送る内容も同じエントリーに記録し、反映時に送信ジョブの有無を確かめる（_submit_clock_out）
+    payload = _stapro_payload(
+        user, "clock_out", commuting_costs=int(transport_cost), total_lesson=int(class_count),
+        lesson_ids=(lesson_ids or []))
+    attendance_id = attendance_journal.resolve(active_log.id)
+    await attendance_journal.append_clock_out(user.id, attendance_id, update_data, sync=payload)
+    open_shifts.closed(user.id)
 
-    client = StaproAPIClient(base_url=stapro_url, api_token=stapro_token)
+    # 2. 外部システム連携（アウトボックスに積むだけにし、送信はワーカーが行う）
+    # 反映より先に積んでおけば、反映時に積み直すことはない
+    sync = await _enqueue_stapro_sync(attendance_id, "clock_out", payload)
+    if sync["external_status"] == "unqueued":
+        # ジャーナルには記録済みなので、attendance_logs への反映時に積まれる
+        sync["external_status"] = "queued"
+    journal_replayer.notify()
+    await shared_state.publish("open_shifts", {"op": "closed", "user_id": user.id})
+
+    return {
+        "message": "退勤と業務報告が完了しました",
+        "attendance_id": attendance_journal.resolve(attendance_id),
+        **sync,
+    }
 
-    # 1) Stapro にログインしてスタッフ情報を取得
-    try:
-        staff = client.authenticate(req.stapro_email, req.stapro_password)
-    except Exception as e:
-        raise HTTPException(status_code=401, detail=f"Stapro authentication failed: {e}")
 
+def _registration_payload(req: RegisterCardRequest, staff: Dict[str, Any]) -> Dict[str, Any]:
+    """Stapro のスタッフ情報と登録リクエストから `users` に書き込む内容を作る"""
     # staff は dict を想定
     staff_id = staff.get('id')
     staff_email = staff.get('email') or req.stapro_email
@@ -203,21 +776,6 @@ def register_card(req: RegisterCardRequest):
     except Exception:
         staff_name = staff_email
 
-    # 2) 既存ユーザーを検索（stapro_staff_id または email）
-    existing = None
-    try:
-        if staff_id is not None:
-            res = supabase.table('users').select('*').eq('stapro_staff_id', int(staff_id)).execute()
-            if res.data:
-                existing = res.data[0]
-        if existing is None:
-            res2 = supabase.table('users').select('*').eq('email', staff_email).execute()
-            if res2.data:
-                existing = res2.data[0]
-    except Exception:
-        # 検索エラーが起きても先に進める（insert 時に重複が起きれば DB 側で確認）
-        existing = None
-
     # Build payload from Stapro info and request — then sanitize by allowed columns
     user_payload = {
         'name': staff_name,
@@ -240,188 +798,706 @@ def register_card(req: RegisterCardRequest):
     # Supabase `users` table columns (as provided):
     # id, card_id, name, default_transport_cost, transport_presets, created_at, email
     allowed_cols = {'card_id', 'name', 'default_transport_cost', 'transport_presets', 'email', 'stapro_staff_id'}
-    sanitized_payload: Dict[str, Any] = {k: v for k, v in user_payload.items() if k in allowed_cols and v is not None}
+    return {k: v for k, v in user_payload.items() if k in allowed_cols and v is not None}
+
+
+async def _write_registered_user(card_id: str, sanitized_payload: Dict[str, Any]) -> Dict[str, Any]:
+    """登録内容を 1 件書き込む（stapro_staff_id → email の順で既存ユーザーを探す）"""
+    staff_id = sanitized_payload.get('stapro_staff_id')
+    staff_email = sanitized_payload.get('email')
+    existing = None
+    try:
+        if staff_id is not None:
+            res = await supabase.table('users').select('id').eq('stapro_staff_id', int(staff_id)).execute()
+            if res.data:
+                existing = res.data[0]
+        if existing is None:
+            res2 = await supabase.table('users').select('id').eq('email', staff_email).execute()
+            if res2.data:
+                existing = res2.data[0]
+    except Exception:
+        # 検索エラーが起きても先に進める（insert 時に重複が起きれば DB 側で確認）
+        existing = None
 
-    # 3) insert or update
+    if existing:
+        # update existing user (only allowed columns)
+        await supabase.table('users').update(sanitized_payload).eq('id', existing.get('id')).execute()
+        await _invalidate_user(card_id=card_id, user_id=existing.get('id'))
+        return {'message': '既存ユーザーを更新しました', 'user_id': existing.get('id'), 'created': False}
     try:
-        if existing:
-            # update existing user (only allowed columns)
-            supabase.table('users').update(sanitized_payload).eq('id', existing.get('id')).execute()
-            return {'message': '既存ユーザーを更新しました', 'user_id': existing.get('id'), 'created': False}
+        insert_res = await supabase.table('users').insert(sanitized_payload).execute()
+        new_id = None
+        try:
+            new_id = insert_res.data[0].get('id')
+        except Exception:
+            new_id = None
+        await _invalidate_user(card_id=card_id, user_id=new_id)
+        return {'message': 'ユーザーを作成してカードを紐付けました', 'user_id': new_id, 'created': True}
+    except Exception as ie:
+        # Handle duplicate card_id unique constraint by updating the existing row
+        msg = str(ie)
+        if 'users_card_id_key' in msg or ('duplicate key' in msg and 'card_id' in msg):
+            try:
+                existing_by_card = await supabase.table('users').select('id').eq('card_id', card_id).execute()
+                if existing_by_card.data:
+                    uid = existing_by_card.data[0].get('id')
+                    await supabase.table('users').update(sanitized_payload).eq('id', uid).execute()
+                    await _invalidate_user(card_id=card_id, user_id=uid)
+                    return {'message': '重複したカードIDの既存ユーザーを更新しました', 'user_id': uid, 'created': False}
+            except Exception:
+                # fall through to raise original
+                pass
+        # re-raise to be handled by the caller
+        raise ie
+
+
+async def _write_registered_users(items: List[tuple]) -> List[Dict[str, Any]]:
+    """認証済みの登録内容をまとめて書き込み、入力と同じ順序で行ごとの結果を返す
+
+    `items` は (ImportRow, card_id, `_registration_payload` の結果) の配列。
+    既存ユーザーは stapro_staff_id → email → card_id の順に 1 列 1 クエリで引き当て、
+    更新は upsert、新規は insert でまとめて送る。
+    """
+    staff_ids = sorted({p['stapro_staff_id'] for _, _, p in items if p.get('stapro_staff_id') is not None})
+    emails = sorted({p['email'] for _, _, p in items if p.get('email')})
+    card_ids = sorted({card_id for _, card_id, _ in items})
+    lookups: Dict[str, Dict[Any, Dict[str, Any]]] = {'stapro_staff_id': {}, 'email': {}, 'card_id': {}}
+    for column, values in (('stapro_staff_id', staff_ids), ('email', emails), ('card_id', card_ids)):
+        if values:
+            res = await supabase.table('users').select('id,card_id,email,stapro_staff_id').in_(column, values).execute()
+            lookups[column] = {row[column]: row for row in res.data or []}
+
+    results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+    updates: List[tuple] = []
+    inserts: List[tuple] = []
+    # 同じユーザー（スタッフ）を指す行が同じバッチに複数あれば、最初の行だけを書き込む
+    claimed: Dict[tuple, int] = {}
+    for i, (row, card_id, payload) in enumerate(items):
+        base = {'line': row.line, 'card_id': card_id, 'user_id': None, 'error': None}
+        existing = (
+            lookups['stapro_staff_id'].get(payload.get('stapro_staff_id'))
+            or lookups['email'].get(payload.get('email'))
+            or lookups['card_id'].get(card_id)
+        )
+        keys = [('id', existing['id'])] if existing else []
+        keys += [('staff', payload.get('stapro_staff_id')), ('email', payload.get('email'))]
+        holder = lookups['card_id'].get(card_id)
+        duplicate = next((claimed[k] for k in keys if k[1] is not None and k in claimed), None)
+        if existing and holder is not None and holder['id'] != existing['id']:
+            results[i] = dict(base, status='error', error='card_id is already assigned to another user')
+        elif duplicate is not None:
+            results[i] = dict(base, status='error', error=f'same staff as line {duplicate}')
         else:
+            for k in keys:
+                if k[1] is not None:
+                    claimed[k] = row.line
+            if existing:
+                updates.append((i, dict(payload, id=existing['id'])))
+            else:
+                inserts.append((i, payload))
+
+    for status, group in (('updated', updates), ('created', inserts)):
+        # 列の組み合わせが違う行を 1 リクエストにまとめると欠けた列が NULL になるため、組み合わせごとに送る
+        by_columns: Dict[tuple, List[tuple]] = {}
+        for i, payload in group:
+            by_columns.setdefault(tuple(sorted(payload)), []).append((i, payload))
+        for chunk in by_columns.values():
             try:
-                insert_res = supabase.table('users').insert(sanitized_payload).execute()
-                new_id = None
-                try:
-                    new_id = insert_res.data[0].get('id')
-                except Exception:
-                    new_id = None
-                return {'message': 'ユーザーを作成してカードを紐付けました', 'user_id': new_id, 'created': True}
-            except Exception as ie:
-                # Handle duplicate card_id unique constraint by updating the existing row
-                msg = str(ie)
-                if 'users_card_id_key' in msg or ('duplicate key' in msg and 'card_id' in msg):
+                if status == 'updated':
+                    res = await supabase.table('users').upsert([p for _, p in chunk], on_conflict='id').execute()
+                else:
+                    res = await supabase.table('users').insert([p for _, p in chunk]).execute()
+                data = res.data or []
+                for n, (i, payload) in enumerate(chunk):
+                    uid = payload.get('id') if status == 'updated' else (data[n].get('id') if n < len(data) else None)
+                    results[i] = {'line': items[i][0].line, 'card_id': items[i][1], 'status': status, 'user_id': uid, 'error': None}
+            except Exception as e:
+                # まとめて書けなかったときは 1 件ずつ書き直し、失敗した行だけをエラーにする
+                logger.warning("bulk user write failed, retrying row by row", extra={"rows": len(chunk), "error": repr(e)})
+                for i, payload in chunk:
+                    row, card_id, sanitized = items[i]
                     try:
-                        existing_by_card = supabase.table('users').select('*').eq('card_id', req.card_id).execute()
-                        if existing_by_card.data:
-                            uid = existing_by_card.data[0].get('id')
-                            supabase.table('users').update(sanitized_payload).eq('id', uid).execute()
-                            return {'message': '重複したカードIDの既存ユーザーを更新しました', 'user_id': uid, 'created': False}
-                    except Exception:
-                        # fall through to raise original
-                        pass
-                # re-raise to be handled by outer except
-                raise ie
+                        written = await _write_registered_user(card_id, sanitized)
+                        results[i] = {
+                            'line': row.line, 'card_id': card_id, 'user_id': written.get('user_id'), 'error': None,
+                            'status': 'created' if written.get('created') else 'updated',
+                        }
+                    except Exception as ie:
+                        results[i] = {'line': row.line, 'card_id': card_id, 'status': 'error', 'user_id': None, 'error': str(ie)}
+
+    for result in results:
+        if result and result['status'] != 'error':
+            await _invalidate_user(card_id=result['card_id'], user_id=result['user_id'])
+    return results
+
+
+async def _bulk_register(rows: List[ImportRow], max_concurrency: int, batch_size: int):
+    """一括登録の本体。行ごとの結果を 1 行 1 JSON で順次返す（最後の行は集計）"""
+    client = get_stapro_client()
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def authenticate(row: ImportRow) -> tuple:
+        if row.error is not None:
+            return row, None, None, row.error
+        try:
+            req = RegisterCardRequest(**row.data)
+        except ValidationError as e:
+            first = e.errors()[0]
+            return row, None, None, f"invalid row: {'.'.join(str(x) for x in first['loc'])}: {first['msg']}"
+        async with semaphore:
+            try:
+                staff = await client.authenticate(req.stapro_email, req.stapro_password)
+            except Exception as e:
+                return row, req, None, f"Stapro authentication failed: {e}"
+        return row, req, staff, None
+
+    def line(result: Dict[str, Any]) -> str:
+        return json.dumps(result, ensure_ascii=False) + "\n"
+
+    counts = {'created': 0, 'updated': 0, 'error': 0}
+    tasks = [asyncio.create_task(authenticate(row)) for row in rows]
+    batch: List[tuple] = []
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            row, req, staff, error = await next_done
+            if error is not None:
+                counts['error'] += 1
+                card_id = req.card_id if req is not None else (row.data or {}).get('card_id')
+                yield line({'line': row.line, 'card_id': card_id, 'status': 'error', 'user_id': None, 'error': error})
+                continue
+            batch.append((row, req.card_id, _registration_payload(req, staff)))
+            if len(batch) >= batch_size:
+                with _db_timer("register_users_batch"):
+                    written = await _write_registered_users(batch)
+                for result in written:
+                    counts[result['status']] += 1
+                    yield line(result)
+                batch = []
+        if batch:
+            with _db_timer("register_users_batch"):
+                written = await _write_registered_users(batch)
+            for result in written:
+                counts[result['status']] += 1
+                yield line(result)
+        yield line({'done': True, 'total': len(rows), **counts})
+    finally:
+        # クライアントが切断したら残りの認証は打ち切る
+        for task in tasks:
+            task.cancel()
+
+
+# --- エンドポイント ---
+@app.get("/")
+async def health_check():
+    return {"status": "ok", "message": "Backend is running"}
+
+@app.get("/healthz")
+async def healthz():
+    """生存確認（プロセスが応答できれば 200。依存先は見ない）"""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """受け付け可否（Supabase に到達でき、索引・台帳の読み込みが終わっていれば 200、それ以外は 503）
+
+    起動後も依存先への疎通を定期的に確かめており、Supabase に届かなくなれば 503 に戻る。
+    """
+    if readiness is None:
+        return ORJSONResponse({"ready": False, "checks": {}}, status_code=503)
+    report = readiness.report()
+    return ORJSONResponse(report, status_code=200 if report["ready"] else 503)
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus テキスト形式のメトリクス"""
+    return Response(REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/api/stapro/pool-stats")
+async def stapro_pool_stats():
+    """共有 Stapro クライアントの接続プール状態を返す"""
+    client = get_stapro_client()
+    if client is None:
+        return {"configured": False, "pools": []}
+    return {"configured": True, "pools": client.pool_stats()}
+
+@app.post("/api/scan", response_model=ScanResponse)
+async def scan_card(req: ScanRequest):
+    """カードをスキャンした時の状態判定"""
+    
+    # 1. ユーザー特定
+    user = await _get_user_by_card(req.card_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="未登録のカードです")
+    
+    # 2. 現在の状態を確認（出勤中か？）
+    active_log = await _get_active_log(user.id)
+    estimate = await _estimate_lessons(user, active_log.clock_in_at) if active_log else None
+    # 応答は型の揃った UserRecord / OpenShift から組み立てているので、ScanResponse（ドキュメント用）での
+    # 検証と jsonable_encoder を通さずにそのまま書き出す
+    return ORJSONResponse(_scan_payload(user, active_log, estimate))
+
+
+@app.post("/api/tap")
+async def tap(req: TapRequest):
+    """1 回のタップで状態判定と打刻をまとめて行う
+
+    - 未出勤: その場で出勤を記録する（`clocked_in`）
+    - 出勤中で `confirm` なし: 退勤待ちとして状態トークンを返す（`ready_to_out`）
+    - 出勤中で `confirm` あり: そのまま退勤を記録する（`clocked_out`）
+
+    退勤待ちで受け取ったトークンを付けて `confirm` を送ると、カード検索と出勤状態の確認を省略する。
+    """
+    state = await tap_tokens.consume(req.state_token) if req.state_token else None
+    if state is not None:
+        user = await card_index.get_by_id(state.user_id)
+    elif req.card_id:
+        user = await _get_user_by_card(req.card_id)
+    else:
+        raise HTTPException(status_code=400, detail="card_id か有効な state_token が必要です")
+    if not user:
+        raise HTTPException(status_code=404, detail="未登録のカードです")
+
+    async with _user_lock(user.id):
+        active_log = await _get_active_log(user.id)
+        if state is not None and (
+            active_log is None
+            or attendance_journal.resolve(active_log.id) != attendance_journal.resolve(state.attendance_id)
+        ):
+            # トークン発行後に別の端末で打刻された
+            raise HTTPException(status_code=409, detail="状態が変わりました。もう一度カードをタッチしてください")
+
+        if active_log is None:
+            result = await _do_clock_in(user)
+            return ORJSONResponse(dict(_scan_payload(user, None), **result, status="clocked_in"))
+
+        if req.confirm is None:
+            token = await tap_tokens.issue(user.id, user.card_id, active_log.id)
+            estimate = await _estimate_lessons(user, active_log.clock_in_at)
+            return ORJSONResponse(
+                dict(_scan_payload(user, active_log, estimate), state_token=token, expires_in=tap_tokens.ttl)
+            )
+
+        result = await _do_clock_out(
+            user,
+            active_log,
+            transport_cost=req.confirm.transport_cost,
+            class_count=req.confirm.class_count,
+            is_auto_submit=req.confirm.is_auto_submit,
+            lesson_ids=req.confirm.lesson_ids,
+        )
+        return ORJSONResponse(dict(_scan_payload(user, active_log), **result, status="clocked_out"))
+
+
+@app.post("/api/register-card")
+async def register_card(req: RegisterCardRequest):
+    """新規カードを登録する。Stapro にログインしてスタッフ情報を取得し、
+    ローカル DB の `users` テーブルに `card_id` を紐付ける。
+    リクエストには Stapro のログイン情報を含める必要がある。
+    """
+    client = get_stapro_client()
+    if client is None:
+        raise HTTPException(status_code=500, detail="Stapro configuration missing")
+
+    # 1) Stapro にログインしてスタッフ情報を取得
+    try:
+        staff = await client.authenticate(req.stapro_email, req.stapro_password)
+    except Exception as e:
+        raise HTTPException(status_code=401, detail=f"Stapro authentication failed: {e}")
+
+    # 2) 既存ユーザーを検索して insert or update
+    sanitized_payload = _registration_payload(req, staff)
+    try:
+        with _db_timer("register_user"):
+            return await _write_registered_user(req.card_id, sanitized_payload)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to write user: {e}")
 
+@app.post("/api/register-cards/bulk")
+async def register_cards_bulk(request: Request, max_concurrency: int = 8, batch_size: int = 100):
+    """カードを一括登録する（新学期のスタッフ登録用）
+
+    本文は CSV（`Content-Type: text/csv`）または JSONL で、列は `/api/register-card` と同じ。
+    Stapro へのログインは `max_concurrency` 件まで並列に行い、`users` への書き込みは
+    `batch_size` 件ごとにまとめる。行ごとの結果は NDJSON で順次返す（最後の行は集計）。
+    """
+    if get_stapro_client() is None:
+        raise HTTPException(status_code=500, detail="Stapro configuration missing")
+    body = (await request.body()).decode('utf-8-sig')
+    rows = parse_registrations(body, request.headers.get('content-type', ''))
+    if not rows:
+        raise HTTPException(status_code=400, detail="登録する行がありません")
+    return StreamingResponse(
+        _bulk_register(rows, max_concurrency=max(1, min(max_concurrency, 32)), batch_size=max(1, batch_size)),
+        media_type="application/x-ndjson",
+    )
+
 @app.post("/api/clock-in")
-def clock_in(req: ClockInRequest):
+async def clock_in(req: ClockInRequest):
     """出勤打刻"""
-    user = _get_user_by_card(req.card_id)
+    user = await _get_user_by_card(req.card_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
     # 重複チェック（既に出勤中ならエラーにするか、無視するか）
-    if _get_active_log(user['id']):
-        raise HTTPException(status_code=400, detail="既に出勤済みです")
+    async with _user_lock(user.id):
+        if await _get_active_log(user.id):
+            raise HTTPException(status_code=400, detail="既に出勤済みです")
+        return await _do_clock_in(user)
+
+@app.post("/api/clock-out")
+async def clock_out(req: ClockOutRequest):
+    """退勤打刻 + 外部連携"""
+    user = await _get_user_by_card(req.card_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
     
-    # DB登録（ローカル）
-    now_iso = datetime.now(timezone.utc).isoformat()
-    data = {
-        "user_id": user['id'],
-        "clock_in_at": now_iso
+    async with _user_lock(user.id):
+        active_log = await _get_active_log(user.id)
+        if not active_log:
+            raise HTTPException(status_code=400, detail="出勤記録が見つかりません")
+        return await _do_clock_out(
+            user,
+            active_log,
+            transport_cost=req.transport_cost,
+            class_count=req.class_count,
+            is_auto_submit=req.is_auto_submit,
+            lesson_ids=req.lesson_ids,
+        )
+
+
+@app.get("/api/sync-status/{job_id}")
+async def sync_status(job_id: int):
+    """アウトボックスに積んだ Stapro 連携ジョブの状態を返す（キオスクのポーリング用）"""
+    job = await attendance_outbox.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Sync job not found")
+    return {
+        "sync_job_id": job.get('id'),
+        "attendance_id": job.get('attendance_id'),
+        "sync_status": job.get('status'),
+        "result": job.get('result'),
+        "attempts": job.get('attempts'),
+        "last_error": job.get('last_error'),
     }
-    insert_res = supabase.table("attendance_logs").insert(data).execute()
 
-    # 可能なら Stapro に勤怠を作成する（失敗してもローカルは残す）
-    stapro_url = os.getenv("STAPRO_API_URL")
-    stapro_token = os.getenv("STAPRO_API_TOKEN")
-    external_created = False
+
+@app.post("/api/admin/schools/cache/invalidate")
+async def invalidate_school_catalog(school_id: Optional[int] = None):
+    """コマ推定に使う教室カタログのキャッシュを全ワーカーで捨てる（school_id 省略時は全件）
+
+    Stapro 側でタイムテーブルを直したときに、TTL を待たずに次の打刻から新しい内容を使わせる。
+    """
+    removed = school_catalog.invalidate(school_id)
+    await school_catalog.save_snapshot()
+    await shared_state.publish("school_catalog", {"school_id": school_id})
+    return {"invalidated": removed, "cache": school_catalog.stats()}
+
+
+@app.get("/api/admin/attendance/journal")
+async def attendance_journal_status(status: Optional[str] = None, limit: int = 100):
+    """出勤・退勤ジャーナルの状態（件数・反映の遅れ）と直近のエントリーを返す
+
+    `status=conflict` などで DB 側と食い違ったエントリーだけを確認できる。
+    """
+    return {
+        "counts": attendance_journal.counts(),
+        "lag_seconds": round(attendance_journal.lag_seconds(), 3),
+        "entries": await attendance_journal.entries(status, max(1, min(limit, 1000))),
+    }
+
+
+@app.get("/api/roster")
+async def roster(school_id: Optional[int] = None):
+    """出勤中のスタッフ一覧を教室ごとに返す（未退勤シフト台帳から作るので DB には問い合わせない）
+
+    応答の `last_event_id` を `Last-Event-ID` にして `/api/roster/stream` に接続すれば、以降の変更を漏れなく受け取れる。
+    """
+    if not open_shifts.seeded or not card_index.loaded:
+        raise HTTPException(status_code=503, detail="出勤状況の読み込み中です")
+    return _roster_payload(school_id)
+
+
+async def _roster_events(school_id: Optional[int], last_event_id: Optional[int]) -> Any:
+    subscription = roster_feed.subscribe()
     try:
-        # prefer stapro_staff_id saved in users; fallback to other fields
-        raw_staff_id = user.get('stapro_staff_id') or user.get('staff_id') or user.get('id')
-        staff_id_int = _safe_int(raw_staff_id)
-        school_raw = user.get('stapro_school_id') or user.get('default_school_id') or 1
-        school_id_int = _safe_int(school_raw) or 1
-        commuting_costs = int(user.get('default_transport_cost', 0) or 0)
-
-        if stapro_url and stapro_token and staff_id_int is not None:
-            client = StaproAPIClient(base_url=stapro_url, api_token=stapro_token)
-            work_day = date.today().isoformat()
-            try:
-                client.create_attendance(
-                    staff_id=staff_id_int,
-                    work_day=work_day,
-                    school_id=int(school_id_int),
-                    commuting_costs=commuting_costs,
-                    another_time=0.0,
-                    total_lesson=0,
-                    lesson_ids=[],
-                )
-                external_created = True
-            except requests.exceptions.HTTPError as e:
-                # If Stapro returns 422 for duplicate work_day, treat as already-created and continue
-                resp = getattr(e, 'response', None)
-                status = getattr(resp, 'status_code', None)
-                body = ''
-                try:
-                    body = resp.text if resp is not None else ''
-                except Exception:
-                    body = str(e)
-
-                if status == 422:
-                    print(f"Stapro create_attendance returned 422 on clock-in (possibly already exists): {body}")
-                    external_created = True
-                else:
-                    print(f"Stapro create_attendance failed on clock-in: {e}")
-            except Exception as e:
-                print(f"Stapro create_attendance failed on clock-in: {e}")
+        # 購読を始めてから一覧を作るので、一覧とイベントの間に取りこぼしは無い
+        backlog = roster_feed.since(last_event_id) if last_event_id is not None else None
+        yield b"retry: 3000\n\n"
+        if backlog is None:
+            yield sse_frame(roster_feed.last_id, "snapshot", _roster_payload(school_id))
         else:
-            print(f"Skipping Stapro create_attendance on clock-in: invalid staff_id={raw_staff_id}")
-    except Exception as e:
-        print(f"Stapro create_attendance failed on clock-in: {e}")
+            for event in backlog:
+                if school_id is None or event.school_id == school_id:
+                    yield event.frame
+        while True:
+            try:
+                event = await subscription.get(ROSTER_HEARTBEAT)
+            except asyncio.TimeoutError:
+                # プロキシに接続を切られないよう、イベントが無くても定期的に送る
+                yield b": ping\n\n"
+                continue
+            if event is None:
+                return
+            if event is RESYNC:
+                yield sse_frame(roster_feed.last_id, "snapshot", _roster_payload(school_id))
+            elif school_id is None or event.school_id == school_id:
+                yield event.frame
+    finally:
+        roster_feed.unsubscribe(subscription)
 
-    # レスポンスに挿入結果を含める
-    resp = {"message": "出勤を記録しました", "external_created": external_created}
-    try:
-        resp['attendance_id'] = insert_res.data[0].get('id')
-        resp['clock_in_at'] = insert_res.data[0].get('clock_in_at')
-    except Exception:
-        resp['attendance_id'] = None
-        resp['clock_in_at'] = now_iso
 
-    return resp
+@app.get("/api/roster/stream")
+async def roster_stream(request: Request, school_id: Optional[int] = None):
+    """出勤・退勤を Server-Sent Events で配信する（最初に一覧を `snapshot` イベントで送る）
 
-@app.post("/api/clock-out")
-def clock_out(req: ClockOutRequest):
-    """退勤打刻 + 外部連携"""
-    user = _get_user_by_card(req.card_id)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    active_log = _get_active_log(user['id'])
-    if not active_log:
-        raise HTTPException(status_code=400, detail="出勤記録が見つかりません")
-    
-    # 1. DB更新 (退勤時間と実績を入力)
-    update_data = {
-        "clock_out_at": datetime.now(timezone.utc).isoformat(),
-        "transport_cost": req.transport_cost,
-        "class_count": req.class_count,
-        "is_auto_submit": req.is_auto_submit
-    }
-    
-    supabase.table("attendance_logs")\
-        .update(update_data)\
-        .eq("id", active_log['id'])\
+    イベントは `clock_in` / `clock_out` / `updated`（勤怠 ID の付け替え）で、data はロスターの 1 行。
+    再接続時は `Last-Event-ID` を送れば、保持している範囲の続きから配信する。
+    """
+    if not open_shifts.seeded or not card_index.loaded:
+        raise HTTPException(status_code=503, detail="出勤状況の読み込み中です")
+    last_event_id = _safe_int(request.headers.get("last-event-id"))
+    return StreamingResponse(
+        _roster_events(school_id, last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/api/reports/monthly")
+async def monthly_report(month: Optional[str] = None, user_id: Optional[int] = None):
+    """ユーザーごとの月次集計（勤務時間・交通費・コマ数）を返す（`month` は YYYY-MM。省略時は当月）
+
+    締めた月は集計テーブルを読むだけで返す。当月は attendance_logs をその場で集計する（`source: live`）。
+    """
+    month = month or payroll_rollups.current_month()
+    if not valid_month(month):
+        raise HTTPException(status_code=400, detail="month は YYYY-MM で指定してください")
+    with _db_timer("monthly_report"):
+        return await payroll_rollups.monthly(month, user_id=user_id)
+
+
+@app.post("/api/admin/reports/backfill")
+async def backfill_monthly_reports(since: Optional[str] = None):
+    """attendance_logs から月次集計を作り直す（`since`（YYYY-MM）以降。省略時は全期間）
+
+    退勤時の集計更新に失敗した月や、DB を直接直した月の修復に使う。
+    """
+    if since is not None and not valid_month(since):
+        raise HTTPException(status_code=400, detail="since は YYYY-MM で指定してください")
+    with _db_timer("backfill_monthly_reports"):
+        return await payroll_rollups.backfill(since)
+
+
+EXPORT_COLUMNS = (
+    "id", "user_id", "user_name", "school_id", "clock_in_at", "clock_out_at",
+    "transport_cost", "class_count", "is_auto_submit",
+)
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "1000"))
+# 教室で絞り込むときに 1 回の問い合わせの `in_` に入れるユーザーIDの上限（URL が長くなりすぎないように）
+EXPORT_USER_CHUNK = int(os.getenv("EXPORT_USER_CHUNK", "200"))
+
+
+async def _export_rows(
+    since: Optional[str], until: Optional[str], user_ids: Optional[List[Any]],
+) -> Any:
+    """attendance_logs を ID のキーセットで 1 ページずつ読み、ユーザー名と教室を付けて返す
+
+    `user_ids` が多いときは `EXPORT_USER_CHUNK` 人ずつに分けて読む（行は分けた単位ごとに ID 順になる）。
+    ユーザーはページごとに索引に無い分だけをまとめて引き、見つからなかったユーザーも書き出しの間は覚えておく。
+    """
+    if user_ids is not None and not user_ids:
+        return
+    chunks = [None] if user_ids is None else [
+        user_ids[start:start + EXPORT_USER_CHUNK] for start in range(0, len(user_ids), EXPORT_USER_CHUNK)
+    ]
+    # このエクスポートで引いたユーザー（見つからなかったユーザーは None）
+    users: Dict[Any, Optional[UserRecord]] = {}
+    # 最初のページは小さくして、先頭の行をすぐに送り始める
+    page_size = min(100, EXPORT_PAGE_SIZE)
+    for chunk in chunks:
+        last_id = None
+        while True:
+            query = supabase.table("attendance_logs")\
+                .select("id,user_id,clock_in_at,clock_out_at,transport_cost,class_count,is_auto_submit")
+            if since is not None:
+                query = query.gte("clock_in_at", since)
+            if until is not None:
+                query = query.lt("clock_in_at", until)
+            if chunk is not None:
+                query = query.in_("user_id", chunk)
+            if last_id is not None:
+                query = query.gt("id", last_id)
+            with _db_timer("export_attendance_page"):
+                res = await query.order("id").limit(page_size).execute()
+            rows = res.data or []
+            unknown = {row.get("user_id") for row in rows} - users.keys()
+            if unknown:
+                found = await card_index.get_many(unknown)
+                users.update({user_id: found.get(user_id) for user_id in unknown})
+            page = []
+            for row in rows:
+                user = users[row.get("user_id")]
+                page.append(dict(
+                    row,
+                    user_name=user.name if user else None,
+                    school_id=(_safe_int(user.school_id) or 1) if user else None,
+                ))
+            if page:
+                yield page
+            if len(rows) < page_size:
+                break
+            last_id = rows[-1]["id"]
+            page_size = EXPORT_PAGE_SIZE
+
+
+async def _export_csv(pages: Any) -> Any:
+    # Excel で文字化けしないよう BOM を付け、見出しはすぐに送る
+    yield ("\ufeff" + ",".join(EXPORT_COLUMNS) + "\r\n").encode("utf-8")
+    async for page in pages:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in page:
+            writer.writerow(["" if row.get(col) is None else row.get(col) for col in EXPORT_COLUMNS])
+        yield buffer.getvalue().encode("utf-8")
+
+
+async def _export_jsonl(pages: Any) -> Any:
+    async for page in pages:
+        yield b"".join(orjson.dumps({col: row.get(col) for col in EXPORT_COLUMNS}) + b"\n" for row in page)
+
+
+@app.get("/api/export/attendance")
+async def export_attendance(
+    format: str = "csv",
+    date_from: Optional[date] = Query(None, alias="from"),
+    date_to: Optional[date] = Query(None, alias="to"),
+    school_id: Optional[int] = None,
+):
+    """勤怠（attendance_logs）を CSV または JSONL で書き出す
+
+    `from` / `to`（両端を含む。出勤日の現地日付）と `school_id` で絞り込める。
+    ID のキーセットで 1 ページずつ読みながら送るので、期間が長くてもメモリ使用量は 1 ページ分で済む。
+    """
+    if format not in ("csv", "jsonl"):
+        raise HTTPException(status_code=400, detail="format は csv か jsonl を指定してください")
+    tz = lesson_estimator.tz
+    since = datetime.combine(date_from, dt_time.min, tz).astimezone(timezone.utc).isoformat() if date_from else None
+    until = (
+        datetime.combine(date_to + timedelta(days=1), dt_time.min, tz).astimezone(timezone.utc).isoformat()
+        if date_to else None
+    )
+    user_ids = None
+    if school_id is not None:
+        if not card_index.loaded:
+            raise HTTPException(status_code=503, detail="ユーザー索引の読み込み中です")
+        user_ids = [user.id for user in card_index.records() if (_safe_int(user.school_id) or 1) == school_id]
+
+    pages = _export_rows(since, until, user_ids)
+    name = f"attendance_{date_from or 'all'}_{date_to or 'all'}"
+    if format == "csv":
+        body, media_type, name = _export_csv(pages), "text/csv; charset=utf-8", name + ".csv"
+    else:
+        body, media_type, name = _export_jsonl(pages), "application/x-ndjson", name + ".jsonl"
+    return StreamingResponse(body, media_type=media_type, headers={"Content-Disposition": f'attachment; filename="{name}"'})
+
+
+@app.post("/api/admin/attendance/reconcile")
+async def reconcile_attendance(req: AttendanceReconcileRequest):
+    """attendance_logs と Stapro の勤怠を勤務日ごとに突き合わせ、食い違いを返す
+
+    期間を省略すると前回確認した日の少し前から昨日までを確認する（夜間の定期実行用）。
+    `repair: true` なら Stapro に無い勤務日をアウトボックス経由で登録し直す。
+    """
+    if get_stapro_client() is None:
+        raise HTTPException(status_code=500, detail="Stapro configuration missing")
+    if attendance_reconciler.running:
+        raise HTTPException(status_code=409, detail="突き合わせを実行中です")
+    if req.since is not None and req.until is not None and req.since > req.until:
+        raise HTTPException(status_code=400, detail="since は until 以前の日付を指定してください")
+    return await attendance_reconciler.run(
+        since=req.since,
+        until=req.until,
+        repair=req.repair,
+        max_concurrency=max(1, min(req.max_concurrency, 64)),
+        submit=_resubmit_attendances,
+        limit=max(0, min(req.limit, 10000)),
+    )
+
+
+@app.post("/api/admin/attendance/flush")
+async def flush_attendance(req: AttendanceFlushRequest):
+    """退勤済みで Stapro 未連携の勤怠をまとめて送信する（閉店時の一括送信用）
+
+    指定日（と教室）の退勤済み `attendance_logs` のうち、連携済みでないものを
+    アウトボックスのジョブとして同時実行数を制限しながら送信し、行ごとの結果を返す。
+    """
+    if get_stapro_client() is None:
+        raise HTTPException(status_code=500, detail="Stapro configuration missing")
+
+    # 勤務日は教室のタイムゾーンで区切る（サーバーのタイムゾーンに依存させない）
+    tz = lesson_estimator.tz
+    work_day = req.work_day or datetime.now(tz).date()
+    day_start = datetime.combine(work_day, dt_time.min, tz).astimezone(timezone.utc)
+    day_end = datetime.combine(work_day + timedelta(days=1), dt_time.min, tz).astimezone(timezone.utc)
+    res = await supabase.table("attendance_logs")\
+        .select("id,user_id,clock_in_at,clock_out_at,transport_cost,class_count")\
+        .gte("clock_in_at", day_start.isoformat())\
+        .lt("clock_in_at", day_end.isoformat())\
+        .not_.is_("clock_out_at", "null")\
+        .order("id")\
         .execute()
-    
-    # 2. 外部システム連携
-    # ここでエラーが起きてもDBの退勤記録は残るようにしている
-    external_created = False
-    try:
-        stapro_url = os.getenv("STAPRO_API_URL")
-        stapro_token = os.getenv("STAPRO_API_TOKEN")
+    logs = res.data or []
+    jobs_by_log = await attendance_outbox.for_attendances([log['id'] for log in logs])
 
-        raw_staff_id = user.get('stapro_staff_id') or user.get('staff_id') or user.get('id')
-        staff_id_int = _safe_int(raw_staff_id)
-        school_raw = user.get('stapro_school_id') or user.get('default_school_id') or 1
-        school_id_int = _safe_int(school_raw) or 1
+    results: List[Dict[str, Any]] = []
+    pending: List[tuple] = []
+    for log in logs:
+        row: Dict[str, Any] = {"attendance_id": log['id'], "user_id": log['user_id'], "sync_job_id": None, "error": None}
+        user = await card_index.get_by_id(log['user_id'])
+        if user is None:
+            results.append(dict(row, status="skipped", error="user not found"))
+            continue
+        school_id = _safe_int(user.school_id) or 1
+        if req.school_id is not None and school_id != req.school_id:
+            continue
 
-        if stapro_url and stapro_token and staff_id_int is not None:
-            client = StaproAPIClient(base_url=stapro_url, api_token=stapro_token)
-            work_day = date.today().isoformat()
-            try:
-                client.create_attendance(
-                    staff_id=staff_id_int,
-                    work_day=work_day,
-                    school_id=int(school_id_int),
-                    commuting_costs=int(req.transport_cost),
-                    another_time=0.0,
-                    total_lesson=int(req.class_count),
-                    lesson_ids=(req.lesson_ids or []),
-                )
-                external_created = True
-            except requests.exceptions.HTTPError as e:
-                resp = getattr(e, 'response', None)
-                status = getattr(resp, 'status_code', None)
-                body = ''
-                try:
-                    body = resp.text if resp is not None else ''
-                except Exception:
-                    body = str(e)
-
-                if status == 422:
-                    print(f"Stapro create_attendance returned 422 on clock-out (possibly already exists): {body}")
-                    external_created = True
-                else:
-                    print(f"Stapro create_attendance failed on clock-out: {e}")
-            except Exception as e:
-                print(f"Stapro create_attendance failed on clock-out: {e}")
-        else:
-            print(f"Skipping Stapro create_attendance on clock-out: invalid staff_id={raw_staff_id}")
-    except Exception as e:
-        print(f"Stapro create_attendance failed on clock-out: {e}")
+        jobs = [job for job in jobs_by_log.get(log['id'], []) if job.get('kind') == "clock_out"]
+        done = next((job for job in jobs if job.get('status') == STATUS_DONE), None)
+        if done is not None:
+            results.append(dict(row, status="already_synced", sync_job_id=done.get('id')))
+            continue
 
-    return {"message": "退勤と業務報告が完了しました", "external_created": external_created}
\ No newline at end of file
+        staff_id_int = _safe_int(user.stapro_staff_id or user.id)
+        if staff_id_int is None:
+            results.append(dict(row, status="skipped", error="invalid staff_id"))
+            continue
+
+        job = jobs[-1] if jobs else None
+        if job is None or job.get('status') == STATUS_FAILED:
+            # アウトボックスに無い（または諦めた）退勤はログの内容からジョブを作り直す
+            estimate = None
+            if job is None:
+                estimate = await _estimate_lessons(user, log.get('clock_in_at'), log.get('clock_out_at'))
+            payload = job['payload'] if job is not None else {
+                "staff_id": staff_id_int,
+                "work_day": work_day.isoformat(),
+                "school_id": school_id,
+                "commuting_costs": int(log.get('transport_cost') or 0),
+                "another_time": 0.0,
+                "total_lesson": int(log.get('class_count') or 0),
+                "lesson_ids": estimate.lesson_ids if estimate else [],
+            }
+            job = await attendance_outbox.enqueue(log['id'], "clock_out", payload)
+        pending.append((row, job))
+
+    flushed = await outbox_worker.flush([job for _, job in pending], max_concurrency=max(1, min(req.max_concurrency, 64)))
+    for (row, job), result in zip(pending, flushed):
+        results.append(dict(row, status=result['status'], sync_job_id=job.get('id'), error=result.get('error')))
+
+    return {
+        "work_day": work_day.isoformat(),
+        "school_id": req.school_id,
+        "total": len(results),
+        "submitted": len(pending),
+        "results": results,
+    }
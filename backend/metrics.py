@@ -0,0 +1,348 @@
+"""
+Prometheus テキスト形式のメトリクス
+
+外部ライブラリを使わずに、カウンター・ゲージ・ヒストグラムと、スクレイプ時に値を読む
+コールバック型のメトリクスを提供する。記録は 1 回あたりロック 1 回と二分探索だけなので、
+リクエストごとに記録しても負荷はほぼ無視できる。
+
+使用方法:
+    from metrics import REGISTRY
+
+    QUERY_SECONDS = REGISTRY.histogram('supabase_query_duration_seconds', 'Supabase クエリの所要時間', ['helper'])
+    with QUERY_SECONDS.time(helper='get_active_log'):
+        ...
+
+    REGISTRY.callback('card_index_users', 'カード索引のユーザー数', 'gauge', lambda: [({}, len(card_index))])
+    text = REGISTRY.render()
+"""
+
+import bisect
+import contextvars
+import functools
+import inspect
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_INF_LABEL = 'le="+Inf"'
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# 実行中の上流 API 操作名（低レベルの送信処理がステータスコードを記録するときのラベルに使う）
+current_operation: contextvars.ContextVar[str] = contextvars.ContextVar('current_operation', default='unknown')
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, '')) for n in self.labelnames)
+
+    def _header(self) -> List[str]:
+        return [f'# HELP {self.name} {_escape(self.help)}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(_Metric):
+    """単調増加するカウンター"""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return self._header() + [
+            f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}' for key, v in items
+        ]
+
+
+class Gauge(Counter):
+    """任意の値を設定できるゲージ"""
+
+    kind = 'gauge'
+
+    def set(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def dec(self, amount: float = 1.0, **labels: Any) -> None:
+        self.inc(-amount, **labels)
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram: 'Histogram', labels: Dict[str, Any]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self) -> '_Timer':
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+class Histogram(_Metric):
+    """累積バケットのヒストグラム"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # ラベルごとに [バケットごとの件数..., 合計, 件数]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0.0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                row[index] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    def time(self, **labels: Any) -> _Timer:
+        """`with` ブロックの所要時間を記録する"""
+        return _Timer(self, labels)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = [(key, list(row)) for key, row in self._values.items()]
+        lines = self._header()
+        for key, row in items:
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, row):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {_format_value(cumulative)}')
+            lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, _INF_LABEL)} {_format_value(row[-1])}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(row[-2])}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {_format_value(row[-1])}')
+        return lines
+
+
+class CallbackMetric(_Metric):
+    """スクレイプ時に `fn` を呼んで値を読むメトリクス（ゲージやキャッシュの統計用）
+
+    `fn` は (ラベルの dict, 値) の組を返す。
+    """
+
+    def __init__(self, name: str, help: str, kind: str, fn: Callable[[], Iterable[Tuple[Dict[str, Any], float]]]):
+        super().__init__(name, help)
+        self.kind = kind
+        self.fn = fn
+
+    def render(self) -> List[str]:
+        try:
+            samples = list(self.fn())
+        except Exception:
+            # 読めない値は出さない（スクレイプ全体は失敗させない）
+            return []
+        lines = self._header()
+        for labels, value in samples:
+            names = tuple(labels)
+            values = tuple(str(labels[n]) for n in names)
+            lines.append(f'{self.name}{_format_labels(names, values)} {_format_value(value)}')
+        return lines
+
+
+class Registry:
+    """メトリクスの登録先。同じ名前で登録し直すと既存のものを返す（コールバックは置き換える）"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls: type, name: str, *args: Any, **kwargs: Any) -> Any:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f'metric {name} is already registered as {metric.kind}')
+            return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, help, labelnames)
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, help, labelnames)
+
+    def histogram(
+        self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self._get_or_create(Histogram, name, help, labelnames, buckets=buckets)
+
+    def callback(
+        self, name: str, help: str, kind: str, fn: Callable[[], Iterable[Tuple[Dict[str, Any], float]]]
+    ) -> CallbackMetric:
+        metric = CallbackMetric(name, help, kind, fn)
+        with self._lock:
+            self._metrics[name] = metric
+        return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines: List[str] = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def timed_operation(histogram: Histogram, label: str = 'method') -> Callable[[Callable], Callable]:
+    """メソッドの所要時間を `label=<メソッド名>` で記録し、実行中は `current_operation` に名前を入れるデコレーター
+
+    同期関数・コルーチン関数のどちらにも使える。
+    """
+    def decorator(fn: Callable) -> Callable:
+        name = fn.__name__
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+                token = current_operation.set(name)
+                started = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - started, **{label: name})
+                    current_operation.reset(token)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            token = current_operation.set(name)
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, **{label: name})
+                current_operation.reset(token)
+        return wrapper
+
+    return decorator
+
+
+class MetricsMiddleware:
+    """ルートごとのリクエスト所要時間を記録する ASGI ミドルウェア
+
+    ラベルの `route` はパスのテンプレート（例: `/staffs/{staff_id}`）にして、系列数が増えすぎないようにする。
+    """
+
+    def __init__(self, app: Any, app_name: str, registry: Optional[Registry] = None):
+        self.app = app
+        self.app_name = app_name
+        self.histogram = (registry or REGISTRY).histogram(
+            'http_request_duration_seconds',
+            'HTTP リクエストの所要時間（ルート別）',
+            ['app', 'method', 'route', 'status'],
+        )
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        status = {'code': 500}
+
+        async def send_wrapper(message: Dict[str, Any]) -> None:
+            if message['type'] == 'http.response.start':
+                status['code'] = message['status']
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get('route')
+            self.histogram.observe(
+                time.perf_counter() - started,
+                app=self.app_name,
+                method=scope.get('method', ''),
+                route=getattr(route, 'path', None) or 'unmatched',
+                status=status['code'],
+            )
+
+
+def watch_stapro_pool(get_client: Callable[[], Any], app_name: str, registry: Optional[Registry] = None) -> None:
+    """共有 Stapro クライアント（非同期版）の接続数をゲージとして公開する"""
+    def samples() -> List[Tuple[Dict[str, Any], float]]:
+        client = get_client()
+        if client is None:
+            return []
+        out = []
+        for pool in client.pool_stats():
+            out.append(({'app': app_name, 'state': 'open'}, pool['connections']))
+            out.append(({'app': app_name, 'state': 'idle'}, pool['idle']))
+        return out
+
+    (registry or REGISTRY).callback(
+        'stapro_pool_connections', 'Stapro クライアントの接続数（open: 保持中, idle: 待機中）', 'gauge', samples)
+
+
+def watch_school_catalog(get_catalog: Callable[[], Any], app_name: str, registry: Optional[Registry] = None) -> None:
+    """教室カタログの件数とヒット率を公開する"""
+    registry = registry or REGISTRY
+
+    def entries() -> List[Tuple[Dict[str, Any], float]]:
+        catalog = get_catalog()
+        return [({'app': app_name}, catalog.stats()['entries'])] if catalog is not None else []
+
+    def lookups() -> List[Tuple[Dict[str, Any], float]]:
+        catalog = get_catalog()
+        if catalog is None:
+            return []
+        stats = catalog.stats()
+        return [
+            ({'app': app_name, 'result': result}, stats[key])
+            for result, key in (('hit', 'hits'), ('stale', 'stale_hits'), ('miss', 'misses'))
+        ]
+
+    registry.callback('school_catalog_entries', '教室カタログのキャッシュ件数', 'gauge', entries)
+    registry.callback('school_catalog_lookups_total', '教室カタログの参照数（hit / stale / miss）', 'counter', lookups)
@@ -0,0 +1,220 @@
+"""
+出勤中（未退勤）シフトのインメモリ台帳
+
+`attendance_logs` の `clock_out_at IS NULL` の行をユーザーIDごとに保持する。
+起動時にサーバー側で絞り込んだ 1 クエリで読み込み、以降は出勤・退勤処理が直接更新する。
+DB との突き合わせは台帳が古くなったとき（`verify_after` 秒経過）にだけ行う。
+
+使用方法:
+    from open_shifts import OpenShiftRegistry
+
+    open_shifts = OpenShiftRegistry(supabase)  # supabase は AsyncClient
+    await open_shifts.seed()
+
+    shift = await open_shifts.get(user_id)
+    if shift:
+        print(shift.id, shift.clock_in_at)
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+SHIFT_COLUMNS = 'id,user_id,clock_in_at'
+
+
+class OpenShift:
+    """未退勤の勤怠ログ 1 件"""
+
+    __slots__ = ('id', 'user_id', 'clock_in_at')
+
+    def __init__(self, id: Any, user_id: Any, clock_in_at: Optional[str]):
+        self.id = id
+        self.user_id = user_id
+        self.clock_in_at = clock_in_at
+
+    @classmethod
+    def from_row(cls, row: Dict[str, Any]) -> 'OpenShift':
+        return cls(row.get('id'), row.get('user_id'), row.get('clock_in_at'))
+
+    def __repr__(self) -> str:
+        return f"OpenShift(id={self.id!r}, user_id={self.user_id!r}, clock_in_at={self.clock_in_at!r})"
+
+
+class OpenShiftRegistry:
+    """ユーザーID → 未退勤シフトの台帳
+
+    - `seed()` で `clock_out_at IS NULL` の行を一括で読み込む
+    - `opened()` / `closed()` で出勤・退勤処理の結果をそのまま反映する
+    - `get()` は台帳を引くだけ。`verify_after` 秒を過ぎていればバックグラウンドで読み直す
+    - `overlay` を渡すと、DB にまだ反映されていない打刻（ユーザーID → 出勤中の行 / 退勤済みなら None）を
+      読み直しの結果より優先する
+    - `on_change` を渡すと、台帳の内容が変わるたびに `on_change(user_id, 変更前, 変更後)` を呼ぶ
+      （出勤なら変更前が None、退勤なら変更後が None。読み直しで DB 側に揃えた分も含む）
+    """
+
+    def __init__(
+        self,
+        supabase: Any,
+        table: str = 'attendance_logs',
+        verify_after: float = 60.0,
+        overlay: Optional[Callable[[], Dict[Any, Optional[Dict[str, Any]]]]] = None,
+        on_change: Optional[Callable[[Any, Optional[OpenShift], Optional[OpenShift]], None]] = None,
+    ):
+        self.supabase = supabase
+        self.table = table
+        self.verify_after = verify_after
+        self.overlay = overlay
+        self.on_change = on_change
+
+        self._shifts: Dict[Any, OpenShift] = {}
+        # プロセス内で出勤・退勤を反映した時刻（読み直し中の書き込みを上書きしないため）
+        self._touched: Dict[Any, float] = {}
+        self._seed_task: Optional[asyncio.Task] = None
+        self._seeded_at = 0.0
+        self._next_seed_at = 0.0
+
+    # ========================================
+    # 読み込み
+    # ========================================
+
+    def _query_open(self):
+        # clock_out_at は退勤時に ISO 文字列で書き込むため、未退勤は NULL のみを対象にする
+        return self.supabase.table(self.table)\
+            .select(SHIFT_COLUMNS)\
+            .is_('clock_out_at', 'null')
+
+    async def seed(self) -> int:
+        """未退勤シフトを全件読み込み直す。読み込んだ件数を返す"""
+        started = time.monotonic()
+        res = await self._query_open().order('id').execute()
+        self._replace(res.data or [], started)
+        self._next_seed_at = started + self.verify_after
+        return len(self._shifts)
+
+    def _replace(self, rows: Iterable[Dict[str, Any]], started: float) -> None:
+        shifts: Dict[Any, OpenShift] = {}
+        for row in rows:
+            # id 昇順なので同じユーザーの複数行は最新のものが残る
+            shift = OpenShift.from_row(row)
+            shifts[shift.user_id] = shift
+        # 読み込み中にこのプロセスが反映した出勤・退勤は台帳側を正とする
+        for user_id, touched in self._touched.items():
+            if touched >= started:
+                current = self._shifts.get(user_id)
+                if current is None:
+                    shifts.pop(user_id, None)
+                else:
+                    shifts[user_id] = current
+        self._apply_overlay(shifts)
+        previous, self._shifts = self._shifts, shifts
+        # 最初の読み込みは変更ではないので通知しない
+        if self.on_change is not None and self.seeded:
+            for user_id, shift in previous.items():
+                if user_id not in shifts:
+                    self._changed(user_id, shift, None)
+            for user_id, shift in shifts.items():
+                old = previous.get(user_id)
+                if old is None or old.id != shift.id:
+                    self._changed(user_id, old, shift)
+        self._touched = {u: t for u, t in self._touched.items() if t >= started}
+        self._seeded_at = started
+
+    def _apply_overlay(self, shifts: Dict[Any, OpenShift]) -> None:
+        if self.overlay is None:
+            return
+        for user_id, row in self.overlay().items():
+            if row is None:
+                shifts.pop(user_id, None)
+            else:
+                shifts[user_id] = OpenShift.from_row(row)
+
+    def _changed(self, user_id: Any, old: Optional[OpenShift], new: Optional[OpenShift]) -> None:
+        if self.on_change is None:
+            return
+        try:
+            self.on_change(user_id, old, new)
+        except Exception:
+            logger.exception("open shift on_change failed", extra={'user_id': user_id})
+
+    def _set(self, user_id: Any, shift: Optional[OpenShift]) -> None:
+        """ユーザーのシフトを置き換え、変わっていれば `on_change` を呼ぶ"""
+        old = self._shifts.pop(user_id, None) if shift is None else self._shifts.get(user_id)
+        if shift is not None:
+            self._shifts[user_id] = shift
+        if (old is None) != (shift is None) or (old is not None and old.id != shift.id):
+            self._changed(user_id, old, shift)
+
+    async def _load_user(self, user_id: Any) -> Optional[OpenShift]:
+        pending = self.overlay() if self.overlay is not None else {}
+        if user_id in pending:
+            row = pending[user_id]
+            shift = OpenShift.from_row(row) if row is not None else None
+            self._set(user_id, shift)
+            return shift
+        res = await self._query_open().eq('user_id', user_id).order('id', desc=True).limit(1).execute()
+        shift = OpenShift.from_row(res.data[0]) if res.data else None
+        self._set(user_id, shift)
+        return shift
+
+    async def _background_seed(self) -> None:
+        try:
+            await self.seed()
+        except Exception as e:
+            # 読み直しに失敗しても手元の台帳で応答を続ける（次の間隔で再試行）
+            logger.warning("open shift registry reseed failed", extra={'error': repr(e)})
+
+    def _maybe_reseed(self) -> None:
+        now = time.monotonic()
+        if now < self._next_seed_at:
+            return
+        if self._seed_task is not None and not self._seed_task.done():
+            return
+        self._next_seed_at = now + self.verify_after
+        self._seed_task = asyncio.create_task(self._background_seed())
+
+    # ========================================
+    # 参照・更新
+    # ========================================
+
+    @property
+    def seeded(self) -> bool:
+        return self._seeded_at > 0.0
+
+    async def get(self, user_id: Any) -> Optional[OpenShift]:
+        """ユーザーの未退勤シフトを返す。出勤していなければ None"""
+        self._maybe_reseed()
+        if not self.seeded:
+            # 一度も読み込めていない場合はユーザー単位で DB を確認する
+            return await self._load_user(user_id)
+        return self._shifts.get(user_id)
+
+    def opened(self, row: Dict[str, Any]) -> OpenShift:
+        """出勤で挿入した `attendance_logs` の行を台帳に反映する"""
+        shift = OpenShift.from_row(row)
+        self._set(shift.user_id, shift)
+        self._touched[shift.user_id] = time.monotonic()
+        return shift
+
+    def closed(self, user_id: Any) -> None:
+        """退勤したユーザーを台帳から外す"""
+        self._set(user_id, None)
+        self._touched[user_id] = time.monotonic()
+
+    def rekey(self, user_id: Any, old_id: Any, new_id: Any) -> None:
+        """仮の ID で載せたシフトを、DB に反映された行の ID に付け替える"""
+        shift = self._shifts.get(user_id)
+        if shift is not None and shift.id == old_id:
+            # 付け替え前の内容を通知できるよう、新しいオブジェクトに置き換える
+            self._set(user_id, OpenShift(new_id, shift.user_id, shift.clock_in_at))
+
+    def snapshot(self) -> List[OpenShift]:
+        """台帳にある未退勤シフトの一覧"""
+        return list(self._shifts.values())
+
+    def __len__(self) -> int:
+        return len(self._shifts)
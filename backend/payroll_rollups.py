@@ -0,0 +1,258 @@
+"""
+月次の給与集計（ユーザー × 月）
+
+`attendance_logs` の退勤済みの行から、ユーザーごと・月ごとの勤務時間・交通費・コマ数を
+`attendance_monthly_rollups` テーブルに集計しておく。締めた月のレポートは集計行を読むだけで済む。
+
+- 退勤が `attendance_logs` に反映されるたびに、そのユーザーのその月だけを集計し直す（`record_clock_out`）
+- `backfill()` は `attendance_logs` を ID 順に読み、全期間（または指定した月以降）の集計を作り直す
+- 当月（締めていない月）のレポートは `attendance_logs` をその場で集計する
+- 月は出勤時刻の現地時間で決める
+
+`attendance_monthly_rollups` テーブルの列（主キーは (user_id, month)）:
+    user_id (bigint), month (text, YYYY-MM), shifts (int), worked_seconds (bigint),
+    transport_cost (bigint), class_count (bigint), updated_at (timestamptz)
+
+使用方法:
+    from payroll_rollups import PayrollRollups
+
+    rollups = PayrollRollups(supabase, tz=ZoneInfo("Asia/Tokyo"))
+    await rollups.record_clock_out(user_id, attendance_id)
+    report = await rollups.monthly("2025-04")
+"""
+
+import logging
+import re
+from datetime import datetime, timezone, tzinfo
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+LOG_COLUMNS = 'id,user_id,clock_in_at,clock_out_at,transport_cost,class_count'
+
+_MONTH_RE = re.compile(r'^\d{4}-(0[1-9]|1[0-2])$')
+
+
+def _parse_ts(value: Any) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def _int(value: Any) -> int:
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def valid_month(month: str) -> bool:
+    return bool(_MONTH_RE.match(month or ''))
+
+
+def month_of(ts: datetime, tz: Optional[tzinfo]) -> str:
+    """時刻が属する月（現地時間の YYYY-MM）"""
+    return ts.astimezone(tz).strftime('%Y-%m')
+
+
+def month_range(month: str, tz: Optional[tzinfo]) -> Tuple[str, str]:
+    """月の始まりと翌月の始まり（UTC の ISO 8601。`clock_in_at` の範囲指定に使う）"""
+    year, mon = int(month[:4]), int(month[5:7])
+    start = datetime(year, mon, 1, tzinfo=tz or timezone.utc)
+    end = datetime(year + mon // 12, mon % 12 + 1, 1, tzinfo=tz or timezone.utc)
+    return start.astimezone(timezone.utc).isoformat(), end.astimezone(timezone.utc).isoformat()
+
+
+class MonthlyTotals:
+    """1 ユーザー・1 か月分の集計"""
+
+    __slots__ = ('user_id', 'month', 'shifts', 'worked_seconds', 'transport_cost', 'class_count')
+
+    def __init__(self, user_id: Any, month: str):
+        self.user_id = user_id
+        self.month = month
+        self.shifts = 0
+        self.worked_seconds = 0
+        self.transport_cost = 0
+        self.class_count = 0
+
+    def add(self, clock_in: datetime, clock_out: datetime, row: Dict[str, Any]) -> None:
+        self.shifts += 1
+        self.worked_seconds += max(0, int((clock_out - clock_in).total_seconds()))
+        self.transport_cost += _int(row.get('transport_cost'))
+        self.class_count += _int(row.get('class_count'))
+
+    def to_row(self, updated_at: str) -> Dict[str, Any]:
+        return {
+            'user_id': self.user_id,
+            'month': self.month,
+            'shifts': self.shifts,
+            'worked_seconds': self.worked_seconds,
+            'transport_cost': self.transport_cost,
+            'class_count': self.class_count,
+            'updated_at': updated_at,
+        }
+
+    @staticmethod
+    def report(row: Dict[str, Any]) -> Dict[str, Any]:
+        """集計行をレポートの 1 行にする（勤務時間は時間単位）"""
+        return {
+            'user_id': row['user_id'],
+            'shifts': _int(row.get('shifts')),
+            'hours_worked': round(_int(row.get('worked_seconds')) / 3600, 2),
+            'transport_cost': _int(row.get('transport_cost')),
+            'class_count': _int(row.get('class_count')),
+        }
+
+
+class PayrollRollups:
+    """`attendance_monthly_rollups` の更新と月次レポート
+
+    Args:
+        supabase: Supabase の AsyncClient
+        tz: 月の区切りに使うタイムゾーン
+        page_size: `attendance_logs` を読む 1 回あたりの件数
+    """
+
+    def __init__(
+        self,
+        supabase: Any,
+        tz: Optional[tzinfo] = None,
+        logs_table: str = 'attendance_logs',
+        table: str = 'attendance_monthly_rollups',
+        page_size: int = 1000,
+    ):
+        self.supabase = supabase
+        self.tz = tz
+        self.logs_table = logs_table
+        self.table = table
+        self.page_size = page_size
+
+    def current_month(self) -> str:
+        return month_of(datetime.now(timezone.utc), self.tz)
+
+    # ========================================
+    # 集計
+    # ========================================
+
+    def _accumulate(self, totals: Dict[Tuple[Any, str], MonthlyTotals], rows: Iterable[Dict[str, Any]]) -> None:
+        for row in rows:
+            clock_in = _parse_ts(row.get('clock_in_at'))
+            clock_out = _parse_ts(row.get('clock_out_at'))
+            if clock_in is None or clock_out is None or row.get('user_id') is None:
+                continue
+            key = (row['user_id'], month_of(clock_in, self.tz))
+            entry = totals.get(key)
+            if entry is None:
+                entry = totals[key] = MonthlyTotals(*key)
+            entry.add(clock_in, clock_out, row)
+
+    async def _scan(
+        self, totals: Dict[Tuple[Any, str], MonthlyTotals], since: Optional[str] = None,
+        until: Optional[str] = None, user_id: Any = None,
+    ) -> int:
+        """退勤済みの行を ID 順に 1 ページずつ読んで集計に足す。読んだ行数を返す"""
+        last_id = None
+        scanned = 0
+        while True:
+            query = self.supabase.table(self.logs_table)\
+                .select(LOG_COLUMNS)\
+                .not_.is_('clock_out_at', 'null')
+            if since is not None:
+                query = query.gte('clock_in_at', since)
+            if until is not None:
+                query = query.lt('clock_in_at', until)
+            if user_id is not None:
+                query = query.eq('user_id', user_id)
+            if last_id is not None:
+                query = query.gt('id', last_id)
+            res = await query.order('id').limit(self.page_size).execute()
+            rows = res.data or []
+            self._accumulate(totals, rows)
+            scanned += len(rows)
+            if len(rows) < self.page_size:
+                return scanned
+            last_id = rows[-1]['id']
+
+    async def _upsert(self, totals: Iterable[MonthlyTotals], batch_size: int = 500) -> int:
+        now = datetime.now(timezone.utc).isoformat()
+        rows = [entry.to_row(now) for entry in totals]
+        for i in range(0, len(rows), batch_size):
+            await self.supabase.table(self.table).upsert(rows[i:i + batch_size], on_conflict='user_id,month').execute()
+        return len(rows)
+
+    async def refresh(self, user_id: Any, month: str) -> MonthlyTotals:
+        """1 ユーザー・1 か月分を `attendance_logs` から集計し直して保存する"""
+        since, until = month_range(month, self.tz)
+        totals: Dict[Tuple[Any, str], MonthlyTotals] = {}
+        await self._scan(totals, since=since, until=until, user_id=user_id)
+        entry = totals.get((user_id, month)) or MonthlyTotals(user_id, month)
+        await self._upsert([entry])
+        return entry
+
+    async def record_clock_out(self, user_id: Any, attendance_id: Any) -> Optional[MonthlyTotals]:
+        """退勤が `attendance_logs` に反映された行について、その月の集計を更新する"""
+        res = await self.supabase.table(self.logs_table).select('clock_in_at').eq('id', attendance_id).execute()
+        clock_in = _parse_ts(res.data[0].get('clock_in_at')) if res.data else None
+        if clock_in is None:
+            return None
+        return await self.refresh(user_id, month_of(clock_in, self.tz))
+
+    async def backfill(self, since_month: Optional[str] = None) -> Dict[str, Any]:
+        """`attendance_logs` から集計を作り直す（`since_month` 以降。省略時は全期間）
+
+        書き直した後、範囲内で今回書かなかった集計行（行が消えた・別の月に移ったユーザー・月）を消す。
+        消すのは書き直しより前に更新された行だけなので、途中で `record_clock_out` が書いた行は残る。
+        """
+        since = month_range(since_month, self.tz)[0] if since_month else None
+        started = datetime.now(timezone.utc).isoformat()
+        totals: Dict[Tuple[Any, str], MonthlyTotals] = {}
+        scanned = await self._scan(totals, since=since)
+        written = await self._upsert(totals.values())
+        query = self.supabase.table(self.table).delete().lt('updated_at', started)
+        if since_month is not None:
+            query = query.gte('month', since_month)
+        res = await query.execute()
+        removed = len(res.data or [])
+        logger.info("payroll rollups backfilled", extra={
+            'since': since_month, 'rows': scanned, 'rollups': written, 'removed': removed,
+        })
+        return {'since': since_month, 'rows': scanned, 'rollups': written, 'removed': removed}
+
+    # ========================================
+    # レポート
+    # ========================================
+
+    async def monthly(self, month: str, user_id: Any = None) -> Dict[str, Any]:
+        """月次レポート。締めた月は集計行を読み、当月以降（または集計が無い月）はその場で集計する"""
+        rows: List[Dict[str, Any]] = []
+        source = 'rollup'
+        if month < self.current_month():
+            query = self.supabase.table(self.table).select('*').eq('month', month)
+            if user_id is not None:
+                query = query.eq('user_id', user_id)
+            res = await query.order('user_id').execute()
+            rows = res.data or []
+        if not rows:
+            source = 'live'
+            since, until = month_range(month, self.tz)
+            totals: Dict[Tuple[Any, str], MonthlyTotals] = {}
+            await self._scan(totals, since=since, until=until, user_id=user_id)
+            rows = [entry.to_row('') for entry in sorted(totals.values(), key=lambda e: e.user_id)]
+        users = [MonthlyTotals.report(row) for row in rows]
+        return {
+            'month': month,
+            'source': source,
+            'users': users,
+            'totals': {
+                'shifts': sum(u['shifts'] for u in users),
+                'hours_worked': round(sum(_int(row.get('worked_seconds')) for row in rows) / 3600, 2),
+                'transport_cost': sum(u['transport_cost'] for u in users),
+                'class_count': sum(u['class_count'] for u in users),
+            },
+        }
@@ -0,0 +1,233 @@
+"""
+起動時の準備処理とレディネス判定
+
+lifespan では接続オブジェクトを作るだけで直ちに受け付けを始め、キャッシュの読み込みや
+上流への接続確立はここに登録したチェックとしてバックグラウンドで行う。失敗したチェックは
+間隔を延ばしながら成功するまで再試行する。必須のチェックがすべて成功するまで `/readyz` は 503 を返す。
+
+成功したチェックに `probe`（軽い疎通確認）を渡しておくと、以降も `recheck_interval` 秒ごとに
+実行し、失敗している間はそのチェックを `failed` に戻す（依存先が落ちたら `/readyz` も 503 に戻る）。
+報告にはチェックごとの結果に加えて、依存先（`dependency`）ごとの状態を含める。
+
+使用方法:
+    from readiness import Readiness
+
+    readiness = Readiness()
+    readiness.add('card_index', card_index.load, dependency='supabase', probe=ping_supabase)
+    readiness.add('stapro', warm_stapro, required=False, probe=ping_stapro)
+    readiness.start()
+    ...
+    readiness.report()   # {'ready': True, 'dependencies': {'supabase': 'ok', ...}, 'checks': {...}}
+    await readiness.stop()
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+STATUS_PENDING = 'pending'
+STATUS_OK = 'ok'
+STATUS_FAILED = 'failed'
+
+# 依存先の状態をまとめるときの優先度（悪い方を採る）
+_SEVERITY = {STATUS_OK: 0, STATUS_PENDING: 1, STATUS_FAILED: 2}
+
+
+class StartupCheck:
+    """1 つの準備処理と、その最新の結果"""
+
+    __slots__ = (
+        'name', 'fn', 'required', 'dependency', 'probe',
+        'status', 'error', 'attempts', 'duration_ms', 'detail', 'checked_at',
+    )
+
+    def __init__(
+        self,
+        name: str,
+        fn: Callable[[], Awaitable[Any]],
+        required: bool,
+        dependency: str,
+        probe: Optional[Callable[[], Awaitable[Any]]],
+    ):
+        self.name = name
+        self.fn = fn
+        self.required = required
+        self.dependency = dependency
+        self.probe = probe
+        self.status = STATUS_PENDING
+        self.error: Optional[str] = None
+        self.attempts = 0
+        self.duration_ms: Optional[float] = None
+        self.detail: Any = None
+        self.checked_at: Optional[float] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'status': self.status,
+            'required': self.required,
+            'dependency': self.dependency,
+            'attempts': self.attempts,
+            'duration_ms': self.duration_ms,
+            'checked_s_ago': round(time.monotonic() - self.checked_at, 3) if self.checked_at is not None else None,
+            'detail': self.detail,
+            'error': self.error,
+        }
+
+
+class Readiness:
+    """準備処理の実行とレディネスの集計
+
+    Args:
+        retry_interval: 失敗したチェックを最初に再試行するまでの秒数（以降は倍々で延ばす）
+        max_retry_interval: 再試行間隔の上限（秒）
+        recheck_interval: 成功したチェックの `probe` を実行する間隔（秒）
+        probe_timeout: `probe` の応答を待つ秒数（超えたら失敗とみなす）
+    """
+
+    def __init__(
+        self,
+        retry_interval: float = 1.0,
+        max_retry_interval: float = 30.0,
+        recheck_interval: float = 15.0,
+        probe_timeout: float = 5.0,
+    ):
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.recheck_interval = recheck_interval
+        self.probe_timeout = probe_timeout
+        self._checks: Dict[str, StartupCheck] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._ready = asyncio.Event()
+        self._started_at = time.monotonic()
+
+    def add(
+        self,
+        name: str,
+        fn: Callable[[], Awaitable[Any]],
+        required: bool = True,
+        dependency: Optional[str] = None,
+        probe: Optional[Callable[[], Awaitable[Any]]] = None,
+    ) -> None:
+        """チェックを登録する
+
+        Args:
+            fn: 準備処理。戻り値は `detail` として報告に含める
+            required: 成功するまで受け付け不可とするか
+            dependency: 報告で集計する依存先の名前（省略時はチェック名）
+            probe: 成功後に定期的に実行する疎通確認（省略時は再確認しない）
+        """
+        self._checks[name] = StartupCheck(name, fn, required, dependency or name, probe)
+
+    @property
+    def ready(self) -> bool:
+        return all(c.status == STATUS_OK for c in self._checks.values() if c.required)
+
+    def start(self) -> None:
+        """すべてのチェックをバックグラウンドで開始する"""
+        self._started_at = time.monotonic()
+        self._update()
+        for check in self._checks.values():
+            self._tasks.append(asyncio.create_task(self._run(check)))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def wait(self, timeout: Optional[float] = None) -> bool:
+        """必須のチェックがすべて成功するまで待つ。時間切れなら False"""
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def dependencies(self) -> Dict[str, str]:
+        """依存先ごとの状態（どれかのチェックが失敗していれば failed、未完了があれば pending）"""
+        statuses: Dict[str, str] = {}
+        for check in self._checks.values():
+            current = statuses.get(check.dependency)
+            if current is None or _SEVERITY[check.status] > _SEVERITY[current]:
+                statuses[check.dependency] = check.status
+        return statuses
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            'ready': self.ready,
+            'uptime_s': round(time.monotonic() - self._started_at, 3),
+            'dependencies': self.dependencies(),
+            'checks': {name: check.to_dict() for name, check in self._checks.items()},
+        }
+
+    def _update(self) -> None:
+        if self.ready:
+            self._ready.set()
+        else:
+            self._ready.clear()
+
+    async def _run(self, check: StartupCheck) -> None:
+        delay = self.retry_interval
+        while True:
+            check.attempts += 1
+            started = time.perf_counter()
+            try:
+                check.detail = await check.fn()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                check.status = STATUS_FAILED
+                check.error = repr(e)
+                check.duration_ms = round((time.perf_counter() - started) * 1000, 2)
+                check.checked_at = time.monotonic()
+                logger.warning("startup check failed", extra={
+                    'check': check.name, 'attempts': check.attempts, 'retry_in_s': delay, 'error': check.error,
+                })
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_retry_interval)
+                continue
+            check.status = STATUS_OK
+            check.error = None
+            check.duration_ms = round((time.perf_counter() - started) * 1000, 2)
+            check.checked_at = time.monotonic()
+            logger.info("startup check ok", extra={
+                'check': check.name, 'attempts': check.attempts, 'duration_ms': check.duration_ms,
+            })
+            self._update()
+            if check.probe is not None:
+                await self._recheck(check)
+            return
+
+    async def _recheck(self, check: StartupCheck) -> None:
+        """成功したチェックの疎通確認を定期的に実行し、結果に応じて状態を切り替える"""
+        while True:
+            await asyncio.sleep(self.recheck_interval)
+            started = time.perf_counter()
+            try:
+                await asyncio.wait_for(check.probe(), self.probe_timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                check.checked_at = time.monotonic()
+                check.duration_ms = round((time.perf_counter() - started) * 1000, 2)
+                check.error = repr(e)
+                if check.status != STATUS_FAILED:
+                    logger.warning("dependency check failed", extra={
+                        'check': check.name, 'dependency': check.dependency, 'error': check.error,
+                    })
+                check.status = STATUS_FAILED
+                self._update()
+                continue
+            check.checked_at = time.monotonic()
+            check.duration_ms = round((time.perf_counter() - started) * 1000, 2)
+            if check.status != STATUS_OK:
+                logger.info("dependency check recovered", extra={
+                    'check': check.name, 'dependency': check.dependency, 'duration_ms': check.duration_ms,
+                })
+            check.status = STATUS_OK
+            check.error = None
+            self._update()
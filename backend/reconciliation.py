@@ -0,0 +1,422 @@
+"""
+attendance_logs と Stapro の勤怠の突き合わせ
+
+出勤・退勤時の Stapro 連携の失敗は打刻を止めないため、ローカルの `attendance_logs` と Stapro の勤怠は
+黙ってずれていくことがある。このモジュールは勤務日ごとに両者を突き合わせ、食い違いを報告（または修復）する。
+
+- ローカル側は退勤済みの `attendance_logs` を ID 順に 1 ページずつ読み、ユーザー × 勤務日（出勤時刻の現地日付）にまとめる
+- Stapro 側はスタッフごとに `iter_attendances` で期間内の勤怠を読む（同時実行数を制限して並列に取得する）
+- 食い違いの種類:
+    - `missing_in_stapro`: ローカルにだけある勤務日。`repair=True` なら `create_attendance` で登録し直す
+    - `missing_locally`: Stapro にだけある勤務日（報告のみ）
+    - `different`: 両方にあるが交通費・コマ数が異なる勤務日（Stapro に更新 API が無いので報告のみ）
+- 前回どこまで確認したか（ウォーターマーク）を JSON ファイルに保存し、次回はその少し前からだけ確認する。
+  取得に失敗したスタッフがいた回はウォーターマークを進めない
+
+使用方法:
+    python reconciliation.py                    # 前回の続きから昨日までを確認する
+    python reconciliation.py --since 2025-04-01 --repair
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import date, datetime, timedelta, timezone, tzinfo
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+LOG_COLUMNS = 'id,user_id,clock_in_at,clock_out_at,transport_cost,class_count'
+
+MISMATCHES = REGISTRY.counter(
+    'attendance_reconcile_mismatches_total', '突き合わせで見つかった食い違いの件数', ['kind'])
+REPAIRS = REGISTRY.counter(
+    'attendance_reconcile_repairs_total', '突き合わせで Stapro に登録し直した件数', ['status'])
+
+# 修復に使う送信関数: [(attendance_id, create_attendance の引数)] と同時実行数 → 入力と同じ順序の結果
+Submit = Callable[[List[Tuple[Any, Dict[str, Any]]], int], Awaitable[List[Dict[str, Any]]]]
+
+
+def _parse_ts(value: Any) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def _int(value: Any) -> Optional[int]:
+    try:
+        if value is None or str(value).strip() == '':
+            return None
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class DayTotals:
+    """1 スタッフ・1 勤務日分の勤怠（ローカルは複数の勤務をまとめる）"""
+
+    __slots__ = ('ids', 'commuting_costs', 'total_lesson')
+
+    def __init__(self):
+        self.ids: List[Any] = []
+        self.commuting_costs = 0
+        self.total_lesson = 0
+
+    def add(self, record_id: Any, commuting_costs: Any, total_lesson: Any) -> None:
+        self.ids.append(record_id)
+        self.commuting_costs += _int(commuting_costs) or 0
+        self.total_lesson += _int(total_lesson) or 0
+
+    def values(self) -> Dict[str, int]:
+        return {'commuting_costs': self.commuting_costs, 'total_lesson': self.total_lesson}
+
+
+class AttendanceReconciler:
+    """`attendance_logs` と Stapro の勤怠を勤務日ごとに突き合わせる
+
+    Args:
+        supabase: Supabase の AsyncClient
+        get_client: 共有の Stapro クライアントを返す関数（未設定なら None を返す）
+        get_users: 突き合わせ対象のユーザー（`UserRecord`）を返す非同期関数
+        tz: 勤務日の区切りに使うタイムゾーン
+        watermark_path: ウォーターマークを保存する JSON ファイル（None なら保存しない）
+        overlap_days: 前回確認した日から何日さかのぼって確認し直すか（後から直された勤怠を拾う）
+        lookback_days: ウォーターマークが無いときに何日前から確認するか
+        page_size: `attendance_logs` を読む 1 回あたりの件数
+    """
+
+    def __init__(
+        self,
+        supabase: Any,
+        get_client: Callable[[], Any],
+        get_users: Callable[[], Awaitable[Iterable[Any]]],
+        tz: Optional[tzinfo] = None,
+        watermark_path: Optional[str] = 'attendance_reconcile.json',
+        overlap_days: int = 2,
+        lookback_days: int = 35,
+        logs_table: str = 'attendance_logs',
+        page_size: int = 1000,
+    ):
+        self.supabase = supabase
+        self.get_client = get_client
+        self.get_users = get_users
+        self.tz = tz
+        self.watermark_path = watermark_path
+        self.overlap_days = overlap_days
+        self.lookback_days = lookback_days
+        self.logs_table = logs_table
+        self.page_size = page_size
+        self._lock = asyncio.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    def today(self) -> date:
+        return datetime.now(timezone.utc).astimezone(self.tz).date()
+
+    # ========================================
+    # ウォーターマーク
+    # ========================================
+
+    def load_watermark(self) -> Optional[date]:
+        """前回すべて確認できた最後の勤務日（無ければ None）"""
+        if not self.watermark_path or not os.path.exists(self.watermark_path):
+            return None
+        try:
+            with open(self.watermark_path, encoding='utf-8') as f:
+                return date.fromisoformat(json.load(f)['watermark'])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning("reconcile watermark could not be read", extra={'error': repr(e)})
+            return None
+
+    def _write_watermark(self, watermark: date) -> None:
+        tmp_path = f"{self.watermark_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'watermark': watermark.isoformat(), 'updated_at': datetime.now(timezone.utc).isoformat()}, f)
+        os.replace(tmp_path, self.watermark_path)
+
+    async def save_watermark(self, watermark: date) -> None:
+        if not self.watermark_path:
+            return
+        try:
+            await asyncio.to_thread(self._write_watermark, watermark)
+        except OSError as e:
+            logger.warning("reconcile watermark could not be written", extra={'error': repr(e)})
+
+    # ========================================
+    # 読み込み
+    # ========================================
+
+    def _day_bounds(self, since: date, until: date) -> Tuple[str, str]:
+        """勤務日の範囲（両端を含む）を `clock_in_at` の UTC の範囲にする"""
+        tz = self.tz or timezone.utc
+        start = datetime.combine(since, datetime.min.time(), tz)
+        end = datetime.combine(until + timedelta(days=1), datetime.min.time(), tz)
+        return start.astimezone(timezone.utc).isoformat(), end.astimezone(timezone.utc).isoformat()
+
+    async def _local_days(self, since: date, until: date) -> Dict[Tuple[Any, str], DayTotals]:
+        """退勤済みの `attendance_logs` をユーザー × 勤務日にまとめる"""
+        start, end = self._day_bounds(since, until)
+        days: Dict[Tuple[Any, str], DayTotals] = {}
+        last_id = None
+        while True:
+            query = self.supabase.table(self.logs_table)\
+                .select(LOG_COLUMNS)\
+                .not_.is_('clock_out_at', 'null')\
+                .gte('clock_in_at', start)\
+                .lt('clock_in_at', end)
+            if last_id is not None:
+                query = query.gt('id', last_id)
+            res = await query.order('id').limit(self.page_size).execute()
+            rows = res.data or []
+            for row in rows:
+                clock_in = _parse_ts(row.get('clock_in_at'))
+                if clock_in is None or row.get('user_id') is None:
+                    continue
+                key = (row['user_id'], clock_in.astimezone(self.tz).date().isoformat())
+                entry = days.get(key)
+                if entry is None:
+                    entry = days[key] = DayTotals()
+                entry.add(row['id'], row.get('transport_cost'), row.get('class_count'))
+            if len(rows) < self.page_size:
+                return days
+            last_id = rows[-1]['id']
+
+    async def _remote_days(
+        self, client: Any, staff_ids: Iterable[int], since: date, until: date, max_concurrency: int,
+    ) -> Tuple[Dict[Tuple[int, str], DayTotals], List[Dict[str, Any]]]:
+        """スタッフごとの Stapro の勤怠を並列に読み、スタッフ × 勤務日にまとめる。取得に失敗したスタッフも返す"""
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+        days: Dict[Tuple[int, str], DayTotals] = {}
+        errors: List[Dict[str, Any]] = []
+
+        async def fetch(staff_id: int) -> None:
+            async with semaphore:
+                try:
+                    rows = [row async for row in client.iter_attendances(
+                        staff_id, work_day_from=since.isoformat(), work_day_to=until.isoformat())]
+                except Exception as e:
+                    errors.append({'staff_id': staff_id, 'error': repr(e)})
+                    return
+            for row in rows:
+                key = (staff_id, str(row.get('work_day') or '')[:10])
+                entry = days.get(key)
+                if entry is None:
+                    entry = days[key] = DayTotals()
+                entry.add(row.get('id'), row.get('commuting_costs'), row.get('total_lesson'))
+
+        await asyncio.gather(*(fetch(staff_id) for staff_id in staff_ids))
+        return days, errors
+
+    # ========================================
+    # 突き合わせ
+    # ========================================
+
+    async def run(
+        self,
+        since: Optional[date] = None,
+        until: Optional[date] = None,
+        repair: bool = False,
+        max_concurrency: int = 16,
+        submit: Optional[Submit] = None,
+        limit: int = 500,
+    ) -> Dict[str, Any]:
+        """勤務日 `since`〜`until`（両端を含む）を突き合わせて結果を返す
+
+        `since` を省略するとウォーターマークの `overlap_days` 日前から（無ければ `lookback_days` 日前から）、
+        `until` を省略すると昨日まで（今日はまだ退勤していない勤務があるため）を確認する。
+        `repair=True` なら Stapro に無い勤務日を `submit`（省略時は `create_attendances_bulk`）で登録し直す。
+        結果の `mismatches` は先頭 `limit` 件まで返す（件数は `counts` にすべて入る）。
+        """
+        client = self.get_client()
+        if client is None:
+            raise RuntimeError("Stapro configuration missing")
+        async with self._lock:
+            return await self._run(client, since, until, repair, max_concurrency, submit, limit)
+
+    async def _run(
+        self, client: Any, since: Optional[date], until: Optional[date], repair: bool,
+        max_concurrency: int, submit: Optional[Submit], limit: int,
+    ) -> Dict[str, Any]:
+        started = time.perf_counter()
+        watermark = self.load_watermark()
+        until = until or self.today() - timedelta(days=1)
+        if since is None:
+            since = watermark - timedelta(days=self.overlap_days) if watermark else until - timedelta(days=self.lookback_days)
+        if since > until:
+            return {'since': since.isoformat(), 'until': until.isoformat(), 'staff': 0, 'counts': {}, 'mismatches': []}
+
+        # スタッフ ID を持つユーザーだけが突き合わせの対象（同じスタッフ ID のユーザーはまとめる）
+        staff_of: Dict[Any, int] = {}
+        users_by_staff: Dict[int, Any] = {}
+        for user in await self.get_users():
+            staff_id = _int(user.stapro_staff_id or user.id)
+            if staff_id is None:
+                continue
+            staff_of[user.id] = staff_id
+            users_by_staff.setdefault(staff_id, user)
+
+        # ローカルの読み込みと Stapro の取得は並行して進める
+        local_by_user, (remote, errors) = await asyncio.gather(
+            self._local_days(since, until),
+            self._remote_days(client, users_by_staff, since, until, max_concurrency),
+        )
+        failed = {error['staff_id'] for error in errors}
+        local: Dict[Tuple[int, str], DayTotals] = {}
+        unmatched_users = set()
+        for (user_id, work_day), entry in local_by_user.items():
+            staff_id = staff_of.get(user_id)
+            if staff_id is None:
+                unmatched_users.add(user_id)
+                continue
+            merged = local.get((staff_id, work_day))
+            if merged is None:
+                local[(staff_id, work_day)] = entry
+            else:
+                merged.ids.extend(entry.ids)
+                merged.commuting_costs += entry.commuting_costs
+                merged.total_lesson += entry.total_lesson
+
+        mismatches: List[Dict[str, Any]] = []
+        for key in sorted(set(local) | set(remote), key=lambda k: (k[1], k[0])):
+            staff_id, work_day = key
+            if staff_id in failed:
+                continue
+            mine, theirs = local.get(key), remote.get(key)
+            if theirs is None:
+                kind = 'missing_in_stapro'
+            elif mine is None:
+                kind = 'missing_locally'
+            elif mine.values() != theirs.values():
+                kind = 'different'
+            else:
+                continue
+            mismatches.append({
+                'kind': kind,
+                'staff_id': staff_id,
+                'work_day': work_day,
+                'attendance_ids': mine.ids if mine else [],
+                'stapro_ids': theirs.ids if theirs else [],
+                'local': mine.values() if mine else None,
+                'stapro': theirs.values() if theirs else None,
+            })
+
+        counts: Dict[str, int] = {}
+        for item in mismatches:
+            counts[item['kind']] = counts.get(item['kind'], 0) + 1
+        for kind, n in counts.items():
+            MISMATCHES.inc(n, kind=kind)
+
+        if repair:
+            await self._repair(client, mismatches, users_by_staff, max_concurrency, submit)
+
+        if not errors and (watermark is None or until > watermark):
+            await self.save_watermark(until)
+            watermark = until
+
+        elapsed = time.perf_counter() - started
+        logger.info("attendance reconciliation finished", extra={
+            'since': since.isoformat(), 'until': until.isoformat(), 'staff': len(users_by_staff),
+            'counts': counts, 'errors': len(errors), 'elapsed_ms': round(elapsed * 1000, 1),
+        })
+        return {
+            'since': since.isoformat(),
+            'until': until.isoformat(),
+            'watermark': watermark.isoformat() if watermark else None,
+            'staff': len(users_by_staff),
+            'local_days': len(local),
+            'stapro_days': len(remote),
+            'counts': counts,
+            'errors': errors,
+            'unmatched_users': sorted(unmatched_users, key=str),
+            'elapsed_ms': round(elapsed * 1000, 1),
+            'mismatches': mismatches[:max(0, limit)],
+        }
+
+    async def _repair(
+        self, client: Any, mismatches: List[Dict[str, Any]], users_by_staff: Dict[int, Any],
+        max_concurrency: int, submit: Optional[Submit],
+    ) -> None:
+        """Stapro に無い勤務日をローカルの内容で登録し直し、各項目に `repair` の結果を付ける"""
+        targets = [item for item in mismatches if item['kind'] == 'missing_in_stapro']
+        if not targets:
+            return
+        items = []
+        for item in targets:
+            user = users_by_staff[item['staff_id']]
+            items.append((item['attendance_ids'][0], {
+                'staff_id': item['staff_id'],
+                'work_day': item['work_day'],
+                'school_id': _int(user.school_id) or 1,
+                'commuting_costs': item['local']['commuting_costs'],
+                'another_time': 0.0,
+                'total_lesson': item['local']['total_lesson'],
+                'lesson_ids': [],
+            }))
+        if submit is None:
+            async def submit(batch: List[Tuple[Any, Dict[str, Any]]], concurrency: int) -> List[Dict[str, Any]]:
+                return await client.create_attendances_bulk([payload for _, payload in batch], max_concurrency=concurrency)
+        results = await submit(items, max_concurrency)
+        for item, result in zip(targets, results):
+            item['repair'] = {'status': result.get('status'), 'error': result.get('error')}
+            REPAIRS.inc(status=str(result.get('status')))
+
+
+if __name__ == '__main__':
+    from zoneinfo import ZoneInfo
+
+    from dotenv import load_dotenv
+
+    from card_index import CardIndex
+    from stapro_api_client_async import AsyncStaproAPIClient
+
+    parser = argparse.ArgumentParser(description="attendance_logs と Stapro の勤怠を突き合わせる")
+    parser.add_argument('--since', type=date.fromisoformat, help="確認する最初の勤務日（YYYY-MM-DD）")
+    parser.add_argument('--until', type=date.fromisoformat, help="確認する最後の勤務日（YYYY-MM-DD。省略時は昨日）")
+    parser.add_argument('--repair', action='store_true', help="Stapro に無い勤務日を登録し直す")
+    parser.add_argument('--concurrency', type=int, default=16, help="Stapro に同時に問い合わせるスタッフ数")
+    parser.add_argument('--limit', type=int, default=500, help="表示する食い違いの件数の上限")
+    args = parser.parse_args()
+
+    async def _main():
+        load_dotenv()
+        from supabase import acreate_client
+
+        supabase = await acreate_client(os.environ["SUPABASE_URL"], os.environ["SUPABASE_KEY"])
+        async with AsyncStaproAPIClient(
+            base_url=os.environ["STAPRO_API_URL"],
+            api_token=os.environ["STAPRO_API_TOKEN"],
+            timeout=float(os.getenv("STAPRO_TIMEOUT", "10")),
+            connect_timeout=float(os.getenv("STAPRO_CONNECT_TIMEOUT", "3")),
+        ) as client:
+            index = CardIndex(supabase)
+
+            async def users():
+                await index.load()
+                return index.records()
+
+            reconciler = AttendanceReconciler(
+                supabase,
+                get_client=lambda: client,
+                get_users=users,
+                tz=ZoneInfo(os.getenv("SCHOOL_TIMEZONE", "Asia/Tokyo")),
+                watermark_path=os.getenv("RECONCILE_WATERMARK_PATH", "attendance_reconcile.json"),
+            )
+            result = await reconciler.run(
+                since=args.since, until=args.until, repair=args.repair,
+                max_concurrency=args.concurrency, limit=args.limit,
+            )
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+
+    asyncio.run(_main())
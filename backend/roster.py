@@ -0,0 +1,122 @@
+"""
+出勤中スタッフ一覧（ロスター）の変更を Server-Sent Events で配信する
+
+未退勤シフト台帳（`OpenShiftRegistry`）の変更（出勤・退勤・ID の付け替え）をイベントにし、
+接続中のクライアントに配信する。イベントは 1 回だけ SSE の形式に変換し、全クライアントで使い回す。
+
+- 直近 `history` 件のイベントを保持し、再接続したクライアントが `Last-Event-ID` を送れば続きから配信する
+  （保持していない古い ID なら、改めて一覧（snapshot）から送る）
+- 読み取りが遅いクライアントのキューがあふれたら、溜まったイベントを捨てて一覧を送り直す（`RESYNC`）
+- `close()` で全クライアントの配信を終える（サーバー停止時）
+
+使用方法:
+    from roster import RosterFeed
+
+    feed = RosterFeed()
+    feed.publish("clock_in", {"user_id": 1, "school_id": 2}, school_id=2)
+
+    subscription = feed.subscribe()
+    event = await subscription.get(timeout=15.0)
+"""
+
+import asyncio
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Set
+
+import orjson
+
+
+def sse_frame(event_id: Optional[int], event: str, data: Any) -> bytes:
+    """SSE の 1 イベント分（data は JSON 1 行）"""
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return (head + f"event: {event}\n").encode() + b"data: " + orjson.dumps(data) + b"\n\n"
+
+
+class RosterEvent:
+    """配信するイベント（SSE に変換済みの本文と、教室での絞り込み用の school_id）"""
+
+    __slots__ = ('id', 'type', 'school_id', 'frame')
+
+    def __init__(self, event_id: int, event_type: str, school_id: Any, frame: bytes):
+        self.id = event_id
+        self.type = event_type
+        self.school_id = school_id
+        self.frame = frame
+
+
+# キューがあふれたクライアントに一覧を送り直させる印
+RESYNC = RosterEvent(0, 'resync', None, b'')
+
+
+class Subscription:
+    """1 クライアント分の受信キュー"""
+
+    __slots__ = ('queue',)
+
+    def __init__(self, queue_size: int):
+        self.queue: 'asyncio.Queue[Optional[RosterEvent]]' = asyncio.Queue(queue_size)
+
+    def push(self, event: Optional[RosterEvent]) -> None:
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # 溜まった分は捨て、一覧からやり直させる（終了の印は必ず届ける）
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(event if event is None else RESYNC)
+
+    async def get(self, timeout: float) -> Optional[RosterEvent]:
+        """次のイベント。`timeout` 秒届かなければ asyncio.TimeoutError、配信終了なら None"""
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+
+class RosterFeed:
+    """ロスターの変更イベントの配信元
+
+    Args:
+        history: 再接続のために保持するイベント数
+        queue_size: クライアントごとに溜めておけるイベント数
+    """
+
+    def __init__(self, history: int = 1000, queue_size: int = 1000):
+        self.queue_size = queue_size
+        self.last_id = 0
+        self._history: Deque[RosterEvent] = deque(maxlen=history)
+        self._subscribers: Set[Subscription] = set()
+        self._closed = False
+
+    def publish(self, event_type: str, data: Dict[str, Any], school_id: Any = None) -> RosterEvent:
+        self.last_id += 1
+        event = RosterEvent(self.last_id, event_type, school_id, sse_frame(self.last_id, event_type, data))
+        self._history.append(event)
+        for subscription in self._subscribers:
+            subscription.push(event)
+        return event
+
+    def subscribe(self) -> Subscription:
+        subscription = Subscription(self.queue_size)
+        if self._closed:
+            subscription.push(None)
+        self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self._subscribers.discard(subscription)
+
+    def since(self, last_id: int) -> Optional[List[RosterEvent]]:
+        """`last_id` より後のイベント。保持している範囲より古ければ None（一覧から送り直す）"""
+        if last_id > self.last_id:
+            return None
+        oldest = self._history[0].id if self._history else self.last_id + 1
+        if last_id < oldest - 1:
+            return None
+        return [event for event in self._history if event.id > last_id]
+
+    def close(self) -> None:
+        """全クライアントの配信を終える"""
+        self._closed = True
+        for subscription in self._subscribers:
+            subscription.push(None)
+
+    def __len__(self) -> int:
+        return len(self._subscribers)
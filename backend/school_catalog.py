@@ -0,0 +1,178 @@
+"""
+教室・タイムテーブルのカタログキャッシュ
+
+`get_schools` / `get_school`（timetables を含む）の結果を TTL 付きで保持する。
+TTL を過ぎたデータはそのまま返しつつバックグラウンドで取り直し（stale-while-revalidate）、
+内容はディスクにスナップショットとして保存して、再起動直後から温かいデータを返せるようにする。
+
+使用方法:
+    from school_catalog import SchoolCatalog
+
+    catalog = SchoolCatalog(get_client=lambda: client, snapshot_path="school_catalog.json")
+    catalog.load_snapshot()
+
+    schools = await catalog.get_schools()
+    school = await catalog.get_school(1)
+    catalog.invalidate(school_id=1)
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+SCHOOLS_KEY = 'schools'
+
+
+def school_key(school_id: int) -> str:
+    return f'school:{school_id}'
+
+
+class CatalogEntry:
+    """キャッシュした応答と取得時刻（UNIX 時刻。スナップショットにも保存する）"""
+
+    __slots__ = ('data', 'fetched_at')
+
+    def __init__(self, data: Any, fetched_at: float):
+        self.data = data
+        self.fetched_at = fetched_at
+
+
+class SchoolCatalog:
+    """教室カタログの stale-while-revalidate キャッシュ
+
+    - `ttl` 秒以内のデータはそのまま返す
+    - `ttl` を過ぎたデータも返し、1 キーにつき 1 タスクだけがバックグラウンドで取り直す
+    - `max_stale` 秒を過ぎたデータは取り直しを待つ（失敗したら古いデータで応答する）
+    """
+
+    def __init__(
+        self,
+        get_client: Callable[[], Any],
+        ttl: float = 3600.0,
+        max_stale: float = 7 * 24 * 3600.0,
+        snapshot_path: Optional[str] = None,
+    ):
+        self.get_client = get_client
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.snapshot_path = snapshot_path
+
+        self._entries: Dict[str, CatalogEntry] = {}
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._snapshot_lock = asyncio.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    # ========================================
+    # 取得
+    # ========================================
+
+    async def get_schools(self) -> Any:
+        """教室一覧（キャッシュ経由）"""
+        return await self._get(SCHOOLS_KEY, lambda client: client.get_schools())
+
+    async def get_school(self, school_id: int) -> Any:
+        """教室詳細（timetables を含む。キャッシュ経由）"""
+        return await self._get(school_key(school_id), lambda client: client.get_school(school_id))
+
+    async def _get(self, key: str, fetch: Callable[[Any], Any]) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None:
+            age = time.time() - entry.fetched_at
+            if age < self.ttl:
+                self.hits += 1
+                return entry.data
+            if age < self.max_stale:
+                self.stale_hits += 1
+                self._revalidate(key, fetch)
+                return entry.data
+
+        self.misses += 1
+        try:
+            return await asyncio.shield(self._revalidate(key, fetch))
+        except Exception:
+            if entry is not None:
+                # 取り直せなかった場合は古いデータでも返す
+                return entry.data
+            raise
+
+    def _revalidate(self, key: str, fetch: Callable[[Any], Any]) -> asyncio.Task:
+        task = self._inflight.get(key)
+        if task is None or task.done():
+            task = asyncio.create_task(self._refresh(key, fetch))
+            # バックグラウンド更新の失敗は _refresh 内で記録済みなので、ここでは回収だけする
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._inflight[key] = task
+        return task
+
+    async def _refresh(self, key: str, fetch: Callable[[Any], Any]) -> Any:
+        try:
+            data = await fetch(self.get_client())
+            self._entries[key] = CatalogEntry(data, time.time())
+            await self.save_snapshot()
+            return data
+        except Exception as e:
+            logger.warning("school catalog refresh failed", extra={'key': key, 'error': repr(e)})
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    def invalidate(self, school_id: Optional[int] = None) -> int:
+        """キャッシュを捨てる。school_id 省略時は全件。捨てた件数を返す"""
+        if school_id is None:
+            count = len(self._entries)
+            self._entries.clear()
+            return count
+        removed = self._entries.pop(school_key(school_id), None)
+        return 1 if removed is not None else 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+        }
+
+    # ========================================
+    # スナップショット
+    # ========================================
+
+    def load_snapshot(self) -> int:
+        """ディスクのスナップショットを読み込む。読み込んだ件数を返す"""
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return 0
+        try:
+            with open(self.snapshot_path, encoding='utf-8') as f:
+                raw = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning("school catalog snapshot could not be read", extra={'error': repr(e)})
+            return 0
+        for key, item in raw.items():
+            self._entries[key] = CatalogEntry(item['data'], float(item['fetched_at']))
+        return len(raw)
+
+    def _write_snapshot(self, raw: Dict[str, Any]) -> None:
+        # 複数プロセスが同じスナップショットを書いても一時ファイルが衝突しないようにする
+        tmp_path = f"{self.snapshot_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(raw, f, ensure_ascii=False)
+        os.replace(tmp_path, self.snapshot_path)
+
+    async def save_snapshot(self) -> None:
+        """現在のキャッシュをスナップショットに書き出す"""
+        if not self.snapshot_path:
+            return
+        raw = {key: {'data': e.data, 'fetched_at': e.fetched_at} for key, e in self._entries.items()}
+        async with self._snapshot_lock:
+            try:
+                await asyncio.to_thread(self._write_snapshot, raw)
+            except OSError as e:
+                logger.warning("school catalog snapshot could not be written", extra={'error': repr(e)})
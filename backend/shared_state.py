@@ -0,0 +1,333 @@
+"""
+ワーカー間で共有する状態と無効化イベント
+
+`main.py` を複数の uvicorn / gunicorn ワーカーで動かすと、カード索引・未退勤シフト台帳・重複排除の窓・
+タップ確認トークンなどのプロセス内の状態がワーカーごとに食い違う。このモジュールはそれらが使う
+共有ストアと、変更を他のワーカーに伝えるイベントを提供する。
+
+- LocalState:  プロセス内だけの実装（既定。ワーカー 1 つで動かす場合）
+- SqliteState: 同じホストのワーカーで共有する SQLite ファイル（WAL）。イベントは表に追記し、
+  各ワーカーが `poll_interval` 秒ごとに読んで購読者に渡す（自分が送ったイベントは受け取らない）
+
+どちらも次の操作を持つ（値は JSON にできるもの）:
+    get / set / add（無ければ書く）/ pop（読んで消す）/ delete  … TTL 付きのキーと値
+    acquire / release                                              … 名前付きのリース（1 ワーカーだけが持つ）
+    publish / subscribe                                            … 他のワーカーへのイベント
+
+使用方法:
+    from shared_state import open_shared_state
+
+    state = open_shared_state("sqlite:///shared_state.db")  # "local" ならプロセス内
+    state.subscribe("users", lambda message: card_index.invalidate(**message))
+    state.start()
+
+    await state.publish("users", {"card_id": "0123", "user_id": 1})
+"""
+
+import asyncio
+import inspect
+import logging
+import secrets
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import orjson
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+SHARED_EVENTS = REGISTRY.counter(
+    'shared_state_events_total', 'ワーカー間のイベントの件数（published: 送信, received: 他のワーカーから受信）',
+    ['channel', 'direction'])
+
+
+class _Subscribers:
+    """チャンネルごとの購読者（同期関数でも非同期関数でもよい）"""
+
+    shared = False
+
+    def __init__(self):
+        # このプロセスを表す ID（自分が送ったイベントを読み飛ばすのに使う）
+        self.origin = secrets.token_hex(8)
+        self._handlers: Dict[str, List[Callable[[Any], Any]]] = {}
+
+    def subscribe(self, channel: str, handler: Callable[[Any], Any]) -> None:
+        self._handlers.setdefault(channel, []).append(handler)
+
+    async def _dispatch(self, channel: str, message: Any) -> None:
+        SHARED_EVENTS.inc(channel=channel, direction='received')
+        for handler in self._handlers.get(channel, ()):
+            try:
+                result = handler(message)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception:
+                logger.exception("shared state handler failed", extra={'channel': channel})
+
+
+class LocalState(_Subscribers):
+    """プロセス内だけの実装（イベントを受け取る他のワーカーはいない）"""
+
+    def __init__(self):
+        super().__init__()
+        self._values: Dict[str, Tuple[Any, float]] = {}
+
+    def _live(self, key: str, now: float) -> Optional[Tuple[Any, float]]:
+        found = self._values.get(key)
+        if found is not None and found[1] <= now:
+            del self._values[key]
+            return None
+        return found
+
+    def _purge(self, now: float) -> None:
+        expired = [key for key, (_, expires_at) in self._values.items() if expires_at <= now]
+        for key in expired:
+            del self._values[key]
+
+    async def get(self, key: str) -> Any:
+        found = self._live(key, time.time())
+        return found[0] if found is not None else None
+
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        now = time.time()
+        if len(self._values) >= 10000:
+            self._purge(now)
+        self._values[key] = (value, now + ttl)
+
+    async def add(self, key: str, value: Any, ttl: float) -> bool:
+        """キーが無い（期限切れを含む）ときだけ書く。書けたら True"""
+        if self._live(key, time.time()) is not None:
+            return False
+        await self.set(key, value, ttl)
+        return True
+
+    async def pop(self, key: str) -> Any:
+        found = self._live(key, time.time())
+        if found is None:
+            return None
+        del self._values[key]
+        return found[0]
+
+    async def delete(self, key: str) -> None:
+        self._values.pop(key, None)
+
+    async def acquire(self, name: str, ttl: float) -> bool:
+        return True
+
+    async def release(self, name: str) -> None:
+        return None
+
+    async def publish(self, channel: str, message: Any) -> None:
+        SHARED_EVENTS.inc(channel=channel, direction='published')
+
+    def start(self) -> None:
+        return None
+
+    async def close(self) -> None:
+        return None
+
+
+class SqliteState(_Subscribers):
+    """同じホストのワーカーで共有する SQLite ファイルの実装
+
+    Args:
+        path: SQLite ファイルのパス（全ワーカーで同じものを指定する）
+        poll_interval: イベントを読みに行く間隔（秒）
+        event_retention: イベントを残しておく秒数（これより古いものは消す）
+    """
+
+    shared = True
+
+    def __init__(self, path: str, poll_interval: float = 0.05, event_retention: float = 60.0):
+        super().__init__()
+        self.path = path
+        self.poll_interval = poll_interval
+        self.event_retention = event_retention
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5.0)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS shared_kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)'
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS shared_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                origin TEXT NOT NULL,
+                channel TEXT NOT NULL,
+                message TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        self._last_event_id = 0
+        self._pruned_at = 0.0
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+
+    # ========================================
+    # 内部処理（SQLite）
+    # ========================================
+
+    def _execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._conn.execute(sql, params)
+
+    def _get(self, key: str) -> Any:
+        row = self._execute('SELECT value FROM shared_kv WHERE key = ? AND expires_at > ?', (key, time.time())).fetchone()
+        return orjson.loads(row[0]) if row is not None else None
+
+    def _set(self, key: str, value: str, ttl: float) -> None:
+        self._execute('INSERT OR REPLACE INTO shared_kv (key, value, expires_at) VALUES (?, ?, ?)',
+                      (key, value, time.time() + ttl))
+
+    def _add(self, key: str, value: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            self._conn.execute('DELETE FROM shared_kv WHERE key = ? AND expires_at <= ?', (key, now))
+            cur = self._conn.execute('INSERT OR IGNORE INTO shared_kv (key, value, expires_at) VALUES (?, ?, ?)',
+                                     (key, value, now + ttl))
+        return cur.rowcount == 1
+
+    def _pop(self, key: str) -> Any:
+        with self._lock:
+            # 読んでから消すまでの間に他のワーカーが同じキーを取らないよう、書き込みロックを先に取る
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute(
+                    'SELECT value FROM shared_kv WHERE key = ? AND expires_at > ?', (key, time.time())).fetchone()
+                self._conn.execute('DELETE FROM shared_kv WHERE key = ?', (key,))
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        return orjson.loads(row[0]) if row is not None else None
+
+    def _acquire(self, key: str, ttl: float) -> bool:
+        # 自分が持っているか期限切れのときだけ書き換わる（書き換わった行数で取れたかが分かる）
+        now = time.time()
+        owner = orjson.dumps(self.origin).decode()
+        cur = self._execute(
+            'INSERT INTO shared_kv (key, value, expires_at) VALUES (?, ?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at '
+            'WHERE shared_kv.value = excluded.value OR shared_kv.expires_at <= ?',
+            (key, owner, now + ttl, now),
+        )
+        return cur.rowcount == 1
+
+    def _release(self, key: str) -> None:
+        self._execute('DELETE FROM shared_kv WHERE key = ? AND value = ?', (key, orjson.dumps(self.origin).decode()))
+
+    def _publish(self, channel: str, message: str) -> None:
+        self._execute('INSERT INTO shared_events (origin, channel, message, created_at) VALUES (?, ?, ?, ?)',
+                      (self.origin, channel, message, time.time()))
+
+    def _events(self, after: int, limit: int = 500) -> List[Tuple[int, str, str, str]]:
+        return self._execute(
+            'SELECT id, origin, channel, message FROM shared_events WHERE id > ? ORDER BY id LIMIT ?', (after, limit)
+        ).fetchall()
+
+    def _prune(self) -> None:
+        now = time.time()
+        self._execute('DELETE FROM shared_events WHERE created_at < ?', (now - self.event_retention,))
+        self._execute('DELETE FROM shared_kv WHERE expires_at <= ?', (now,))
+
+    # ========================================
+    # キーと値
+    # ========================================
+
+    async def get(self, key: str) -> Any:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        await asyncio.to_thread(self._set, key, orjson.dumps(value).decode(), ttl)
+
+    async def add(self, key: str, value: Any, ttl: float) -> bool:
+        """キーが無い（期限切れを含む）ときだけ書く。書けたら True"""
+        return await asyncio.to_thread(self._add, key, orjson.dumps(value).decode(), ttl)
+
+    async def pop(self, key: str) -> Any:
+        return await asyncio.to_thread(self._pop, key)
+
+    async def delete(self, key: str) -> None:
+        await asyncio.to_thread(self._execute, 'DELETE FROM shared_kv WHERE key = ?', (key,))
+
+    async def acquire(self, name: str, ttl: float) -> bool:
+        """リースを取る（自分が持っていれば延長する）。取れたら True"""
+        return await asyncio.to_thread(self._acquire, 'lease:' + name, ttl)
+
+    async def release(self, name: str) -> None:
+        await asyncio.to_thread(self._release, 'lease:' + name)
+
+    # ========================================
+    # イベント
+    # ========================================
+
+    async def publish(self, channel: str, message: Any) -> None:
+        """他のワーカーにイベントを送る（送信に失敗しても呼び出し元の処理は止めない）"""
+        try:
+            await asyncio.to_thread(self._publish, channel, orjson.dumps(message).decode())
+        except sqlite3.Error as e:
+            logger.warning("shared state publish failed", extra={'channel': channel, 'error': repr(e)})
+            return
+        SHARED_EVENTS.inc(channel=channel, direction='published')
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._stopping = False
+            # 起動前のイベントは読まない（状態は各自が DB から読み込む）
+            row = self._execute('SELECT MAX(id) FROM shared_events').fetchone()
+            self._last_event_id = row[0] or 0
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                await self.poll_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("shared state poll error")
+            await asyncio.sleep(self.poll_interval)
+
+    async def poll_once(self) -> int:
+        """届いているイベントを購読者に渡す。渡した件数を返す"""
+        delivered = 0
+        while True:
+            rows = await asyncio.to_thread(self._events, self._last_event_id)
+            for event_id, origin, channel, message in rows:
+                self._last_event_id = event_id
+                if origin == self.origin:
+                    continue
+                await self._dispatch(channel, orjson.loads(message))
+                delivered += 1
+            if len(rows) < 500:
+                break
+        now = time.monotonic()
+        if now - self._pruned_at >= self.event_retention / 2:
+            self._pruned_at = now
+            await asyncio.to_thread(self._prune)
+        return delivered
+
+    async def close(self) -> None:
+        self._stopping = True
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        with self._lock:
+            self._conn.close()
+
+
+def open_shared_state(url: Optional[str]) -> Any:
+    """`local`（または空）ならプロセス内、`sqlite:///path` なら共有 SQLite ファイルの実装を返す"""
+    if not url or url == 'local':
+        return LocalState()
+    if url.startswith('sqlite:///'):
+        return SqliteState(url[len('sqlite:///'):])
+    raise ValueError(f"unsupported SHARED_STATE: {url}")
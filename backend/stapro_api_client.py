@@ -16,44 +16,207 @@
 
 import requests
 import logging
-from typing import Optional, Dict, List, Any
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from typing import Optional, Dict, List, Any, Iterator, Tuple
 from datetime import date
 
+from http_cache import ValidatorCache
+from metrics import current_operation, timed_operation
+from stapro_api_common import (
+    ATTENDANCES_PER_PAGE, DEFAULT_CONNECT_TIMEOUT, DEFAULT_TIMEOUT, LOGIN_ENDPOINTS,
+    STAPRO_COALESCED, STAPRO_RESPONSES, STAPRO_REVALIDATIONS, STAPRO_SECONDS,
+    attendance_page_params, attendance_page_rows, in_work_day_range, next_attendance_page,
+)
+
+
+_timed = timed_operation(STAPRO_SECONDS)
+
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    """実行中の GET 1 件。先に来たスレッドが上流を呼び、後から来たスレッドは結果を待つ"""
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
 
 class StaproAPIClient:
     """スタートプログラミング スタッフ管理システム API クライアント"""
 
-    def __init__(self, base_url: str, api_token: str):
+    def __init__(
+        self,
+        base_url: str,
+        api_token: str,
+        pool_connections: int = 10,
+        pool_maxsize: int = 10,
+        timeout: Optional[float] = DEFAULT_TIMEOUT,
+        connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+        validator_cache_size: int = 512,
+    ):
         """
         Args:
             base_url: APIのベースURL（例: http://localhost:3000）
             api_token: APIトークン
+            pool_connections: 接続プールを保持するホスト数
+            pool_maxsize: ホストごとに保持する keep-alive 接続の上限
+            timeout: 応答の読み取りのタイムアウト秒数（None なら無制限）
+            connect_timeout: 接続を確立するまでのタイムアウト秒数
+            validator_cache_size: 条件付き GET のために保持する応答の件数
         """
         self.base_url = base_url.rstrip('/')
         self.api_token = api_token
+        # requests は (接続, 読み取り) の組でタイムアウトを受け取る
+        self.timeout = (min(connect_timeout, timeout), timeout) if timeout is not None else None
         self.session = requests.Session()
         self.session.headers.update({
             'Authorization': f'Bearer {api_token}',
-            'Content-Type': 'application/json'
+            'Content-Type': 'application/json',
+            'Connection': 'keep-alive',
         })
+        # 1 つのクライアントを複数リクエストで共有するため、同時実行数に合わせてプールを広げる
+        self.adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        # 認証に成功したログイン API（未確定なら None）
+        self._login_endpoint: Optional[str] = None
+        # 実行中の GET（エンドポイントとクエリ → 上流への 1 回の呼び出し）
+        self._inflight: Dict[Tuple[str, Tuple[Tuple[str, Any], ...]], _Flight] = {}
+        self._inflight_lock = threading.Lock()
+        # ETag / Last-Modified の付いた GET の応答（次回は条件付きで問い合わせる。_inflight_lock で保護する）
+        self.validators = ValidatorCache(validator_cache_size)
+
+    def close(self) -> None:
+        """セッションと接続プールを閉じる"""
+        self.session.close()
+
+    def __enter__(self) -> 'StaproAPIClient':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def pool_stats(self) -> List[Dict[str, Any]]:
+        """
+        接続プールの状態を取得
 
-    def _get(self, endpoint: str) -> Dict[str, Any]:
-        """GETリクエストを送信"""
-        response = self.session.get(f"{self.base_url}{endpoint}")
+        Returns:
+            ホストごとのプール情報（作成した接続数・送信リクエスト数・待機中の接続数）
+        """
+        pools = self.adapter.poolmanager.pools
+        stats = []
+        with pools.lock:
+            keys = list(pools.keys())
+        for key in keys:
+            pool = pools.get(key)
+            if pool is None or pool.pool is None:
+                continue
+            # キューには未使用枠の None も入っているので、実際の接続だけを数える
+            idle = sum(1 for conn in list(pool.pool.queue) if conn is not None)
+            stats.append({
+                'scheme': key.key_scheme,
+                'host': key.key_host,
+                'port': key.key_port,
+                'maxsize': pool.pool.maxsize,
+                'idle': idle,
+                'connections_created': pool.num_connections,
+                'requests': pool.num_requests,
+            })
+        return stats
+
+    def _request(self, method: str, endpoint: str, **kwargs: Any) -> requests.Response:
+        """リクエストを送信し、応答ステータスをメトリクスに、所要時間をログに記録する"""
+        operation = current_operation.get()
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, f"{self.base_url}{endpoint}", timeout=self.timeout, **kwargs)
+        except requests.exceptions.RequestException as e:
+            STAPRO_RESPONSES.inc(method=operation, status='error')
+            logger.warning("stapro request failed", extra={
+                'operation': operation, 'method': method, 'endpoint': endpoint,
+                'duration_ms': round((time.perf_counter() - started) * 1000, 2), 'error': repr(e),
+            })
+            raise
+        STAPRO_RESPONSES.inc(method=operation, status=response.status_code)
+        ok = response.status_code < 400
+        logger.log(logging.INFO if ok else logging.WARNING, "stapro request", extra={
+            'operation': operation, 'method': method, 'endpoint': endpoint, 'status': response.status_code,
+            'duration_ms': round((time.perf_counter() - started) * 1000, 2), 'sampled': ok,
+        })
+        return response
+
+    def _get(self, endpoint: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """GETリクエストを送信
+
+        同じ GET（エンドポイントとクエリが同じ）が別スレッドで実行中なら新たに送らず、その結果（例外も）を共有する。
+        共有した結果は呼び出し側で書き換えないこと。
+        """
+        key = (endpoint, tuple(sorted(params.items())) if params else ())
+        with self._inflight_lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+        if not leader:
+            STAPRO_COALESCED.inc(method=current_operation.get())
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self._fetch(key, endpoint, params)
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+            flight.done.set()
+
+    def _fetch(
+        self, key: Tuple[str, Tuple[Tuple[str, Any], ...]], endpoint: str, params: Optional[Dict[str, Any]],
+    ) -> Dict[str, Any]:
+        """前回の応答に検証子があれば条件付きで GET し、304 なら前回の応答を返す"""
+        with self._inflight_lock:
+            cached = self.validators.get(key)
+        headers = cached.conditional_headers() if cached is not None else None
+        response = self._request('GET', endpoint, params=params, headers=headers)
+        if cached is not None:
+            # 別の GET を送っているスレッドも数えるので、カウンターもロックの中で更新する
+            if response.status_code == 304:
+                with self._inflight_lock:
+                    self.validators.not_modified += 1
+                STAPRO_REVALIDATIONS.inc(method=current_operation.get(), result='not_modified')
+                return cached.data
+            with self._inflight_lock:
+                self.validators.modified += 1
+            STAPRO_REVALIDATIONS.inc(method=current_operation.get(), result='modified')
         response.raise_for_status()
-        return response.json()
+        data = response.json()
+        with self._inflight_lock:
+            self.validators.store(key, response.headers.get('etag'), response.headers.get('last-modified'), data)
+        return data
 
     def _post(self, endpoint: str, data: Dict[str, Any]) -> Dict[str, Any]:
         """POSTリクエストを送信"""
-        response = self.session.post(f"{self.base_url}{endpoint}", json=data)
+        response = self._request('POST', endpoint, json=data)
         try:
             response.raise_for_status()
         except requests.exceptions.HTTPError as e:
-            # Log status at error level, but payload/response body at debug level
+            # ステータスは _request が WARNING で出しているので、送信内容と応答本文は DEBUG だけに出す
             try:
-                logging.error("Stapro API POST %s returned %s", endpoint, response.status_code)
-                logging.debug("Request payload: %s", data)
-                logging.debug("Response body: %s", response.text)
+                logger.debug("stapro request rejected", extra={
+                    'endpoint': endpoint, 'status': response.status_code, 'payload': data, 'body': response.text,
+                })
             except Exception:
                 pass
             raise
@@ -61,7 +224,7 @@ class StaproAPIClient:
 
     def _delete(self, endpoint: str) -> Dict[str, Any]:
         """DELETEリクエストを送信"""
-        response = self.session.delete(f"{self.base_url}{endpoint}")
+        response = self._request('DELETE', endpoint)
         response.raise_for_status()
         return response.json()
 
@@ -69,6 +232,7 @@ class StaproAPIClient:
     # 認証API
     # ========================================
 
+    @_timed
     def authenticate(self, email: str, password: str) -> Dict[str, Any]:
         """
         ユーザー認証（ID, PWでユーザー情報を取得）
@@ -92,11 +256,23 @@ class StaproAPIClient:
         """
         # Try common login endpoints. Some deployments expose `/auth/login` (proxy),
         # others use `/api/v1/auth/login` (direct API). Try both and return the first success.
+        # The endpoint that worked is remembered so later calls don't probe again.
         payload = {'email': email, 'password': password}
+        if self._login_endpoint is not None:
+            try:
+                return self._post(self._login_endpoint, payload)
+            except requests.exceptions.HTTPError as e:
+                status = getattr(e.response, 'status_code', None)
+                if status not in (404, 405):
+                    raise
+                # the remembered endpoint went away — probe again
+                self._login_endpoint = None
         last_exc = None
-        for endpoint in ['/api/v1/auth/login', '/auth/login']:
+        for endpoint in LOGIN_ENDPOINTS:
             try:
-                return self._post(endpoint, payload)
+                result = self._post(endpoint, payload)
+                self._login_endpoint = endpoint
+                return result
             except requests.exceptions.HTTPError as e:
                 # keep the last exception to raise if all attempts fail
                 last_exc = e
@@ -112,6 +288,7 @@ class StaproAPIClient:
     # スタッフAPI
     # ========================================
 
+    @_timed
     def get_staff(self, staff_id: int) -> Dict[str, Any]:
         """
         スタッフ情報取得（ID指定）
@@ -137,6 +314,7 @@ class StaproAPIClient:
     # 教室API
     # ========================================
 
+    @_timed
     def get_schools(self) -> List[Dict[str, Any]]:
         """
         教室一覧取得
@@ -151,6 +329,7 @@ class StaproAPIClient:
         """
         return self._get('/api/v1/schools')
 
+    @_timed
     def get_school(self, school_id: int) -> Dict[str, Any]:
         """
         教室詳細取得
@@ -172,6 +351,7 @@ class StaproAPIClient:
     # 勤怠情報API
     # ========================================
 
+    @_timed
     def get_attendances(self, staff_id: int) -> Dict[str, Any]:
         """
         勤怠情報一覧取得（スタッフID指定）
@@ -189,6 +369,70 @@ class StaproAPIClient:
         """
         return self._get(f'/api/v1/staffs/{staff_id}/attendances')
 
+    @_timed
+    def get_attendances_page(
+        self,
+        staff_id: int,
+        page: int = 1,
+        per_page: int = ATTENDANCES_PER_PAGE,
+        work_day_from: Optional[str] = None,
+        work_day_to: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        勤怠情報一覧の 1 ページ分を取得（スタッフID指定）
+
+        Args:
+            staff_id: スタッフID
+            page: ページ番号（1 始まり）
+            per_page: 1 ページあたりの件数
+            work_day_from: 勤務日の下限（YYYY-MM-DD）
+            work_day_to: 勤務日の上限（YYYY-MM-DD）
+
+        Returns:
+            勤怠情報一覧（上流の応答そのまま）
+        """
+        params = attendance_page_params(page, per_page, work_day_from, work_day_to)
+        return self._get(f'/api/v1/staffs/{staff_id}/attendances', params=params)
+
+    def iter_attendances(
+        self,
+        staff_id: int,
+        per_page: int = ATTENDANCES_PER_PAGE,
+        work_day_from: Optional[str] = None,
+        work_day_to: Optional[str] = None,
+        first_page: Any = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        勤怠情報を 1 件ずつ返す（1 ページずつ取得するので、件数が多くても手元には 1 ページ分しか持たない）
+
+        引数は `get_attendances_page` と同じ。`first_page` に取得済みの 1 ページ目の応答を渡すと、
+        1 ページ目は取得し直さずにそれを使う。
+
+        Example:
+            >>> for attendance in client.iter_attendances(1, work_day_from='2024-04-01'):
+            ...     print(attendance['work_day'])
+        """
+        page: Optional[int] = 1
+        previous_first = None
+        while page is not None:
+            if page == 1 and first_page is not None:
+                data = first_page
+            else:
+                data = self.get_attendances_page(staff_id, page, per_page, work_day_from, work_day_to)
+            rows = attendance_page_rows(data)
+            if not rows:
+                return
+            # page を無視して毎回同じ先頭ページを返す上流では、2 ページ目で打ち切る
+            first = rows[0].get('id')
+            if page > 1 and first is not None and first == previous_first:
+                return
+            previous_first = first
+            page = next_attendance_page(data, page, per_page, rows)
+            for row in rows:
+                if in_work_day_range(row, work_day_from, work_day_to):
+                    yield row
+
+    @_timed
     def get_attendance(self, attendance_id: int) -> Dict[str, Any]:
         """
         勤怠情報詳細取得（ID指定）
@@ -205,6 +449,7 @@ class StaproAPIClient:
         """
         return self._get(f'/api/v1/attendances/{attendance_id}')
 
+    @_timed
     def create_attendance(
         self,
         staff_id: int,
@@ -262,6 +507,51 @@ class StaproAPIClient:
         }
         return self._post('/api/v1/attendances', payload)
 
+    @_timed
+    def create_attendances_bulk(
+        self,
+        attendances: List[Dict[str, Any]],
+        max_concurrency: int = 8,
+    ) -> List[Dict[str, Any]]:
+        """
+        勤怠情報の一括登録（同時実行数を制限して並列に送信）
+
+        Stapro に一括登録 API が無いため、`create_attendance` を並列に呼び出す。
+        422 は同じ勤務日の勤怠が登録済みとみなす。
+
+        Args:
+            attendances: `create_attendance` のキーワード引数の配列
+            max_concurrency: 同時に送信する件数の上限
+
+        Returns:
+            入力と同じ順序の結果の配列。各要素は
+            {'status': 'created' | 'already_exists' | 'error', 'http_status', 'data', 'error'}
+
+        Example:
+            >>> results = client.create_attendances_bulk([
+            ...     {'staff_id': 1, 'work_day': '2024-01-15', 'school_id': 1, 'commuting_costs': 500,
+            ...      'another_time': 0.0, 'total_lesson': 2, 'lesson_ids': [1, 2]},
+            ... ])
+            >>> print(results[0]['status'])
+        """
+        def submit(attendance: Dict[str, Any]) -> Dict[str, Any]:
+            try:
+                data = self.create_attendance(**attendance)
+                return {'status': 'created', 'http_status': None, 'data': data, 'error': None}
+            except requests.exceptions.HTTPError as e:
+                status = getattr(e.response, 'status_code', None)
+                if status == 422:
+                    return {'status': 'already_exists', 'http_status': status, 'data': None, 'error': None}
+                return {'status': 'error', 'http_status': status, 'data': None, 'error': str(e)}
+            except Exception as e:
+                return {'status': 'error', 'http_status': None, 'data': None, 'error': str(e)}
+
+        if not attendances:
+            return []
+        with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(attendances)))) as executor:
+            return list(executor.map(submit, attendances))
+
+    @_timed
     def delete_attendance(self, attendance_id: int) -> Dict[str, Any]:
         """
         勤怠情報削除
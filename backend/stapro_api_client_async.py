@@ -0,0 +1,467 @@
+"""
+スタートプログラミング スタッフ管理システム API クライアント（非同期版）
+
+同期版 `StaproAPIClient` と同じメソッドを httpx の非同期クライアントで提供する。
+FastAPI の `async def` ハンドラーからスレッドプールを使わずに呼び出せる。
+
+使用方法:
+    from stapro_api_client_async import AsyncStaproAPIClient
+
+    async with AsyncStaproAPIClient(
+        base_url="http://localhost:3000",
+        api_token="your_api_token_here"
+    ) as client:
+        user = await client.authenticate("user@example.com", "password123")
+        print(user)
+"""
+
+import asyncio
+import logging
+import time
+from typing import Optional, Dict, List, Any, AsyncIterator, Tuple
+
+import httpx
+
+from http_cache import ValidatorCache
+from metrics import current_operation, timed_operation
+from stapro_api_common import (
+    ATTENDANCES_PER_PAGE, DEFAULT_CONNECT_TIMEOUT, DEFAULT_TIMEOUT, LOGIN_ENDPOINTS,
+    STAPRO_COALESCED, STAPRO_RESPONSES, STAPRO_REVALIDATIONS, STAPRO_SECONDS,
+    attendance_page_params, attendance_page_rows, in_work_day_range, next_attendance_page,
+)
+
+
+_timed = timed_operation(STAPRO_SECONDS)
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncStaproAPIClient:
+    """スタートプログラミング スタッフ管理システム API クライアント（非同期版）"""
+
+    def __init__(
+        self,
+        base_url: str,
+        api_token: str,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 32,
+        timeout: Optional[float] = DEFAULT_TIMEOUT,
+        connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+        validator_cache_size: int = 512,
+    ):
+        """
+        Args:
+            base_url: APIのベースURL（例: http://localhost:3000）
+            api_token: APIトークン
+            max_connections: 同時に開く接続の上限
+            max_keepalive_connections: keep-alive で保持する接続の上限
+            timeout: 応答の読み取り・送信・接続待ちのタイムアウト秒数（None なら無制限）
+            connect_timeout: 接続を確立するまでのタイムアウト秒数
+            validator_cache_size: 条件付き GET のために保持する応答の件数
+        """
+        self.base_url = base_url.rstrip('/')
+        self.api_token = api_token
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+        )
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers={
+                'Authorization': f'Bearer {api_token}',
+                'Content-Type': 'application/json',
+            },
+            limits=self.limits,
+            timeout=httpx.Timeout(timeout, connect=min(connect_timeout, timeout)) if timeout is not None else None,
+        )
+        # 認証に成功したログイン API（未確定なら None）
+        self._login_endpoint: Optional[str] = None
+        # 実行中の GET（エンドポイントとクエリ → 上流への 1 回の呼び出し）
+        self._inflight: Dict[Tuple[str, Tuple[Tuple[str, Any], ...]], asyncio.Task] = {}
+        # ETag / Last-Modified の付いた GET の応答（次回は条件付きで問い合わせる）
+        self.validators = ValidatorCache(validator_cache_size)
+
+    async def aclose(self) -> None:
+        """接続プールを閉じる"""
+        await self.client.aclose()
+
+    async def __aenter__(self) -> 'AsyncStaproAPIClient':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+    def pool_stats(self) -> List[Dict[str, Any]]:
+        """
+        接続プールの状態を取得
+
+        Returns:
+            プール情報（接続上限・保持中の接続数・待機中の接続数）
+        """
+        pool = getattr(getattr(self.client, '_transport', None), '_pool', None)
+        connections = list(getattr(pool, 'connections', []) or [])
+        return [{
+            'host': self.base_url,
+            'max_connections': self.limits.max_connections,
+            'max_keepalive_connections': self.limits.max_keepalive_connections,
+            'connections': len(connections),
+            'idle': sum(1 for conn in connections if conn.is_idle()),
+        }]
+
+    async def _request(self, method: str, endpoint: str, **kwargs: Any) -> httpx.Response:
+        """リクエストを送信し、応答ステータスをメトリクスに、所要時間をログに記録する"""
+        operation = current_operation.get()
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, endpoint, **kwargs)
+        except httpx.HTTPError as e:
+            STAPRO_RESPONSES.inc(method=operation, status='error')
+            logger.warning("stapro request failed", extra={
+                'operation': operation, 'method': method, 'endpoint': endpoint,
+                'duration_ms': round((time.perf_counter() - started) * 1000, 2), 'error': repr(e),
+            })
+            raise
+        STAPRO_RESPONSES.inc(method=operation, status=response.status_code)
+        ok = response.status_code < 400
+        logger.log(logging.INFO if ok else logging.WARNING, "stapro request", extra={
+            'operation': operation, 'method': method, 'endpoint': endpoint, 'status': response.status_code,
+            'duration_ms': round((time.perf_counter() - started) * 1000, 2), 'sampled': ok,
+        })
+        return response
+
+    async def _get(self, endpoint: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """GETリクエストを送信
+
+        同じ GET（エンドポイントとクエリが同じ）が実行中なら新たに送らず、その結果（例外も）を共有する。
+        共有した結果は呼び出し側で書き換えないこと。
+        """
+        key = (endpoint, tuple(sorted(params.items())) if params else ())
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._fetch(key, endpoint, params))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finish_flight(key, done))
+        else:
+            STAPRO_COALESCED.inc(method=current_operation.get())
+        # 待っている呼び出しの 1 つがキャンセルされても、上流への呼び出しは他の呼び出しのために続ける
+        return await asyncio.shield(task)
+
+    def _finish_flight(self, key: Tuple[str, Tuple[Tuple[str, Any], ...]], task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            # 待ち手が全員キャンセルされていても「取り出されなかった例外」の警告を出さない
+            task.exception()
+
+    async def _fetch(
+        self, key: Tuple[str, Tuple[Tuple[str, Any], ...]], endpoint: str, params: Optional[Dict[str, Any]],
+    ) -> Dict[str, Any]:
+        """前回の応答に検証子があれば条件付きで GET し、304 なら前回の応答を返す"""
+        cached = self.validators.get(key)
+        headers = cached.conditional_headers() if cached is not None else None
+        response = await self._request('GET', endpoint, params=params, headers=headers)
+        if cached is not None:
+            if response.status_code == 304:
+                self.validators.not_modified += 1
+                STAPRO_REVALIDATIONS.inc(method=current_operation.get(), result='not_modified')
+                return cached.data
+            self.validators.modified += 1
+            STAPRO_REVALIDATIONS.inc(method=current_operation.get(), result='modified')
+        response.raise_for_status()
+        data = response.json()
+        self.validators.store(key, response.headers.get('etag'), response.headers.get('last-modified'), data)
+        return data
+
+    async def _post(self, endpoint: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        """POSTリクエストを送信"""
+        response = await self._request('POST', endpoint, json=data)
+        try:
+            response.raise_for_status()
+        except httpx.HTTPStatusError:
+            # ステータスは _request が WARNING で出しているので、送信内容と応答本文は DEBUG だけに出す
+            try:
+                logger.debug("stapro request rejected", extra={
+                    'endpoint': endpoint, 'status': response.status_code, 'payload': data, 'body': response.text,
+                })
+            except Exception:
+                pass
+            raise
+        return response.json()
+
+    async def _delete(self, endpoint: str) -> Dict[str, Any]:
+        """DELETEリクエストを送信"""
+        response = await self._request('DELETE', endpoint)
+        response.raise_for_status()
+        return response.json()
+
+    # ========================================
+    # 認証API
+    # ========================================
+
+    @_timed
+    async def authenticate(self, email: str, password: str) -> Dict[str, Any]:
+        """
+        ユーザー認証（ID, PWでユーザー情報を取得）
+
+        Args:
+            email: メールアドレス
+            password: パスワード
+
+        Returns:
+            ユーザー情報
+        """
+        # `/api/v1/auth/login`（直接）と `/auth/login`（プロキシ）の両方を順に試す。
+        # 一度成功したエンドポイントは覚えておき、以降はそこだけを呼ぶ
+        payload = {'email': email, 'password': password}
+        if self._login_endpoint is not None:
+            try:
+                return await self._post(self._login_endpoint, payload)
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code not in (404, 405):
+                    raise
+                # エンドポイントが無くなった場合だけ探し直す
+                self._login_endpoint = None
+        last_exc = None
+        for endpoint in LOGIN_ENDPOINTS:
+            try:
+                result = await self._post(endpoint, payload)
+                self._login_endpoint = endpoint
+                return result
+            except httpx.HTTPStatusError as e:
+                last_exc = e
+                continue
+        if last_exc:
+            raise last_exc
+        raise Exception('Authentication failed for unknown reasons')
+
+    # ========================================
+    # スタッフAPI
+    # ========================================
+
+    @_timed
+    async def get_staff(self, staff_id: int) -> Dict[str, Any]:
+        """
+        スタッフ情報取得（ID指定）
+
+        Args:
+            staff_id: スタッフID
+
+        Returns:
+            スタッフ情報
+        """
+        return await self._get(f'/api/v1/staffs/{staff_id}')
+
+    # ========================================
+    # 教室API
+    # ========================================
+
+    @_timed
+    async def get_schools(self) -> List[Dict[str, Any]]:
+        """
+        教室一覧取得
+
+        Returns:
+            教室一覧
+        """
+        return await self._get('/api/v1/schools')
+
+    @_timed
+    async def get_school(self, school_id: int) -> Dict[str, Any]:
+        """
+        教室詳細取得
+
+        Args:
+            school_id: 教室ID
+
+        Returns:
+            教室情報（timetables を含む）
+        """
+        return await self._get(f'/api/v1/schools/{school_id}')
+
+    # ========================================
+    # 勤怠情報API
+    # ========================================
+
+    @_timed
+    async def get_attendances(self, staff_id: int) -> Dict[str, Any]:
+        """
+        勤怠情報一覧取得（スタッフID指定）
+
+        Args:
+            staff_id: スタッフID
+
+        Returns:
+            勤怠情報一覧
+        """
+        return await self._get(f'/api/v1/staffs/{staff_id}/attendances')
+
+    @_timed
+    async def get_attendances_page(
+        self,
+        staff_id: int,
+        page: int = 1,
+        per_page: int = ATTENDANCES_PER_PAGE,
+        work_day_from: Optional[str] = None,
+        work_day_to: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        勤怠情報一覧の 1 ページ分を取得（スタッフID指定）
+
+        Args:
+            staff_id: スタッフID
+            page: ページ番号（1 始まり）
+            per_page: 1 ページあたりの件数
+            work_day_from: 勤務日の下限（YYYY-MM-DD）
+            work_day_to: 勤務日の上限（YYYY-MM-DD）
+
+        Returns:
+            勤怠情報一覧（上流の応答そのまま）
+        """
+        params = attendance_page_params(page, per_page, work_day_from, work_day_to)
+        return await self._get(f'/api/v1/staffs/{staff_id}/attendances', params=params)
+
+    async def iter_attendances(
+        self,
+        staff_id: int,
+        per_page: int = ATTENDANCES_PER_PAGE,
+        work_day_from: Optional[str] = None,
+        work_day_to: Optional[str] = None,
+        first_page: Any = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        勤怠情報を 1 件ずつ返す（1 ページずつ取得するので、件数が多くても手元には 1 ページ分しか持たない）
+
+        引数は `get_attendances_page` と同じ。`first_page` に取得済みの 1 ページ目の応答を渡すと、
+        1 ページ目は取得し直さずにそれを使う。
+        """
+        page: Optional[int] = 1
+        previous_first = None
+        while page is not None:
+            if page == 1 and first_page is not None:
+                data = first_page
+            else:
+                data = await self.get_attendances_page(staff_id, page, per_page, work_day_from, work_day_to)
+            rows = attendance_page_rows(data)
+            if not rows:
+                return
+            # page を無視して毎回同じ先頭ページを返す上流では、2 ページ目で打ち切る
+            first = rows[0].get('id')
+            if page > 1 and first is not None and first == previous_first:
+                return
+            previous_first = first
+            page = next_attendance_page(data, page, per_page, rows)
+            for row in rows:
+                if in_work_day_range(row, work_day_from, work_day_to):
+                    yield row
+
+    @_timed
+    async def get_attendance(self, attendance_id: int) -> Dict[str, Any]:
+        """
+        勤怠情報詳細取得（ID指定）
+
+        Args:
+            attendance_id: 勤怠情報ID
+
+        Returns:
+            勤怠情報
+        """
+        return await self._get(f'/api/v1/attendances/{attendance_id}')
+
+    @_timed
+    async def create_attendance(
+        self,
+        staff_id: int,
+        work_day: str,
+        school_id: int,
+        commuting_costs: int,
+        another_time: float,
+        total_lesson: int,
+        lesson_ids: List[int],
+        total_training_lesson: int = 0,
+        deduction_time: float = 0.0,
+        note: str = ""
+    ) -> Dict[str, Any]:
+        """
+        勤怠情報登録
+
+        引数は同期版 `StaproAPIClient.create_attendance` と同じ。
+
+        Returns:
+            登録した勤怠情報
+        """
+        payload = {
+            'staff_id': staff_id,
+            'work_day': work_day,
+            'school_id': school_id,
+            'commuting_costs': commuting_costs,
+            'another_time': another_time,
+            'total_lesson': total_lesson,
+            'lesson_ids': lesson_ids,
+            'total_training_lesson': total_training_lesson,
+            'deduction_time': deduction_time,
+            'note': note,
+        }
+        return await self._post('/api/v1/attendances', payload)
+
+    @_timed
+    async def create_attendances_bulk(
+        self,
+        attendances: List[Dict[str, Any]],
+        max_concurrency: int = 8,
+    ) -> List[Dict[str, Any]]:
+        """
+        勤怠情報の一括登録（同時実行数を制限して並列に送信）
+
+        Args:
+            attendances: `create_attendance` のキーワード引数の配列
+            max_concurrency: 同時に送信する件数の上限
+
+        Returns:
+            入力と同じ順序の結果の配列（形式は同期版と同じ）
+        """
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+        async def submit(attendance: Dict[str, Any]) -> Dict[str, Any]:
+            async with semaphore:
+                try:
+                    data = await self.create_attendance(**attendance)
+                    return {'status': 'created', 'http_status': None, 'data': data, 'error': None}
+                except httpx.HTTPStatusError as e:
+                    status = e.response.status_code
+                    if status == 422:
+                        return {'status': 'already_exists', 'http_status': status, 'data': None, 'error': None}
+                    return {'status': 'error', 'http_status': status, 'data': None, 'error': str(e)}
+                except Exception as e:
+                    return {'status': 'error', 'http_status': None, 'data': None, 'error': str(e)}
+
+        return list(await asyncio.gather(*(submit(a) for a in attendances)))
+
+    @_timed
+    async def delete_attendance(self, attendance_id: int) -> Dict[str, Any]:
+        """
+        勤怠情報削除
+
+        Args:
+            attendance_id: 勤怠情報ID
+
+        Returns:
+            削除結果
+        """
+        return await self._delete(f'/api/v1/attendances/{attendance_id}')
+
+
+if __name__ == '__main__':
+    async def _main():
+        async with AsyncStaproAPIClient(
+            base_url="http://localhost:3000",
+            api_token="your_api_token_here"
+        ) as client:
+            try:
+                schools = await client.get_schools()
+                print("教室一覧:")
+                for school in schools['schools']:
+                    print(f"- {school['name']} (ID: {school['id']})")
+            except httpx.HTTPStatusError as e:
+                print("教室一覧取得失敗:", e)
+
+    asyncio.run(_main())
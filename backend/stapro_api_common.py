@@ -0,0 +1,102 @@
+"""
+Stapro API クライアント（同期版・非同期版）で共有する定数・メトリクスと勤怠一覧のページング処理
+
+非同期版だけを使うプロセス（main.py）が requests を読み込まずに済むよう、同期版から切り出している。
+"""
+
+from typing import Any, Dict, List, Optional
+
+from metrics import REGISTRY
+
+
+# タイムアウトの既定値（秒）。上流が応答しないときに打刻などの処理を無制限に待たせない
+DEFAULT_TIMEOUT = 10.0
+DEFAULT_CONNECT_TIMEOUT = 3.0
+
+# ログイン API の候補（デプロイによって直接 API かプロキシ経由かが異なる）
+LOGIN_ENDPOINTS = ['/api/v1/auth/login', '/auth/login']
+
+# 呼び出しごとの所要時間と応答ステータス（/metrics で公開する）
+STAPRO_SECONDS = REGISTRY.histogram(
+    'stapro_request_duration_seconds', 'Stapro API 呼び出しの所要時間（メソッド別）', ['method'])
+STAPRO_RESPONSES = REGISTRY.counter(
+    'stapro_responses_total', 'Stapro API の応答数（メソッド・ステータスコード別。接続失敗は error）', ['method', 'status'])
+STAPRO_COALESCED = REGISTRY.counter(
+    'stapro_coalesced_requests_total', '実行中の同じ GET に相乗りして上流を呼ばなかった呼び出し数（メソッド別）', ['method'])
+STAPRO_REVALIDATIONS = REGISTRY.counter(
+    'stapro_conditional_requests_total',
+    'Stapro への条件付き GET の結果（not_modified は手元の応答を再利用した件数）', ['method', 'result'])
+
+
+# ========================================
+# 勤怠一覧のページング
+# ========================================
+
+# 1 ページあたりの件数の既定値
+ATTENDANCES_PER_PAGE = 100
+
+
+def attendance_page_params(
+    page: int,
+    per_page: int,
+    work_day_from: Optional[str] = None,
+    work_day_to: Optional[str] = None,
+) -> Dict[str, Any]:
+    """勤怠一覧 API に付けるクエリパラメーター（期間は上流が対応していれば絞り込みに使われる）"""
+    params: Dict[str, Any] = {'page': page, 'per_page': per_page}
+    if work_day_from:
+        params['from'] = work_day_from
+    if work_day_to:
+        params['to'] = work_day_to
+    return params
+
+
+def attendance_page_rows(data: Any) -> List[Dict[str, Any]]:
+    """勤怠一覧 API の応答から行の配列を取り出す（`{"attendances": [...]}` と配列そのものの両方に対応）"""
+    if isinstance(data, list):
+        return data
+    if isinstance(data, dict):
+        return data.get('attendances') or []
+    return []
+
+
+# `meta` のうち、1 ページ分の位置を表すキー（全ページをまとめた応答には当てはまらない）
+PAGE_CURSOR_KEYS = ('page', 'per_page', 'next_page', 'prev_page')
+
+
+def attendance_page_extras(data: Any) -> Dict[str, Any]:
+    """勤怠一覧 API の応答のうち、行の配列以外のキー（`meta` などをそのまま返すため）
+
+    全ページをまとめて返すときに使うので、`meta` からはページの位置を表すキーを除く。
+    """
+    if not isinstance(data, dict):
+        return {}
+    extras = {key: value for key, value in data.items() if key != 'attendances'}
+    meta = extras.get('meta')
+    if isinstance(meta, dict):
+        extras['meta'] = {key: value for key, value in meta.items() if key not in PAGE_CURSOR_KEYS}
+    return extras
+
+
+def next_attendance_page(data: Any, page: int, per_page: int, rows: List[Dict[str, Any]]) -> Optional[int]:
+    """次に読むページ番号。最後のページなら None
+
+    応答に `meta.next_page` があればそれに従う。無ければ件数で判断し、`per_page` より多く返ってきたときは
+    上流がページングに対応していない（1 回で全件が返った）とみなす。
+    """
+    meta = data.get('meta') if isinstance(data, dict) else None
+    if isinstance(meta, dict) and 'next_page' in meta:
+        return meta['next_page'] or None
+    if len(rows) != per_page:
+        return None
+    return page + 1
+
+
+def in_work_day_range(row: Dict[str, Any], work_day_from: Optional[str], work_day_to: Optional[str]) -> bool:
+    """行の `work_day` が期間（両端を含む）に入るか。上流が期間指定を無視した場合に備えて手元でも絞る"""
+    work_day = str(row.get('work_day') or '')[:10]
+    if work_day_from and work_day < work_day_from:
+        return False
+    if work_day_to and work_day > work_day_to:
+        return False
+    return True
@@ -1,24 +1,87 @@
-from fastapi import FastAPI, HTTPException, Depends
-from fastapi.responses import JSONResponse
+from contextlib import asynccontextmanager
+from datetime import date
+from fastapi import FastAPI, HTTPException, Depends, Query, Request
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from typing import List
+from typing import Any, AsyncIterator, Dict, List, Optional
+import logging
 import os
+import orjson
 from dotenv import load_dotenv
 
-from stapro_api_client import StaproAPIClient
+from stapro_api_client_async import AsyncStaproAPIClient
+from stapro_api_common import (
+    ATTENDANCES_PER_PAGE, attendance_page_extras, attendance_page_rows, next_attendance_page,
+)
+from http_cache import ETagBuilder, RenderCache, etag_matches
+from school_catalog import SchoolCatalog
+import metrics
+from metrics import REGISTRY, MetricsMiddleware
+import structured_logging
+from structured_logging import RequestLogMiddleware
 
 # 環境変数を読み込み
 load_dotenv()
 
+logger = logging.getLogger("stapro_system")
+
+# APIクライアントの設定
+STAPRO_API_URL = os.getenv("STAPRO_API_URL", "http://localhost:3000")
+STAPRO_API_TOKEN = os.getenv("STAPRO_API_TOKEN", "")
+STAPRO_MAX_CONNECTIONS = int(os.getenv("STAPRO_MAX_CONNECTIONS", "100"))
+STAPRO_POOL_MAXSIZE = int(os.getenv("STAPRO_POOL_MAXSIZE", "32"))
+STAPRO_TIMEOUT = float(os.getenv("STAPRO_TIMEOUT", "10"))
+STAPRO_CONNECT_TIMEOUT = float(os.getenv("STAPRO_CONNECT_TIMEOUT", "3"))
+
+# 教室カタログのキャッシュ設定（教室・タイムテーブルは週に一度程度しか変わらない）
+SCHOOL_CATALOG_TTL = float(os.getenv("SCHOOL_CATALOG_TTL", "3600"))
+SCHOOL_CATALOG_SNAPSHOT = os.getenv("SCHOOL_CATALOG_SNAPSHOT", "school_catalog.json")
+
+# キオスクが教室情報を再検証なしで使ってよい秒数（スタッフ・勤怠は毎回 ETag で再検証させる）
+SCHOOLS_CLIENT_MAX_AGE = int(os.getenv("SCHOOLS_CLIENT_MAX_AGE", "300"))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    structured_logging.start("stapro_system")
+    # プロセスで 1 つのクライアントを共有し、keep-alive 接続をリクエスト間で再利用する
+    app.state.stapro_client = AsyncStaproAPIClient(
+        base_url=STAPRO_API_URL,
+        api_token=STAPRO_API_TOKEN,
+        max_connections=STAPRO_MAX_CONNECTIONS,
+        max_keepalive_connections=STAPRO_POOL_MAXSIZE,
+        timeout=STAPRO_TIMEOUT,
+        connect_timeout=STAPRO_CONNECT_TIMEOUT,
+    )
+    # 前回のスナップショットから温かいデータで起動し、古ければバックグラウンドで取り直す
+    app.state.school_catalog = SchoolCatalog(
+        get_client=lambda: app.state.stapro_client,
+        ttl=SCHOOL_CATALOG_TTL,
+        snapshot_path=SCHOOL_CATALOG_SNAPSHOT,
+    )
+    app.state.school_catalog.load_snapshot()
+    metrics.watch_stapro_pool(lambda: getattr(app.state, 'stapro_client', None), "stapro_system")
+    metrics.watch_school_catalog(lambda: getattr(app.state, 'school_catalog', None), "stapro_system")
+    try:
+        yield
+    finally:
+        await app.state.stapro_client.aclose()
+        structured_logging.stop()
+
+
 app = FastAPI(
     title="スタートプログラミング API プロキシ",
     description="スタートプログラミング スタッフ管理システムのAPIを利用するサンプルアプリケーション",
     version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
-# APIクライアントの設定
-STAPRO_API_URL = os.getenv("STAPRO_API_URL", "http://localhost:3000")
-STAPRO_API_TOKEN = os.getenv("STAPRO_API_TOKEN", "")
+# ルートごとの所要時間を記録する（/metrics で公開）
+app.add_middleware(MetricsMiddleware, app_name="stapro_system")
+
+# リクエストIDの割り当てとアクセスログ
+app.add_middleware(RequestLogMiddleware)
 
 
 # ========================================
@@ -49,82 +112,202 @@ class AttendanceCreate(BaseModel):
 # ========================================
 
 
-def get_api_client():
-    """同期クライアントを返す依存関数（yield 形式）。"""
-    client = StaproAPIClient(base_url=STAPRO_API_URL, api_token=STAPRO_API_TOKEN)
-    try:
-        yield client
-    finally:
-        # StaproAPIClient は内部で requests.Session を使うので、明示的に閉じる場合はここで行う
-        try:
-            client.session.close()
-        except Exception:
-            pass
+async def get_api_client(request: Request) -> AsyncStaproAPIClient:
+    """lifespan で作成した共有クライアントを返す依存関数。"""
+    # セッションは lifespan の終了時に閉じるので、ここでは閉じない
+    return request.app.state.stapro_client
+
+
+async def get_school_catalog(request: Request) -> SchoolCatalog:
+    """lifespan で作成した教室カタログを返す依存関数。"""
+    return request.app.state.school_catalog
+
+
+# パス → JSON にした応答本文と ETag
+render_cache = RenderCache()
+
+
+def _conditional_json(request: Request, data: Any, cache_control: str) -> Response:
+    """ETag を付けて JSON を返す。クライアントの `If-None-Match` が一致すれば本文なしの 304 を返す"""
+    rendered = render_cache.render(request.url.path, data)
+    headers = {"ETag": rendered.etag, "Cache-Control": cache_control}
+    if etag_matches(request.headers.get("if-none-match"), rendered.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(rendered.body, media_type="application/json", headers=headers)
 
 
 # ========================================
-# エンドポイント（同期実装）
+# エンドポイント（非同期実装）
 # ========================================
 
 
 @app.get("/")
-def root():
+async def root():
     return {"message": "スタートプログラミング API プロキシ", "version": "1.0.0"}
 
 
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus テキスト形式のメトリクス"""
+    return Response(REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/pool-stats")
+async def pool_stats(client: AsyncStaproAPIClient = Depends(get_api_client)):
+    return {"pools": client.pool_stats(), "validators": client.validators.stats()}
+
+
 @app.post("/auth/login")
-def login(request: LoginRequest, client: StaproAPIClient = Depends(get_api_client)):
+async def login(request: LoginRequest, client: AsyncStaproAPIClient = Depends(get_api_client)):
     try:
-        user = client.authenticate(request.email, request.password)
+        user = await client.authenticate(request.email, request.password)
         return user
     except Exception as e:
         raise HTTPException(status_code=401, detail=f"認証失敗: {e}")
 
 
 @app.get("/staffs/{staff_id}")
-def get_staff(staff_id: int, client: StaproAPIClient = Depends(get_api_client)):
+async def get_staff(request: Request, staff_id: int, client: AsyncStaproAPIClient = Depends(get_api_client)):
     try:
-        return client.get_staff(staff_id)
+        staff = await client.get_staff(staff_id)
     except Exception as e:
         raise HTTPException(status_code=404, detail=f"スタッフが見つかりません: {e}")
+    return _conditional_json(request, staff, "private, no-cache")
 
 
 @app.get("/schools")
-def get_schools(client: StaproAPIClient = Depends(get_api_client)):
+async def get_schools(request: Request, catalog: SchoolCatalog = Depends(get_school_catalog)):
     try:
-        return client.get_schools()
+        schools = await catalog.get_schools()
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"教室一覧取得失敗: {e}")
+    return _conditional_json(request, schools, f"private, max-age={SCHOOLS_CLIENT_MAX_AGE}")
 
 
 @app.get("/schools/{school_id}")
-def get_school(school_id: int, client: StaproAPIClient = Depends(get_api_client)):
+async def get_school(request: Request, school_id: int, catalog: SchoolCatalog = Depends(get_school_catalog)):
     try:
-        return client.get_school(school_id)
+        school = await catalog.get_school(school_id)
     except Exception as e:
         raise HTTPException(status_code=404, detail=f"教室が見つかりません: {e}")
+    return _conditional_json(request, school, f"private, max-age={SCHOOLS_CLIENT_MAX_AGE}")
+
+
+@app.post("/schools/cache/invalidate")
+async def invalidate_schools(school_id: Optional[int] = None, catalog: SchoolCatalog = Depends(get_school_catalog)):
+    """教室カタログのキャッシュを捨てる（school_id 省略時は全件）"""
+    removed = catalog.invalidate(school_id)
+    await catalog.save_snapshot()
+    return {"invalidated": removed, "cache": catalog.stats()}
+
+
+# 勤怠一覧の応答をまとめて書き出す大きさ（先頭の 1 件だけはすぐに送る）
+ATTENDANCES_FLUSH_BYTES = 32 * 1024
+
+
+async def _attendance_chunks(rows: AsyncIterator[Dict[str, Any]], extras: Dict[str, Any]) -> AsyncIterator[bytes]:
+    """`{...extras, "attendances": [...]}` を上流のページを読みながら書き出す（上流のエラーはそのまま送出する）"""
+    # 行の配列以外のキー（meta など）は 1 ページ目で決まっているので先に書き出す
+    buffer = bytearray(orjson.dumps(extras)[:-1] + b',"attendances":[' if extras else b'{"attendances":[')
+    count = 0
+    try:
+        async for row in rows:
+            if count:
+                buffer += b','
+            buffer += orjson.dumps(row)
+            count += 1
+            # 先頭の 1 件はすぐに送り、以降はまとめて送る
+            if count == 1 or len(buffer) >= ATTENDANCES_FLUSH_BYTES:
+                yield bytes(buffer)
+                buffer.clear()
+    finally:
+        await rows.aclose()
+    buffer += b']}'
+    yield bytes(buffer)
+
+
+async def _stream_attendances(chunks: AsyncIterator[bytes], staff_id: int) -> AsyncIterator[bytes]:
+    """`_attendance_chunks` をクライアントに書き出す"""
+    sent = 0
+    try:
+        async for chunk in chunks:
+            sent += len(chunk)
+            yield chunk
+    except Exception as e:
+        # ステータスは送信済みなので、閉じ括弧を付けずに打ち切って壊れた JSON としてクライアントに伝える
+        logger.warning("attendance stream aborted", extra={'staff_id': staff_id, 'bytes': sent, 'error': repr(e)})
 
 
 @app.get("/staffs/{staff_id}/attendances")
-def get_attendances(staff_id: int, client: StaproAPIClient = Depends(get_api_client)):
+async def get_attendances(
+    request: Request,
+    staff_id: int,
+    work_day_from: Optional[date] = Query(None, alias="from"),
+    work_day_to: Optional[date] = Query(None, alias="to"),
+    per_page: int = Query(ATTENDANCES_PER_PAGE, ge=1, le=1000),
+    client: AsyncStaproAPIClient = Depends(get_api_client),
+):
+    """スタッフの勤怠一覧（`from` / `to` で勤務日を絞り込める）
+
+    `attendances` 以外のキー（`meta` など）は 1 ページ目の応答のものを返す
+    （`meta` のうちページの位置を表すキーは全ページをまとめた応答には当てはまらないので除く）。
+
+    本文全体の ETag を付け、`If-None-Match` が一致すれば 304 を返す（キオスクは毎回再検証する）。
+    1 ページに収まる一覧はそのまま返す。複数ページにわたる一覧は、まず上流のページを 1 つずつ読んで
+    ETag だけを計算し、一致しなければもう一度読みながら書き出す（2 回目の上流への GET は
+    条件付きなので、変わっていなければ本文は返らない）。メモリ使用量はどちらも 1 ページ分で済む。
+    上流のエラーは応答を書き出す前に 404 にする。
+    """
+    work_day_from_iso = work_day_from.isoformat() if work_day_from else None
+    work_day_to_iso = work_day_to.isoformat() if work_day_to else None
+    try:
+        first_page = await client.get_attendances_page(staff_id, 1, per_page, work_day_from_iso, work_day_to_iso)
+    except Exception as e:
+        raise HTTPException(status_code=404, detail=f"勤怠情報が見つかりません: {e}")
+    extras = attendance_page_extras(first_page)
+    single_page = next_attendance_page(first_page, 1, per_page, attendance_page_rows(first_page)) is None
+
+    def chunks() -> AsyncIterator[bytes]:
+        rows = client.iter_attendances(
+            staff_id,
+            per_page=per_page,
+            work_day_from=work_day_from_iso,
+            work_day_to=work_day_to_iso,
+            first_page=first_page,
+        )
+        return _attendance_chunks(rows, extras)
+
+    builder = ETagBuilder()
+    body: List[bytes] = []
     try:
-        return client.get_attendances(staff_id)
+        async for chunk in chunks():
+            builder.update(chunk)
+            if single_page:
+                body.append(chunk)
     except Exception as e:
         raise HTTPException(status_code=404, detail=f"勤怠情報が見つかりません: {e}")
 
+    headers = {"ETag": builder.etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), builder.etag):
+        return Response(status_code=304, headers=headers)
+    if single_page:
+        return Response(b''.join(body), media_type="application/json", headers=headers)
+    return StreamingResponse(_stream_attendances(chunks(), staff_id), media_type="application/json", headers=headers)
+
 
 @app.get("/attendances/{attendance_id}")
-def get_attendance(attendance_id: int, client: StaproAPIClient = Depends(get_api_client)):
+async def get_attendance(request: Request, attendance_id: int, client: AsyncStaproAPIClient = Depends(get_api_client)):
     try:
-        return client.get_attendance(attendance_id)
+        attendance = await client.get_attendance(attendance_id)
     except Exception as e:
         raise HTTPException(status_code=404, detail=f"勤怠情報が見つかりません: {e}")
+    return _conditional_json(request, attendance, "private, no-cache")
 
 
 @app.post("/attendances")
-def create_attendance(request: AttendanceCreate, client: StaproAPIClient = Depends(get_api_client)):
+async def create_attendance(request: AttendanceCreate, client: AsyncStaproAPIClient = Depends(get_api_client)):
     try:
-        return client.create_attendance(
+        return await client.create_attendance(
             staff_id=request.staff_id,
             work_day=request.work_day,
             school_id=request.school_id,
@@ -141,17 +324,17 @@ def create_attendance(request: AttendanceCreate, client: StaproAPIClient = Depen
 
 
 @app.delete("/attendances/{attendance_id}")
-def delete_attendance(attendance_id: int, client: StaproAPIClient = Depends(get_api_client)):
+async def delete_attendance(attendance_id: int, client: AsyncStaproAPIClient = Depends(get_api_client)):
     try:
-        return client.delete_attendance(attendance_id)
+        return await client.delete_attendance(attendance_id)
     except Exception as e:
         raise HTTPException(status_code=404, detail=f"勤怠情報の削除失敗: {e}")
 
 
 # エラーハンドラー
 @app.exception_handler(HTTPException)
-def http_exception_handler(request, exc):
-    return JSONResponse(status_code=exc.status_code, content={"error": exc.detail})
+async def http_exception_handler(request, exc):
+    return ORJSONResponse(status_code=exc.status_code, content={"error": exc.detail})
 
 
 if __name__ == "__main__":
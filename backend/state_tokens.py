@@ -0,0 +1,81 @@
+"""
+タップ確認用の短命な状態トークン
+
+`/api/tap` が「出勤中・退勤待ち」と判定したときに発行し、続く確認リクエストで
+カード検索と出勤状態の確認を省略するために使う。トークンは 1 回限りで、期限切れは自動で捨てる。
+`store` にワーカー間の共有ストア（`shared_state`）を渡すと、トークンをそこに保存し、
+発行したのと別のワーカーに確認リクエストが届いても使えるようにする。
+
+使用方法:
+    from state_tokens import StateTokenStore
+
+    tokens = StateTokenStore(ttl=120.0)
+    token = await tokens.issue(user_id=1, card_id="0123", attendance_id=10)
+
+    state = await tokens.consume(token)
+    if state:
+        print(state.user_id, state.attendance_id)
+"""
+
+import secrets
+import time
+from typing import Any, Dict, Optional
+
+
+class TapState:
+    """トークンに紐づくタップ時点の状態"""
+
+    __slots__ = ('user_id', 'card_id', 'attendance_id', 'expires_at')
+
+    def __init__(self, user_id: Any, card_id: str, attendance_id: Any, expires_at: float):
+        self.user_id = user_id
+        self.card_id = card_id
+        self.attendance_id = attendance_id
+        self.expires_at = expires_at
+
+
+class StateTokenStore:
+    """状態トークンの保管庫（既定はインメモリ）"""
+
+    def __init__(self, ttl: float = 120.0, max_tokens: int = 10000, store: Optional[Any] = None):
+        self.ttl = ttl
+        self.max_tokens = max_tokens
+        self.store = store
+        self._states: Dict[str, TapState] = {}
+
+    def _purge(self, now: float) -> None:
+        expired = [token for token, state in self._states.items() if state.expires_at <= now]
+        for token in expired:
+            del self._states[token]
+
+    async def issue(self, user_id: Any, card_id: str, attendance_id: Any) -> str:
+        """トークンを発行する"""
+        now = time.monotonic()
+        token = secrets.token_urlsafe(16)
+        if self.store is not None:
+            state = {'user_id': user_id, 'card_id': card_id, 'attendance_id': attendance_id}
+            await self.store.set('tap_token:' + token, state, self.ttl)
+            return token
+        if len(self._states) >= self.max_tokens:
+            self._purge(now)
+        # 期限切れを捨てても一杯なら、発行の古いものから捨てる（TTL は共通なので挿入順が期限順）
+        while len(self._states) >= self.max_tokens:
+            del self._states[next(iter(self._states))]
+        self._states[token] = TapState(user_id, card_id, attendance_id, now + self.ttl)
+        return token
+
+    async def consume(self, token: str) -> Optional[TapState]:
+        """トークンを使い切る。無効・期限切れなら None"""
+        if self.store is not None:
+            # 共有ストアでは読み出しと削除が一度に行われるので、同じトークンを 2 つのワーカーで使うことはない
+            found = await self.store.pop('tap_token:' + token)
+            if found is None:
+                return None
+            return TapState(found['user_id'], found['card_id'], found['attendance_id'], time.monotonic() + self.ttl)
+        state = self._states.pop(token, None)
+        if state is None or state.expires_at <= time.monotonic():
+            return None
+        return state
+
+    def __len__(self) -> int:
+        return len(self._states)
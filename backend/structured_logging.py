@@ -0,0 +1,239 @@
+"""
+構造化ログ（1 行 1 JSON）とキュー経由の出力
+
+リクエスト処理中の `logger.info(...)` はレコードをキューに積むだけで返り、標準出力への書き込みは
+バックグラウンドのリスナースレッドが行う。キューが溢れたときはレコードを捨てて数える（打刻を待たせない）。
+各レコードには実行中のリクエストID（`X-Request-ID`）と `extra` に渡した項目がそのまま入る。
+
+成功時の定常イベント（アクセスログや上流呼び出しの所要時間）は `extra={'sampled': True}` を付けて出し、
+`LOG_SAMPLE_RATE` の割合だけ残す。WARNING 以上は常に残す。
+
+環境変数:
+    LOG_LEVEL:       出力するレベル（既定 INFO）
+    LOG_FORMAT:      json（既定）または text
+    LOG_SAMPLE_RATE: sampled イベントを残す割合（既定 0.1）
+    LOG_QUEUE_SIZE:  キューの上限件数（既定 10000）
+
+使用方法:
+    import structured_logging
+
+    structured_logging.start("main")
+    logger = logging.getLogger(__name__)
+    logger.info("card index loaded", extra={'users': count})
+    ...
+    structured_logging.stop()
+"""
+
+import contextlib
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional
+
+from metrics import REGISTRY
+
+
+# 実行中のリクエストID（ミドルウェアが入れ、ログ出力時にレコードへ写す）
+request_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar('request_id', default=None)
+
+LOG_DROPPED = REGISTRY.counter('log_records_dropped_total', 'キューが溢れて捨てたログレコード数')
+
+# LogRecord が標準で持つ属性（これ以外は extra として JSON に出す）
+_STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'sampled'}
+
+# 1 リクエストごとに INFO を出すライブラリ（上流呼び出しは各クライアントが sampled で記録する）
+_QUIET_LOGGERS = ('httpx', 'httpcore', 'hpack')
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional[logging.Handler] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """レコードを 1 行の JSON にする"""
+
+    def __init__(self, app_name: str):
+        super().__init__()
+        self.app_name = app_name
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload: Dict[str, Any] = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'app': self.app_name,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_ATTRS and not key.startswith('_') and value is not None:
+                payload[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            payload['exc'] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """`sampled` の付いた INFO 以下のレコードを `rate` の割合だけ通す"""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = max(0.0, min(1.0, rate))
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, 'sampled', False) or record.levelno >= logging.WARNING:
+            return True
+        if self.rate < 1.0 and random.random() >= self.rate:
+            return False
+        record.sample_rate = self.rate
+        return True
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """呼び出し側のスレッドではメッセージの組み立てだけを行い、溢れたら捨てる"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 呼び出し元のコンテキストにあるリクエストIDはここで写しておく（リスナースレッドからは見えない）
+        if getattr(record, 'request_id', None) is None:
+            record.request_id = request_id.get()
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc()
+
+
+def start(app_name: str) -> logging.handlers.QueueListener:
+    """ルートロガーをキュー経由の出力に切り替え、リスナースレッドを起動する（起動済みならそれを返す）"""
+    global _listener, _queue_handler
+    if _listener is not None:
+        return _listener
+
+    output = logging.StreamHandler(sys.stdout)
+    if os.getenv('LOG_FORMAT', 'json') == 'text':
+        output.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s'))
+    else:
+        output.setFormatter(JsonFormatter(app_name))
+
+    log_queue: queue.Queue = queue.Queue(maxsize=int(os.getenv('LOG_QUEUE_SIZE', '10000')))
+    handler = _NonBlockingQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(float(os.getenv('LOG_SAMPLE_RATE', '0.1'))))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+    for name in _QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    _queue_handler = handler
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def stop() -> None:
+    """キューに残ったレコードを書き出してリスナーを止める"""
+    global _listener, _queue_handler
+    if _listener is None:
+        return
+    _listener.stop()
+    logging.getLogger().removeHandler(_queue_handler)
+    _listener = None
+    _queue_handler = None
+
+
+@contextlib.contextmanager
+def log_duration(logger: logging.Logger, event: str, **fields: Any) -> Iterator[Dict[str, Any]]:
+    """`with` ブロックの所要時間を `duration_ms` として記録する
+
+    正常終了は sampled の INFO、例外は WARNING で出す。yield した dict に項目を足すとログに含まれる。
+    """
+    extra = dict(fields)
+    started = time.perf_counter()
+    try:
+        yield extra
+    except BaseException as e:
+        extra['duration_ms'] = round((time.perf_counter() - started) * 1000, 2)
+        extra['error'] = repr(e)
+        logger.warning(event, extra=extra)
+        raise
+    extra['duration_ms'] = round((time.perf_counter() - started) * 1000, 2)
+    extra['sampled'] = True
+    logger.info(event, extra=extra)
+
+
+class RequestLogMiddleware:
+    """リクエストIDを割り当ててアクセスログを出す ASGI ミドルウェア
+
+    クライアントが `X-Request-ID` を付けていればそれを使い、無ければ発行する。応答にも同じヘッダーを返す。
+    5xx は ERROR、4xx は WARNING、それ以外は sampled の INFO で出す。
+    `quiet_paths`（ヘルスチェックやスクレイプ）は応答に関わらず sampled の INFO にする。
+    """
+
+    def __init__(
+        self, app: Any, logger_name: str = 'access', quiet_paths: Iterable[str] = ('/healthz', '/readyz', '/metrics'),
+    ):
+        self.app = app
+        self.logger = logging.getLogger(logger_name)
+        self.quiet_paths = frozenset(quiet_paths)
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        incoming = None
+        for name, value in scope.get('headers') or []:
+            if name == b'x-request-id':
+                incoming = value.decode('latin-1')[:64]
+                break
+        rid = incoming or uuid.uuid4().hex[:16]
+        token = request_id.set(rid)
+        status = {'code': 500}
+
+        async def send_wrapper(message: Dict[str, Any]) -> None:
+            if message['type'] == 'http.response.start':
+                status['code'] = message['status']
+                message['headers'] = list(message.get('headers') or []) + [(b'x-request-id', rid.encode('latin-1'))]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            code = status['code']
+            route = scope.get('route')
+            extra = {
+                'method': scope.get('method', ''),
+                'path': scope.get('path', ''),
+                'route': getattr(route, 'path', None),
+                'status': code,
+                'duration_ms': round((time.perf_counter() - started) * 1000, 2),
+            }
+            if extra['path'] in self.quiet_paths:
+                extra['sampled'] = True
+                self.logger.info('request', extra=extra)
+            elif code >= 500:
+                self.logger.error('request', extra=extra)
+            elif code >= 400:
+                self.logger.warning('request', extra=extra)
+            else:
+                extra['sampled'] = True
+                self.logger.info('request', extra=extra)
+            request_id.reset(token)
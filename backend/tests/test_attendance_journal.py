@@ -0,0 +1,235 @@
+import asyncio
+
+import pytest
+
+from attendance_journal import (
+    JOURNAL_APPLIED, JOURNAL_CONFLICT, JOURNAL_PENDING, KIND_CLOCK_IN, AttendanceJournal, JournalReplayer,
+    is_provisional,
+)
+from bench.fake_supabase import FakeSupabase
+
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = AttendanceJournal(str(tmp_path / 'journal.db'))
+    yield journal
+    journal.close()
+
+
+def _clock_out(at: str, class_count: int = 1):
+    return {'clock_out_at': at, 'transport_cost': 0, 'class_count': class_count, 'is_auto_submit': False}
+
+
+def test_replay_applies_entries_in_append_order(journal):
+    db = FakeSupabase()
+    replayer = JournalReplayer(journal, get_supabase=lambda: db)
+
+    async def run():
+        first = await journal.append_clock_in(1, '2026-10-18T09:00:00+00:00')
+        await journal.append_clock_in(2, '2026-10-18T09:05:00+00:00')
+        await journal.append_clock_out(1, first['provisional_id'], _clock_out('2026-10-18T12:00:00+00:00', 3))
+        assert journal.counts() == {JOURNAL_PENDING: 3}
+        assert journal.lag_seconds() > 0
+        return await replayer.run_once()
+
+    assert asyncio.run(run()) == 3
+    rows = db.tables['attendance_logs']
+    assert [(row['id'], row['user_id']) for row in rows] == [(1, 1), (2, 2)]
+    assert rows[0]['clock_out_at'] == '2026-10-18T12:00:00+00:00'
+    assert rows[0]['class_count'] == 3
+    assert rows[1].get('clock_out_at') is None
+    assert journal.counts() == {JOURNAL_PENDING: 0, JOURNAL_APPLIED: 3}
+    assert journal.lag_seconds() == 0.0
+
+
+def test_replay_stops_at_failure_and_keeps_order(journal):
+    db = FakeSupabase()
+    down = {'on': True}
+    table = db.table
+
+    def flaky_table(name):
+        if down['on']:
+            raise OSError('supabase unreachable')
+        return table(name)
+
+    db.table = flaky_table
+    replayer = JournalReplayer(journal, get_supabase=lambda: db, base_delay=0.0)
+
+    async def run():
+        await journal.append_clock_in(1, '2026-10-18T09:00:00+00:00')
+        await journal.append_clock_in(2, '2026-10-18T09:05:00+00:00')
+        assert await replayer.run_once() == 0
+        assert [e['attempts'] for e in await journal.pending()] == [0, 0]
+        down['on'] = False
+        return await replayer.run_once()
+
+    assert asyncio.run(run()) == 2
+    assert [row['user_id'] for row in db.tables['attendance_logs']] == [1, 2]
+
+
+def test_clock_in_is_rekeyed_from_provisional_id(journal):
+    db = FakeSupabase()
+    db.seed('attendance_logs', [{'id': 40, 'user_id': 9, 'clock_in_at': '2026-10-17T09:00:00+00:00',
+                                 'clock_out_at': '2026-10-17T12:00:00+00:00'}])
+    resolved = []
+
+    async def on_resolved(user_id, provisional_id, attendance_id):
+        resolved.append((user_id, provisional_id, attendance_id))
+
+    replayer = JournalReplayer(journal, get_supabase=lambda: db, on_resolved=on_resolved)
+
+    async def run():
+        entry = await journal.append_clock_in(1, '2026-10-18T09:00:00+00:00')
+        provisional = entry['provisional_id']
+        assert is_provisional(provisional)
+        assert journal.overlay()[1]['id'] == provisional
+        await replayer.run_once()
+        return provisional
+
+    provisional = asyncio.run(run())
+    assert resolved == [(1, provisional, 41)]
+    assert journal.resolve(provisional) == 41
+    # 反映済みなので、以降は DB（未退勤シフト台帳）の状態を正とする
+    assert journal.overlay() == {}
+
+    # 仮の ID のまま届いた退勤も、付け替え後の行に反映される
+    async def clock_out():
+        entry = await journal.append_clock_out(1, provisional, _clock_out('2026-10-18T12:00:00+00:00'))
+        await replayer.run_once()
+        return entry
+
+    entry = asyncio.run(clock_out())
+    assert entry['attendance_id'] == 41
+    assert db.tables['attendance_logs'][1]['clock_out_at'] == '2026-10-18T12:00:00+00:00'
+
+
+def test_rekeyed_ids_survive_restart(tmp_path):
+    path = str(tmp_path / 'journal.db')
+    db = FakeSupabase()
+    journal = AttendanceJournal(path)
+
+    async def run():
+        entry = await journal.append_clock_in(1, '2026-10-18T09:00:00+00:00')
+        await JournalReplayer(journal, get_supabase=lambda: db).run_once()
+        return entry['provisional_id']
+
+    provisional = asyncio.run(run())
+    journal.close()
+
+    reopened = AttendanceJournal(path)
+    try:
+        assert reopened.resolve(provisional) == 1
+        assert reopened.counts() == {JOURNAL_APPLIED: 1}
+    finally:
+        reopened.close()
+
+
+def test_clock_in_conflict_keeps_existing_open_attendance(journal):
+    db = FakeSupabase()
+    db.seed('attendance_logs', [{'id': 7, 'user_id': 1, 'clock_in_at': '2026-10-18T08:00:00+00:00',
+                                 'clock_out_at': None}])
+    resolved = []
+
+    async def on_resolved(user_id, provisional_id, attendance_id):
+        resolved.append(attendance_id)
+
+    replayer = JournalReplayer(journal, get_supabase=lambda: db, on_resolved=on_resolved)
+
+    async def run():
+        entry = await journal.append_clock_in(1, '2026-10-18T09:00:00+00:00')
+        await journal.append_clock_out(1, entry['provisional_id'], _clock_out('2026-10-18T12:00:00+00:00'))
+        await replayer.run_once()
+        return await journal.entries()
+
+    entries = asyncio.run(run())
+    clock_out, clock_in = entries
+    assert clock_in['status'] == JOURNAL_CONFLICT
+    assert clock_in['attendance_id'] == 7
+    assert 'already had open attendance 7' in clock_in['last_error']
+    # DB 側の出勤を正とし、退勤はその行に反映する
+    assert resolved == [7]
+    assert clock_out['status'] == JOURNAL_APPLIED
+    assert len(db.tables['attendance_logs']) == 1
+    assert db.tables['attendance_logs'][0]['clock_out_at'] == '2026-10-18T12:00:00+00:00'
+    assert journal.counts() == {JOURNAL_PENDING: 0, JOURNAL_APPLIED: 1, JOURNAL_CONFLICT: 1}
+
+
+def test_clock_out_conflict_when_already_clocked_out(journal):
+    db = FakeSupabase()
+    db.seed('attendance_logs', [{'id': 7, 'user_id': 1, 'clock_in_at': '2026-10-18T08:00:00+00:00',
+                                 'clock_out_at': '2026-10-18T10:00:00+00:00'}])
+    clocked_out = []
+
+    async def on_clock_out(user_id, attendance_id):
+        clocked_out.append(attendance_id)
+
+    replayer = JournalReplayer(journal, get_supabase=lambda: db, on_clock_out=on_clock_out)
+
+    async def run():
+        await journal.append_clock_out(1, 7, _clock_out('2026-10-18T12:00:00+00:00'))
+        await replayer.run_once()
+        return await journal.entries()
+
+    (entry,) = asyncio.run(run())
+    assert entry['status'] == JOURNAL_CONFLICT
+    assert 'already clocked out' in entry['last_error']
+    assert clocked_out == []
+    assert db.tables['attendance_logs'][0]['clock_out_at'] == '2026-10-18T10:00:00+00:00'
+
+
+def test_settled_by_another_worker_updates_counts(journal):
+    entry = asyncio.run(journal.append_clock_in(1, '2026-10-18T09:00:00+00:00'))
+    journal.settled({'seq': entry['seq'], 'kind': KIND_CLOCK_IN, 'user_id': 1, 'attendance_id': 5,
+                     'status': JOURNAL_APPLIED})
+    assert journal.counts() == {JOURNAL_PENDING: 0, JOURNAL_APPLIED: 1}
+    assert journal.lag_seconds() == 0.0
+    assert journal.resolve(entry['provisional_id']) == 5
+
+
+def test_clock_out_sync_is_submitted_before_settling(journal):
+    db = FakeSupabase()
+    submitted = []
+    fail = {'on': True}
+
+    async def submit_clock_out(user_id, attendance_id, sync):
+        if fail['on']:
+            raise RuntimeError('outbox unavailable')
+        submitted.append((user_id, attendance_id, sync))
+
+    replayer = JournalReplayer(journal, get_supabase=lambda: db, submit_clock_out=submit_clock_out, base_delay=0.0)
+    sync = {'staff_id': 101, 'total_lesson': 2}
+
+    async def run():
+        entry = await journal.append_clock_in(1, '2026-10-18T09:00:00+00:00')
+        await journal.append_clock_out(1, entry['provisional_id'], _clock_out('2026-10-18T12:00:00+00:00'), sync=sync)
+        await replayer.run_once()
+        # 送信ジョブを積めなかった退勤は反映済みにしない
+        assert [e['kind'] for e in await journal.pending()] == ['clock_out']
+        fail['on'] = False
+        await replayer.run_once()
+        return await journal.pending()
+
+    assert asyncio.run(run()) == []
+    assert submitted == [(1, 1, sync)]
+    assert db.tables['attendance_logs'][0]['clock_out_at'] == '2026-10-18T12:00:00+00:00'
+    assert journal.counts() == {JOURNAL_PENDING: 0, JOURNAL_APPLIED: 2}
+
+
+def test_clock_out_without_sync_is_not_submitted(journal):
+    db = FakeSupabase()
+    db.seed('attendance_logs', [{'id': 3, 'user_id': 1, 'clock_in_at': '2026-10-18T09:00:00+00:00',
+                                 'clock_out_at': None}])
+    submitted = []
+
+    async def submit_clock_out(user_id, attendance_id, sync):
+        submitted.append(attendance_id)
+
+    replayer = JournalReplayer(journal, get_supabase=lambda: db, submit_clock_out=submit_clock_out)
+
+    async def run():
+        await journal.append_clock_out(1, 3, _clock_out('2026-10-18T12:00:00+00:00'))
+        await replayer.run_once()
+
+    asyncio.run(run())
+    assert submitted == []
+    assert journal.counts()[JOURNAL_APPLIED] == 1
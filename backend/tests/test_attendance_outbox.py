@@ -0,0 +1,133 @@
+import asyncio
+import time
+
+import pytest
+
+from attendance_outbox import (
+    RESULT_ALREADY_EXISTS, RESULT_CREATED, STATUS_DONE, STATUS_FAILED, STATUS_PENDING, OutboxWorker, SqliteOutbox,
+)
+
+
+class StubClient:
+    """`create_attendances_bulk` が決められた結果を順に返す Stapro クライアント"""
+
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.sent = []
+
+    async def create_attendances_bulk(self, payloads, max_concurrency=8):
+        results = []
+        for payload in payloads:
+            self.sent.append(payload)
+            status = self.statuses.pop(0) if self.statuses else RESULT_CREATED
+            if isinstance(status, int):
+                results.append({'status': 'error', 'http_status': status, 'data': None, 'error': 'upstream error'})
+            else:
+                results.append({'status': status, 'http_status': 201, 'data': {}, 'error': None})
+        return results
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    outbox = SqliteOutbox(str(tmp_path / 'outbox.db'))
+    yield outbox
+    outbox.close()
+
+
+def _worker(outbox, client, **options):
+    return OutboxWorker(outbox, get_client=lambda: client, base_delay=1.0, max_delay=3.0, **options)
+
+
+def _payload(staff_id=101):
+    return {'staff_id': staff_id, 'work_day': '2026-10-18', 'total_lesson': 2}
+
+
+def test_failures_are_retried_with_backoff(outbox):
+    client = StubClient(500, 503, 500, RESULT_CREATED)
+    worker = _worker(outbox, client)
+
+    async def run():
+        job = await outbox.enqueue(1, 'clock_out', _payload())
+        delays = []
+        for _ in range(3):
+            before = time.time()
+            assert await worker.run_once() == 1
+            current = await outbox.get(job['id'])
+            delays.append(round(current['next_attempt_at'] - before))
+            # 次の送信期限までは取り出されない
+            assert await worker.run_once() == 0
+            await outbox.update(job['id'], next_attempt_at=0)
+        assert current['last_error'] == 'HTTP 500: upstream error'
+        assert await worker.run_once() == 1
+        return delays, await outbox.get(job['id'])
+
+    delays, job = asyncio.run(run())
+    # base_delay * 2 ** (attempts - 1)。max_delay で頭打ちになる
+    assert delays == [1, 2, 3]
+    assert (job['status'], job['result'], job['attempts'], job['last_error']) == (STATUS_DONE, RESULT_CREATED, 4, None)
+    assert len(client.sent) == 4
+
+
+def test_conflict_is_recorded_as_already_exists(outbox):
+    worker = _worker(outbox, StubClient(RESULT_ALREADY_EXISTS))
+
+    async def run():
+        job = await outbox.enqueue(1, 'clock_out', _payload())
+        assert await worker.flush([job]) == [
+            {'status': RESULT_ALREADY_EXISTS, 'http_status': 201, 'data': {}, 'error': None},
+        ]
+        return await outbox.get(job['id'])
+
+    job = asyncio.run(run())
+    assert (job['status'], job['result']) == (STATUS_DONE, RESULT_ALREADY_EXISTS)
+
+
+def test_job_fails_after_max_attempts(outbox):
+    client = StubClient(500, 500, 500)
+    worker = _worker(outbox, client, max_attempts=2)
+
+    async def run():
+        job = await outbox.enqueue(1, 'clock_out', _payload())
+        await worker.run_once()
+        await outbox.update(job['id'], next_attempt_at=0)
+        await worker.run_once()
+        await outbox.update(job['id'], next_attempt_at=0)
+        assert await worker.run_once() == 0
+        return await outbox.get(job['id'])
+
+    job = asyncio.run(run())
+    assert (job['status'], job['attempts']) == (STATUS_FAILED, 2)
+    assert len(client.sent) == 2
+
+
+def test_claim_is_conditioned_on_attempts(outbox):
+    async def run():
+        job = await outbox.enqueue(1, 'clock_out', _payload())
+        # 同じ時点で読んだジョブを 2 つのワーカーが取り合っても、取れるのは 1 つだけ
+        first, second = await asyncio.gather(outbox.claim(dict(job), 60), outbox.claim(dict(job), 60))
+        claimed = await outbox.get(job['id'])
+        # 取ったジョブは lease の間は送信期限が来ない
+        return first, second, claimed, await outbox.due()
+
+    first, second, claimed, due = asyncio.run(run())
+    assert sorted([first, second]) == [False, True]
+    assert (claimed['status'], claimed['attempts']) == (STATUS_PENDING, 1)
+    assert due == []
+
+
+def test_concurrent_workers_send_each_job_once(outbox):
+    clients = [StubClient(), StubClient()]
+    workers = [_worker(outbox, client) for client in clients]
+
+    async def run():
+        jobs = [await outbox.enqueue(i, 'clock_out', _payload(100 + i)) for i in range(1, 21)]
+        counts = await asyncio.gather(*(worker.run_once() for worker in workers))
+        # 別のワーカーが取ったジョブを、取る前に読んだ内容のまま flush しても送り直さない
+        flushed = await workers[0].flush([jobs[0]])
+        return counts, flushed
+
+    counts, flushed = asyncio.run(run())
+    assert sum(counts) == 20
+    assert sorted(payload['staff_id'] for client in clients for payload in client.sent) == list(range(101, 121))
+    assert flushed[0]['status'] == 'in_flight'
+    assert sum(len(client.sent) for client in clients) == 20
@@ -0,0 +1,87 @@
+import asyncio
+
+from bench.fake_supabase import FakeSupabase
+from card_index import CardIndex
+
+
+def _user(user_id, updated_at, card_id=None, name=None):
+    return {'id': user_id, 'card_id': card_id or f'C{user_id}', 'name': name or f'u{user_id}',
+            'stapro_staff_id': 100 + user_id, 'updated_at': updated_at}
+
+
+def _counted_loads(index):
+    loads = []
+    load = index._load
+
+    async def counted():
+        loads.append(1)
+        return await load()
+
+    index._load = counted
+    return loads
+
+
+def test_get_before_load_joins_the_running_load():
+    db = FakeSupabase(latency=0.05)
+    db.seed('users', [_user(i, '2026-10-01T00:00:00+00:00') for i in range(1, 4)])
+    index = CardIndex(db)
+    loads = _counted_loads(index)
+
+    async def run():
+        loading = asyncio.create_task(index.load())
+        await asyncio.sleep(0)
+        # 読み込み中の get() と load() は、2 回目の全件読み込みを始めない
+        user, count = await asyncio.gather(index.get('C2'), index.load())
+        await loading
+        await asyncio.sleep(0.2)
+        return user, count
+
+    user, count = asyncio.run(run())
+    assert user.id == 2
+    assert count == 3
+    assert len(loads) == 1
+
+
+def test_refresh_applies_rows_after_watermark():
+    db = FakeSupabase()
+    db.seed('users', [_user(1, '2026-10-01T00:00:00+00:00'), _user(2, '2026-10-02T00:00:00+00:00')])
+    index = CardIndex(db)
+
+    async def run():
+        await index.load()
+        assert index._stamp_column == 'updated_at'
+        assert index._watermark == '2026-10-02T00:00:00+00:00'
+        # 1 のカードを付け替え、3 を追加する
+        db.tables['users'][0].update(card_id='C9', name='renamed', updated_at='2026-10-03T00:00:00+00:00')
+        db.tables['users'].append(_user(3, '2026-10-04T00:00:00+00:00'))
+        before = db.queries
+        refreshed = await index.refresh()
+        return refreshed, db.queries - before
+
+    refreshed, queries = asyncio.run(run())
+    # ウォーターマークと同じ時刻の行（2）も読み直す
+    assert refreshed == 3
+    assert queries == 1
+    assert index._watermark == '2026-10-04T00:00:00+00:00'
+    assert index.cached(1).name == 'renamed'
+    assert 'C9' in index and 'C1' not in index
+    assert 'C3' in index
+
+
+def test_projection_is_rechecked_while_the_table_is_empty():
+    db = FakeSupabase()
+    index = CardIndex(db)
+
+    async def run():
+        empty = await index._select_columns()
+        assert await index.load() == 0
+        db.seed('users', [_user(1, '2026-10-01T00:00:00+00:00')])
+        return empty, await index._select_columns()
+
+    empty, columns = asyncio.run(run())
+    assert empty == '*'
+    assert index._columns == columns
+    assert columns.split(',') == ['id', 'card_id', 'name', 'stapro_staff_id', 'updated_at']
+    # 読み込み直すと最初の行から列を確かめ、ウォーターマーク列も決まる
+    assert asyncio.run(index.load()) == 1
+    assert index._stamp_column == 'updated_at'
@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+
+import main
+from bench.fake_supabase import FakeSupabase
+from card_index import CardIndex
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = FakeSupabase()
+    db.seed('users', [{'id': i, 'card_id': f'C{i}', 'name': f'u{i}', 'school_id': 1 + i % 2} for i in range(1, 11)])
+    # 7 は削除済みのユーザー（索引にも DB にもいない）
+    db.tables['users'] = [row for row in db.tables['users'] if row['id'] != 7]
+    db.seed('attendance_logs', [
+        {'id': i, 'user_id': 1 + i % 10, 'clock_in_at': f'2026-10-{1 + i % 28:02d}T09:00:00+00:00'}
+        for i in range(1, 251)
+    ])
+    tables = []
+    table = db.table
+
+    def counted(name):
+        tables.append(name)
+        return table(name)
+
+    db.table = counted
+    db.tables_queried = tables
+    monkeypatch.setattr(main, 'supabase', db)
+    monkeypatch.setattr(main, 'card_index', CardIndex(db, lookup_chunk=3))
+    return db
+
+
+def _export(user_ids=None):
+    async def run():
+        return [row for page in [page async for page in main._export_rows(None, None, user_ids)] for row in page]
+    return asyncio.run(run())
+
+
+def test_users_are_looked_up_once_per_export(db):
+    rows = _export()
+    assert [row['id'] for row in rows] == list(range(1, 251))
+    assert rows[0]['user_name'] == 'u2' and rows[0]['school_id'] == 1
+    assert all(row['user_name'] is None for row in rows if row['user_id'] == 7)
+    # 索引が空でも、ユーザーは行ごとではなくまとめて引き、見つからないユーザーも引き直さない
+    # （列の確認 1 回 + 10 人を 3 人ずつ 4 回）
+    assert db.tables_queried.count('users') == 5
+
+
+def test_user_filter_is_split_into_chunks(db, monkeypatch):
+    monkeypatch.setattr(main, 'EXPORT_USER_CHUNK', 2)
+    monkeypatch.setattr(main, 'EXPORT_PAGE_SIZE', 10)
+    rows = _export([1, 3, 5, 7, 9])
+    assert sorted(row['id'] for row in rows) == [row['id'] for row in db.tables['attendance_logs']
+                                                 if row['user_id'] in (1, 3, 5, 7, 9)]
+    assert {row['user_id'] for row in rows} == {1, 3, 5, 7, 9}
+    # 分けた単位ごとに ID 順に読む
+    groups = [{1: 0, 3: 0, 5: 1, 7: 1, 9: 2}[row['user_id']] for row in rows]
+    assert groups == sorted(groups)
+    for group in range(3):
+        ids = [row['id'] for row, g in zip(rows, groups) if g == group]
+        assert ids == sorted(ids)
+
+
+def test_get_many_skips_known_users(db):
+    index = main.card_index
+
+    async def run():
+        await index.load()
+        before = len(db.tables_queried)
+        found = await index.get_many([1, 2, 7, 2, None])
+        return found, len(db.tables_queried) - before
+
+    found, queries = asyncio.run(run())
+    assert sorted(found) == [1, 2]
+    # 索引に無い 7 だけを DB に問い合わせる
+    assert queries == 1
@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+from fastapi.testclient import TestClient
+
+from idempotency import IdempotencyMiddleware
+from shared_state import SqliteState
+
+
+def _app(calls, **options):
+    app = FastAPI()
+
+    @app.post('/api/tap')
+    async def tap(body: dict):
+        calls.append(body)
+        return JSONResponse({'n': len(calls)}, status_code=body.get('status', 200))
+
+    @app.post('/api/other')
+    async def other(body: dict):
+        calls.append(body)
+        return {'n': len(calls)}
+
+    app.add_middleware(IdempotencyMiddleware, paths=('/api/tap',), **options)
+    return app
+
+
+@pytest.fixture
+def calls():
+    return []
+
+
+@pytest.fixture
+def client(calls):
+    with TestClient(_app(calls, window=60.0)) as client:
+        yield client
+
+
+def test_same_key_replays_first_response(client, calls):
+    first = client.post('/api/tap', json={'confirm': 1}, headers={'Idempotency-Key': 'k1'})
+    again = client.post('/api/tap', json={'confirm': 1}, headers={'Idempotency-Key': 'k1'})
+    assert first.json() == again.json() == {'n': 1}
+    assert 'idempotent-replayed' not in first.headers
+    assert again.headers['idempotent-replayed'] == 'true'
+    assert len(calls) == 1
+
+
+def test_same_key_with_different_body_is_rejected(client, calls):
+    client.post('/api/tap', json={'confirm': 1}, headers={'Idempotency-Key': 'k1'})
+    conflict = client.post('/api/tap', json={'confirm': 2}, headers={'Idempotency-Key': 'k1'})
+    assert conflict.status_code == 422
+    assert len(calls) == 1
+
+
+def test_window_dedupes_card_reads_only(client, calls):
+    first = client.post('/api/tap', json={'card_id': 'C1'})
+    again = client.post('/api/tap', json={'card_id': 'C1'})
+    assert again.json() == first.json()
+    assert again.headers['idempotent-replayed'] == 'true'
+    # 別のカード・card_id の無い本文・対象外のパスは毎回処理する
+    client.post('/api/tap', json={'card_id': 'C2'})
+    client.post('/api/tap', json={'confirm': 1})
+    client.post('/api/tap', json={'confirm': 1})
+    client.post('/api/other', json={'card_id': 'C1'})
+    client.post('/api/other', json={'card_id': 'C1'})
+    assert len(calls) == 6
+
+
+def test_client_errors_are_replayed(client, calls):
+    first = client.post('/api/tap', json={'card_id': 'C1', 'status': 404})
+    again = client.post('/api/tap', json={'card_id': 'C1', 'status': 404})
+    assert first.status_code == again.status_code == 404
+    assert again.headers['idempotent-replayed'] == 'true'
+    assert len(calls) == 1
+
+
+def test_server_errors_are_not_stored(client, calls):
+    first = client.post('/api/tap', json={'card_id': 'C1', 'status': 503}, headers={'Idempotency-Key': 'k1'})
+    again = client.post('/api/tap', json={'card_id': 'C1', 'status': 503}, headers={'Idempotency-Key': 'k1'})
+    assert first.status_code == again.status_code == 503
+    assert 'idempotent-replayed' not in again.headers
+    assert len(calls) == 2
+
+
+def test_shared_store_replays_across_workers(tmp_path, calls):
+    path = str(tmp_path / 'shared.db')
+    first_store, second_store = SqliteState(path), SqliteState(path)
+    first_app = _app(calls, window=60.0, get_store=lambda: first_store)
+    second_app = _app(calls, window=60.0, get_store=lambda: second_store)
+    try:
+        with TestClient(first_app) as first, TestClient(second_app) as second:
+            created = first.post('/api/tap', json={'confirm': 1}, headers={'Idempotency-Key': 'k1'})
+            replayed = second.post('/api/tap', json={'confirm': 1}, headers={'Idempotency-Key': 'k1'})
+            assert replayed.status_code == 200
+            assert replayed.json() == created.json() == {'n': 1}
+            assert replayed.headers['idempotent-replayed'] == 'true'
+
+            conflict = second.post('/api/tap', json={'confirm': 2}, headers={'Idempotency-Key': 'k1'})
+            assert conflict.status_code == 422
+
+            # 5xx は共有ストアにも残さないので、別のワーカーが処理し直す
+            first.post('/api/tap', json={'card_id': 'C1', 'status': 503})
+            retried = second.post('/api/tap', json={'card_id': 'C1', 'status': 503})
+            assert 'idempotent-replayed' not in retried.headers
+
+            second.post('/api/tap', json={'card_id': 'C2'})
+            window = first.post('/api/tap', json={'card_id': 'C2'})
+            assert window.headers['idempotent-replayed'] == 'true'
+        assert len(calls) == 4
+    finally:
+        for store in (first_store, second_store):
+            asyncio.run(store.close())
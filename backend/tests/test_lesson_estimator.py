@@ -0,0 +1,51 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from lesson_estimator import LessonEstimator, _parse_wday, build_index
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('sunday', 0), ('Sunday', 0), ('sun', 0), ('SUN', 0), (0, 0), ('0', 0), (7, 0),
+    ('monday', 1), ('Mon', 1), ('saturday', 6),
+    ('日', 0), ('日曜', 0), ('日曜日', 0), ('月', 1), ('月曜日', 1), ('水曜日', 3), ('土', 6),
+])
+def test_parse_wday(value, expected):
+    assert _parse_wday(value) == expected
+
+
+@pytest.mark.parametrize('value', [None, '', 'someday', '祝'])
+def test_parse_wday_unknown(value):
+    assert _parse_wday(value) is None
+
+
+def test_build_index_keeps_sunday_lessons():
+    index = build_index([
+        {'id': 1, 'day_of_week': 'sunday', 'start_time': '10:00', 'end_time': '11:00'},
+        {'id': 2, 'day_of_week': '日曜日', 'start_time': '12:00', 'end_time': '13:00'},
+        {'id': 3, 'day_of_week': 'monday', 'start_time': '10:00', 'end_time': '11:00'},
+    ])
+    assert sorted(index) == [0, 1]
+    assert index[0].ids == [1, 2]
+
+
+def test_build_index_nested_lessons_inherit_weekday():
+    index = build_index([
+        {'day_of_week': 'sun', 'lessons': [{'id': 5, 'start_time': '09:00', 'end_time': '10:00'}]},
+    ])
+    assert index[0].ids == [5]
+
+
+def test_estimate_on_sunday():
+    school = {'timetables': [
+        {'id': 1, 'day_of_week': 'sunday', 'start_time': '10:00', 'end_time': '11:00'},
+        {'id': 2, 'day_of_week': 'sunday', 'start_time': '15:00', 'end_time': '16:00'},
+    ]}
+    estimator = LessonEstimator(tz=timezone.utc)
+    # 2025-04-06 は日曜日
+    estimate = estimator.estimate(
+        1, school,
+        datetime(2025, 4, 6, 9, 30, tzinfo=timezone.utc),
+        datetime(2025, 4, 6, 12, 0, tzinfo=timezone.utc),
+    )
+    assert estimate.lesson_ids == [1]
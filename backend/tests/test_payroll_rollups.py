@@ -0,0 +1,92 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from bench.fake_supabase import FakeSupabase
+from payroll_rollups import PayrollRollups, month_of, month_range
+
+TOKYO = ZoneInfo('Asia/Tokyo')
+
+
+def _log(log_id, user_id, clock_in, hours=2, transport_cost=100, class_count=1):
+    clock_out = datetime.fromisoformat(clock_in) + timedelta(hours=hours)
+    return {'id': log_id, 'user_id': user_id, 'clock_in_at': clock_in, 'clock_out_at': clock_out.isoformat(),
+            'transport_cost': transport_cost, 'class_count': class_count}
+
+
+@pytest.fixture
+def db():
+    db = FakeSupabase(unique={})
+    db.seed('attendance_logs', [
+        _log(1, 1, '2025-11-03T00:00:00+00:00'),
+        _log(2, 1, '2025-11-04T00:00:00+00:00', hours=3, class_count=2),
+        # 現地時間（JST）では 12 月 1 日の出勤
+        _log(3, 2, '2025-11-30T16:00:00+00:00'),
+        _log(4, 2, '2025-12-31T14:59:00+00:00'),
+        # 現地時間では翌年 1 月
+        _log(5, 2, '2025-12-31T15:00:00+00:00'),
+    ])
+    return db
+
+
+def test_month_range_wraps_december():
+    assert month_range('2025-12', timezone.utc) == ('2025-12-01T00:00:00+00:00', '2026-01-01T00:00:00+00:00')
+    assert month_range('2025-12', TOKYO) == ('2025-11-30T15:00:00+00:00', '2025-12-31T15:00:00+00:00')
+    assert month_of(datetime(2025, 12, 31, 15, tzinfo=timezone.utc), TOKYO) == '2026-01'
+
+
+def test_record_clock_out_refreshes_that_month(db):
+    rollups = PayrollRollups(db, tz=TOKYO)
+
+    async def run():
+        first = await rollups.record_clock_out(1, 1)
+        db.seed('attendance_logs', [_log(6, 1, '2025-11-20T00:00:00+00:00', hours=1, transport_cost=50)])
+        return first, await rollups.record_clock_out(1, 6), await rollups.record_clock_out(1, 99)
+
+    first, second, missing = asyncio.run(run())
+    assert (first.month, first.shifts, first.worked_seconds) == ('2025-11', 2, 5 * 3600)
+    assert (second.shifts, second.transport_cost, second.class_count) == (3, 250, 4)
+    assert missing is None
+    (row,) = db.tables['attendance_monthly_rollups']
+    assert (row['user_id'], row['month'], row['shifts'], row['worked_seconds']) == (1, '2025-11', 3, 6 * 3600)
+
+
+def test_backfill_removes_rollups_it_no_longer_sees(db):
+    rollups = PayrollRollups(db, tz=TOKYO, page_size=2)
+    db.seed('attendance_monthly_rollups', [
+        # 行が消えたユーザー・月の古い集計
+        {'user_id': 3, 'month': '2025-12', 'shifts': 9, 'updated_at': '2025-12-02T00:00:00+00:00'},
+        # 範囲外の月は触らない
+        {'user_id': 3, 'month': '2025-10', 'shifts': 9, 'updated_at': '2025-11-02T00:00:00+00:00'},
+    ])
+
+    result = asyncio.run(rollups.backfill('2025-11'))
+    assert result == {'since': '2025-11', 'rows': 5, 'rollups': 3, 'removed': 1}
+    keys = sorted((row['user_id'], row['month']) for row in db.tables['attendance_monthly_rollups'])
+    assert keys == [(1, '2025-11'), (2, '2025-12'), (2, '2026-01'), (3, '2025-10')]
+    december = next(row for row in db.tables['attendance_monthly_rollups'] if row['month'] == '2025-12')
+    assert december['shifts'] == 2
+
+
+def test_monthly_reads_rollups_only_for_closed_months(db, monkeypatch):
+    rollups = PayrollRollups(db, tz=TOKYO)
+    monkeypatch.setattr(rollups, 'current_month', lambda: '2025-12')
+    # 集計行と attendance_logs を食い違わせて、どちらから読んだかを見分ける
+    db.seed('attendance_monthly_rollups', [
+        {'user_id': 1, 'month': '2025-11', 'shifts': 7, 'worked_seconds': 7200, 'transport_cost': 0, 'class_count': 0},
+        {'user_id': 2, 'month': '2025-12', 'shifts': 7, 'worked_seconds': 7200, 'transport_cost': 0, 'class_count': 0},
+    ])
+
+    async def run():
+        return await rollups.monthly('2025-11'), await rollups.monthly('2025-12'), await rollups.monthly('2025-10')
+
+    closed, current, empty = asyncio.run(run())
+    assert closed['source'] == 'rollup'
+    assert closed['users'] == [{'user_id': 1, 'shifts': 7, 'hours_worked': 2.0, 'transport_cost': 0, 'class_count': 0}]
+    # 当月は集計行があってもその場で集計する
+    assert current['source'] == 'live'
+    assert current['totals'] == {'shifts': 2, 'hours_worked': 4.0, 'transport_cost': 200, 'class_count': 2}
+    # 集計行の無い締めた月もその場で集計する
+    assert (empty['source'], empty['users']) == ('live', [])
@@ -0,0 +1,61 @@
+import asyncio
+
+from readiness import STATUS_FAILED, STATUS_OK, Readiness
+
+
+def test_probe_failure_flips_readiness_and_recovers():
+    state = {'up': True}
+
+    async def load():
+        return {'users': 1}
+
+    async def ping():
+        if not state['up']:
+            raise OSError('supabase unreachable')
+
+    async def run():
+        readiness = Readiness(recheck_interval=0.01, probe_timeout=1.0)
+        readiness.add('card_index', load, dependency='supabase', probe=ping)
+        readiness.add('stapro', load, required=False)
+        readiness.start()
+        try:
+            assert await readiness.wait(1.0)
+            assert readiness.report()['dependencies'] == {'supabase': STATUS_OK, 'stapro': STATUS_OK}
+
+            state['up'] = False
+            await asyncio.sleep(0.05)
+            report = readiness.report()
+            assert not report['ready']
+            assert report['dependencies']['supabase'] == STATUS_FAILED
+            assert 'unreachable' in report['checks']['card_index']['error']
+
+            state['up'] = True
+            assert await readiness.wait(1.0)
+            assert readiness.report()['checks']['card_index']['error'] is None
+        finally:
+            await readiness.stop()
+
+    asyncio.run(run())
+
+
+def test_probe_timeout_counts_as_failure():
+    async def load():
+        return None
+
+    async def hang():
+        await asyncio.sleep(10)
+
+    async def run():
+        readiness = Readiness(recheck_interval=0.01, probe_timeout=0.01)
+        readiness.add('stapro', load, required=False, probe=hang)
+        readiness.start()
+        try:
+            await asyncio.sleep(0.1)
+            report = readiness.report()
+            # 必須でない依存先が落ちても受け付けは続ける
+            assert report['ready']
+            assert report['dependencies'] == {'stapro': STATUS_FAILED}
+        finally:
+            await readiness.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+import main
+from attendance_outbox import RESULT_CREATED, STATUS_DONE, STATUS_FAILED, OutboxWorker, SqliteOutbox
+
+
+class _Client:
+    def __init__(self):
+        self.sent = []
+
+    async def create_attendances_bulk(self, payloads, max_concurrency=8):
+        self.sent.extend(payloads)
+        return [{'status': RESULT_CREATED, 'http_status': 201, 'data': {}, 'error': None} for _ in payloads]
+
+
+@pytest.fixture
+def outbox(tmp_path, monkeypatch):
+    outbox = SqliteOutbox(str(tmp_path / 'outbox.db'))
+    client = _Client()
+    monkeypatch.setattr(main, 'attendance_outbox', outbox)
+    monkeypatch.setattr(main, 'outbox_worker', OutboxWorker(outbox, get_client=lambda: client))
+    yield outbox, client
+    outbox.close()
+
+
+def _payload(staff_id):
+    return {'staff_id': staff_id, 'work_day': '2026-10-17', 'total_lesson': 1}
+
+
+def test_resubmit_reuses_existing_jobs(outbox):
+    outbox, client = outbox
+
+    async def run():
+        done = await outbox.enqueue(1, 'clock_out', _payload(101))
+        await outbox.update(done['id'], status=STATUS_DONE, result=RESULT_CREATED)
+        pending = await outbox.enqueue(2, 'clock_out', _payload(102))
+        failed = await outbox.enqueue(3, 'clock_out', _payload(103))
+        await outbox.update(failed['id'], status=STATUS_FAILED, last_error='HTTP 500')
+        items = [(attendance_id, _payload(100 + attendance_id)) for attendance_id in (1, 2, 3, 4)]
+        results = await main._resubmit_attendances(items, max_concurrency=4)
+        return done, pending, failed, results, await outbox.for_attendances([1, 2, 3, 4])
+
+    done, pending, failed, results, jobs = asyncio.run(run())
+    assert [result['status'] for result in results] == ['already_synced', RESULT_CREATED, RESULT_CREATED, RESULT_CREATED]
+    assert results[0]['sync_job_id'] == done['id']
+    assert results[1]['sync_job_id'] == pending['id']
+    assert results[2]['sync_job_id'] != failed['id']
+    # 送信済みの勤怠は送らず、未送信のジョブは積み直さない
+    assert [payload['staff_id'] for payload in client.sent] == [102, 103, 104]
+    assert [len(jobs[attendance_id]) for attendance_id in (1, 2, 3, 4)] == [1, 1, 2, 1]
+    assert all(job['status'] == STATUS_DONE for job in jobs[2] + jobs[4])
+    assert [job['status'] for job in jobs[3]] == [STATUS_FAILED, STATUS_DONE]
+
+
+def test_repeated_repair_does_not_duplicate_jobs(outbox):
+    outbox, client = outbox
+    items = [(5, _payload(105))]
+
+    async def run():
+        await main._resubmit_attendances(items, max_concurrency=1)
+        second = await main._resubmit_attendances(items, max_concurrency=1)
+        return second, await outbox.for_attendance(5)
+
+    second, jobs = asyncio.run(run())
+    assert second[0]['status'] == 'already_synced'
+    assert len(jobs) == 1
+    assert len(client.sent) == 1
@@ -0,0 +1,115 @@
+import asyncio
+
+import orjson
+import pytest
+
+import main
+from roster import RESYNC, RosterFeed, sse_frame
+
+
+async def _drain(subscription):
+    events = []
+    while True:
+        try:
+            events.append(await subscription.get(timeout=0.01))
+        except asyncio.TimeoutError:
+            return events
+
+
+def test_frame_is_one_sse_event():
+    frame = sse_frame(3, 'clock_in', {'user_id': 1})
+    assert frame == b'id: 3\nevent: clock_in\ndata: ' + orjson.dumps({'user_id': 1}) + b'\n\n'
+    assert sse_frame(None, 'snapshot', []).startswith(b'event: snapshot\n')
+
+
+def test_subscribers_receive_published_events():
+    async def run():
+        feed = RosterFeed()
+        first, second = feed.subscribe(), feed.subscribe()
+        event = feed.publish('clock_in', {'user_id': 1}, school_id=2)
+        return event, await first.get(timeout=1.0), await second.get(timeout=1.0)
+
+    event, first, second = asyncio.run(run())
+    assert first is second is event
+    assert (event.id, event.type, event.school_id) == (1, 'clock_in', 2)
+
+
+def test_queue_overflow_sends_resync():
+    async def run():
+        feed = RosterFeed(queue_size=3)
+        slow = feed.subscribe()
+        for user_id in range(5):
+            feed.publish('clock_in', {'user_id': user_id})
+        return await _drain(slow)
+
+    events = asyncio.run(run())
+    # あふれた時点までのイベントは捨て、一覧を送り直す印と、その後のイベントだけが残る
+    assert events[0] is RESYNC
+    assert [event.id for event in events[1:]] == [5]
+
+
+def test_since_resumes_from_history():
+    feed = RosterFeed(history=3)
+    for user_id in range(5):
+        feed.publish('clock_in', {'user_id': user_id})
+    assert [event.id for event in feed.since(3)] == [4, 5]
+    assert feed.since(5) == []
+    # 保持している最古（3）の直前までは続きから送れる
+    assert [event.id for event in feed.since(2)] == [3, 4, 5]
+    # それより古い ID や、まだ無い ID は一覧から送り直す
+    assert feed.since(1) is None
+    assert feed.since(6) is None
+    assert RosterFeed().since(0) == []
+
+
+@pytest.mark.parametrize('queue_size', [1, 1000])
+def test_close_ends_every_stream(queue_size):
+    async def run():
+        feed = RosterFeed(queue_size=queue_size)
+        subscription = feed.subscribe()
+        feed.publish('clock_in', {'user_id': 1})
+        waiter = asyncio.ensure_future(_until_end(subscription))
+        await asyncio.sleep(0)
+        feed.close()
+        late = feed.subscribe()
+        return await asyncio.wait_for(waiter, 1.0), await late.get(timeout=1.0)
+
+    events, late = asyncio.run(run())
+    # キューが一杯でも終了の印は必ず届く
+    assert events[-1] is None
+    assert late is None
+
+
+async def _until_end(subscription):
+    events = []
+    while True:
+        event = await subscription.get(timeout=1.0)
+        events.append(event)
+        if event is None:
+            return events
+
+
+def test_stream_resumes_resyncs_and_ends_on_close(monkeypatch):
+    feed = RosterFeed(queue_size=2)
+    monkeypatch.setattr(main, 'roster_feed', feed)
+    monkeypatch.setattr(main, '_roster_payload', lambda school_id: {'staff': []})
+    for user_id in (1, 2):
+        feed.publish('clock_in', {'user_id': user_id}, school_id=1)
+
+    async def run():
+        stream = main._roster_events(None, 1)
+        frames = [await stream.__anext__(), await stream.__anext__()]
+        # 遅いクライアントのキューをあふれさせてから閉じる
+        for user_id in (3, 4, 5):
+            feed.publish('clock_in', {'user_id': user_id}, school_id=1)
+        feed.close()
+        frames += [frame async for frame in stream]
+        return frames
+
+    frames = asyncio.run(run())
+    assert frames[0] == b'retry: 3000\n\n'
+    # Last-Event-ID の続き（2 番）から送る
+    assert frames[1].startswith(b'id: 2\nevent: clock_in\n')
+    # あふれた分は一覧で送り直し、close() で配信が終わる
+    assert frames[2:] == [sse_frame(5, 'snapshot', {'staff': []})]
+    assert len(feed) == 0
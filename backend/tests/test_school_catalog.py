@@ -0,0 +1,47 @@
+import asyncio
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from school_catalog import CatalogEntry, SchoolCatalog, school_key
+from shared_state import SqliteState
+
+
+def _catalog():
+    catalog = SchoolCatalog(get_client=lambda: None)
+    for school_id in (1, 2):
+        catalog._entries[school_key(school_id)] = CatalogEntry({'id': school_id}, time.time())
+    return catalog
+
+
+@pytest.fixture
+def workers(tmp_path, monkeypatch):
+    path = str(tmp_path / 'shared.db')
+    first, second = SqliteState(path), SqliteState(path)
+    monkeypatch.setattr(main, 'shared_state', first)
+    monkeypatch.setattr(main, 'school_catalog', _catalog())
+    yield first, second
+    for state in (first, second):
+        asyncio.run(state.close())
+
+
+def test_invalidate_reaches_other_workers(workers):
+    first, second = workers
+    other = _catalog()
+    # 別のワーカーでは main と同じハンドラーが自分のカタログを捨てる
+    second.subscribe('school_catalog', lambda message: other.invalidate(message.get('school_id')))
+
+    response = TestClient(main.app).post('/api/admin/schools/cache/invalidate', params={'school_id': 1})
+    assert response.status_code == 200
+    assert response.json()['invalidated'] == 1
+    assert school_key(1) not in main.school_catalog._entries
+
+    assert asyncio.run(second.poll_once()) == 1
+    assert sorted(other._entries) == [school_key(2)]
+
+
+def test_invalidate_event_handler_drops_all_without_school_id(workers):
+    main._on_school_catalog_invalidated({'school_id': None})
+    assert main.school_catalog.stats()['entries'] == 0
@@ -0,0 +1,89 @@
+import asyncio
+import time
+
+import pytest
+
+from shared_state import LocalState, SqliteState
+
+
+@pytest.fixture
+def states(tmp_path):
+    path = str(tmp_path / 'shared.db')
+    first, second = SqliteState(path), SqliteState(path)
+    yield first, second
+    for state in (first, second):
+        asyncio.run(state.close())
+
+
+def test_kv_expires_after_ttl(states):
+    first, second = states
+
+    async def run():
+        await first.set('k', {'v': 1}, 0.1)
+        assert await second.get('k') == {'v': 1}
+        assert not await second.add('k', {'v': 2}, 60)
+        await asyncio.sleep(0.15)
+        assert await second.get('k') is None
+        # 期限切れのキーは add で書き直せる
+        assert await second.add('k', {'v': 2}, 60)
+        assert await first.pop('k') == {'v': 2}
+        assert await second.pop('k') is None
+
+    asyncio.run(run())
+
+
+def test_lease_is_held_by_one_state_until_expiry(states):
+    first, second = states
+
+    async def run():
+        assert await first.acquire('replayer', 0.1)
+        assert not await second.acquire('replayer', 0.1)
+        # 持っている側は延長できる
+        assert await first.acquire('replayer', 0.1)
+        # 持っていない側の release では外れない
+        await second.release('replayer')
+        assert not await second.acquire('replayer', 0.1)
+        await asyncio.sleep(0.15)
+        assert await second.acquire('replayer', 60)
+        assert not await first.acquire('replayer', 60)
+        await second.release('replayer')
+        assert await first.acquire('replayer', 60)
+
+    asyncio.run(run())
+
+
+def test_events_reach_other_states_only(states):
+    first, second = states
+    received = {'first': [], 'second': []}
+    first.subscribe('users', received['first'].append)
+    second.subscribe('users', received['second'].append)
+
+    async def run():
+        first.start()
+        second.start()
+        await first.publish('users', {'user_id': 1})
+        await second.publish('users', {'user_id': 2})
+        deadline = time.monotonic() + 2.0
+        try:
+            while (not received['first'] or not received['second']) and time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+        finally:
+            await first.close()
+            await second.close()
+
+    asyncio.run(run())
+    assert received == {'first': [{'user_id': 2}], 'second': [{'user_id': 1}]}
+
+
+def test_local_state_is_not_shared():
+    state = LocalState()
+
+    async def run():
+        # プロセス内の実装ではリースは常に取れる（複数ワーカーでは使えない）
+        assert await state.acquire('replayer', 60)
+        assert await state.acquire('replayer', 60)
+        await state.set('k', 1, 60)
+        return await state.get('k')
+
+    assert asyncio.run(run()) == 1
+    assert not state.shared
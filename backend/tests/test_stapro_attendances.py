@@ -0,0 +1,76 @@
+import asyncio
+
+import orjson
+import pytest
+from fastapi.testclient import TestClient
+
+import stapro_system
+from bench.stub_stapro import StubStapro
+from stapro_api_common import attendance_page_extras
+from stapro_system import _attendance_chunks
+
+
+def test_page_extras_keep_other_keys_without_page_cursor():
+    data = {
+        'attendances': [{'id': 1}],
+        'meta': {'total': 250, 'page': 1, 'per_page': 100, 'next_page': 2},
+        'staff': {'id': 5},
+    }
+    assert attendance_page_extras(data) == {'meta': {'total': 250}, 'staff': {'id': 5}}
+    assert attendance_page_extras([{'id': 1}]) == {}
+
+
+async def _rows(items):
+    for item in items:
+        yield item
+
+
+def _collect(items, extras):
+    async def run():
+        return b''.join([chunk async for chunk in _attendance_chunks(_rows(items), extras)])
+    return orjson.loads(asyncio.run(run()))
+
+
+def test_chunks_pass_through_first_page_extras():
+    body = _collect([{'id': 1}, {'id': 2}, {'id': 3}], {'meta': {'total': 3}})
+    assert body == {'meta': {'total': 3}, 'attendances': [{'id': 1}, {'id': 2}, {'id': 3}]}
+
+
+def test_chunks_without_rows_or_extras():
+    assert _collect([], {}) == {'attendances': []}
+    assert _collect([], {'meta': {}}) == {'meta': {}, 'attendances': []}
+
+
+@pytest.fixture
+def api(monkeypatch):
+    stub = StubStapro()
+    for i in range(1, 251):
+        stub.attendances[i] = {'id': i, 'staff_id': 5, 'work_day': f'2026-10-{(i % 28) + 1:02d}'}
+    monkeypatch.setattr(stapro_system, 'STAPRO_API_URL', stub.start())
+    monkeypatch.setattr(stapro_system, 'STAPRO_API_TOKEN', 't')
+    monkeypatch.setattr(stapro_system, 'SCHOOL_CATALOG_SNAPSHOT', '')
+    with TestClient(stapro_system.app) as client:
+        yield stub, client
+    stub.stop()
+
+
+@pytest.mark.parametrize('per_page', [1000, 100])
+def test_attendance_list_is_revalidated_with_etag(api, per_page):
+    stub, client = api
+    url = f'/staffs/5/attendances?per_page={per_page}'
+    first = client.get(url)
+    assert first.status_code == 200
+    assert len(first.json()['attendances']) == 250
+    assert first.headers['cache-control'] == 'private, no-cache'
+    etag = first.headers['etag']
+
+    again = client.get(url, headers={'If-None-Match': etag})
+    assert again.status_code == 304
+    assert again.content == b''
+    assert again.headers['etag'] == etag
+
+    stub.attendances[1]['work_day'] = '2026-10-31'
+    changed = client.get(url, headers={'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert changed.headers['etag'] != etag
+    assert changed.json()['attendances'][0]['work_day'] == '2026-10-31'
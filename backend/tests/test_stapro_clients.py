@@ -0,0 +1,80 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import pytest
+import requests
+
+from bench.stub_stapro import StubStapro
+from stapro_api_client import StaproAPIClient
+from stapro_api_client_async import AsyncStaproAPIClient
+
+
+@pytest.fixture
+def stub():
+    # 同時に送った GET が上流で重なるよう、応答を少し遅らせる
+    stub = StubStapro(latency=0.2)
+    stub.url = stub.start()
+    yield stub
+    stub.stop()
+
+
+def test_async_concurrent_gets_share_one_call(stub):
+    async def run():
+        async with AsyncStaproAPIClient(base_url=stub.url, api_token='t') as client:
+            first = await asyncio.gather(*(client.get_school(1) for _ in range(10)))
+            again = await asyncio.gather(*(client.get_school(1) for _ in range(10)))
+            return first, again, client.validators.not_modified
+
+    first, again, not_modified = asyncio.run(run())
+    assert all(school == first[0] for school in first + again)
+    # 1 回目と、検証子で問い合わせ直した 2 回目（304）の 2 回だけ
+    assert stub.requests == 2
+    assert not_modified == 1
+
+
+def test_async_failure_reaches_every_waiter(stub):
+    stub.error_rate = 1.0
+
+    async def run():
+        async with AsyncStaproAPIClient(base_url=stub.url, api_token='t') as client:
+            results = await asyncio.gather(*(client.get_school(1) for _ in range(5)), return_exceptions=True)
+            return results, client._inflight
+
+    results, inflight = asyncio.run(run())
+    assert all(isinstance(result, httpx.HTTPStatusError) for result in results)
+    assert stub.requests == 1
+    assert inflight == {}
+
+
+def _together(client, calls):
+    barrier = threading.Barrier(calls)
+
+    def call():
+        barrier.wait()
+        try:
+            return client.get_school(1)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(calls) as pool:
+        return list(pool.map(lambda _: call(), range(calls)))
+
+
+def test_sync_concurrent_gets_share_one_call(stub):
+    with StaproAPIClient(base_url=stub.url, api_token='t') as client:
+        first = _together(client, 8)
+        again = _together(client, 8)
+        assert client.validators.not_modified == 1
+    assert all(school == first[0] for school in first + again)
+    assert stub.requests == 2
+
+
+def test_sync_failure_reaches_every_waiter(stub):
+    stub.error_rate = 1.0
+    with StaproAPIClient(base_url=stub.url, api_token='t') as client:
+        results = _together(client, 8)
+        assert client._inflight == {}
+    assert all(isinstance(result, requests.exceptions.HTTPError) for result in results)
+    assert stub.requests == 1
@@ -0,0 +1,79 @@
+import asyncio
+import gc
+
+import pytest
+import supabase
+from fastapi.testclient import TestClient
+
+import main
+from bench.fake_supabase import FakeSupabase
+from state_tokens import StateTokenStore
+
+_CONFIRM = {'transport_cost': 300, 'class_count': 2}
+
+
+@pytest.fixture
+def api(tmp_path, monkeypatch):
+    db = FakeSupabase()
+    db.seed('users', [{'id': i, 'card_id': f'C{i}', 'name': f'u{i}', 'stapro_staff_id': 100 + i} for i in (1, 2)])
+
+    async def create_client(*args, **kwargs):
+        return db
+
+    monkeypatch.setattr(supabase, 'acreate_client', create_client)
+    for name, value in {
+        'SUPABASE_URL': 'http://supabase.test', 'SUPABASE_KEY': 'k', 'SHARED_STATE': 'local',
+        'ATTENDANCE_OUTBOX_PATH': str(tmp_path / 'outbox.db'), 'ATTENDANCE_JOURNAL_PATH': str(tmp_path / 'journal.db'),
+        'SCHOOL_CATALOG_SNAPSHOT': '', 'RECONCILE_WATERMARK_PATH': str(tmp_path / 'watermark.json'),
+        'STARTUP_WARMUP': '0',
+    }.items():
+        monkeypatch.setenv(name, value)
+    for name in ('STAPRO_API_URL', 'WEB_CONCURRENCY'):
+        monkeypatch.delenv(name, raising=False)
+    with TestClient(main.app) as client:
+        yield client
+
+
+def test_confirm_with_token_clocks_out(api):
+    assert api.post('/api/clock-in', json={'card_id': 'C1'}).status_code == 200
+    ready = api.post('/api/tap', json={'card_id': 'C1'}).json()
+    token = ready['state_token']
+    done = api.post('/api/tap', json={'state_token': token, 'confirm': _CONFIRM})
+    assert done.status_code == 200
+    assert done.json()['status'] == 'clocked_out'
+    # トークンは 1 回限り
+    reused = api.post('/api/tap', json={'state_token': token, 'confirm': _CONFIRM})
+    assert reused.status_code == 400
+
+
+def test_stale_token_is_rejected(api):
+    api.post('/api/clock-in', json={'card_id': 'C2'})
+    token = api.post('/api/tap', json={'card_id': 'C2'}).json()['state_token']
+    # トークンの発行後に別の端末で退勤した
+    api.post('/api/clock-out', json=dict(_CONFIRM, card_id='C2'))
+    stale = api.post('/api/tap', json={'state_token': token, 'confirm': _CONFIRM})
+    assert stale.status_code == 409
+
+
+def test_user_locks_are_dropped_when_unused():
+    async def run():
+        async with main._user_lock(1):
+            assert 1 in main._user_locks
+            assert main._user_lock(1) is main._user_lock(1)
+
+    asyncio.run(run())
+    gc.collect()
+    assert 1 not in main._user_locks
+
+
+def test_token_store_evicts_oldest_when_full():
+    tokens = StateTokenStore(ttl=60.0, max_tokens=3)
+
+    async def run():
+        issued = [await tokens.issue(user_id, f'C{user_id}', user_id) for user_id in range(1, 6)]
+        return issued, [await tokens.consume(token) for token in issued]
+
+    issued, states = asyncio.run(run())
+    assert len(tokens) == 0
+    assert states[:2] == [None, None]
+    assert [state.user_id for state in states[2:]] == [3, 4, 5]